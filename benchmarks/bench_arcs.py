@@ -0,0 +1,55 @@
+# Compares the recursive CircleFitter with the least squares ArcFitter on
+# offset contours: run time, number of output nodes and the maximum distance
+# between the original points and the simplified path.
+import os.path
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common.geom import *
+from DerpCAM.cam.shapes import Shape
+
+def test_shapes():
+    res = []
+    res.append(Shape.round_rectangle(0, 0, 100, 60, 10))
+    res.append(Shape.circle(50, 50, 40))
+    # A gear-like outline, with lots of concave and convex curves
+    gear = []
+    for i in range(720):
+        a = i * pi / 360
+        r = 40 + 3 * sin(12 * a)
+        gear.append(PathPoint(r * cos(a), r * sin(a)))
+    res.append(Shape(gear, True))
+    return res
+
+def offset_contours(shape):
+    boundary = PtsToInts(shape.boundary)
+    res = []
+    for d in (0.5, 1.5, 3, 6):
+        for contour in Shape._offset(boundary, True, d * GeometrySettings.RESOLUTION) or []:
+            res.append(PtsFromInts(contour))
+    return res
+
+def max_deviation(points, nodes):
+    path = Path(nodes, True)
+    return max(path.closest_point(p)[1] for p in points)
+
+def main():
+    contours = []
+    for shape in test_shapes():
+        contours += offset_contours(shape)
+    print(f"Contours: {len(contours)}, points: {sum(len(c) for c in contours)}")
+    results = {}
+    for fitter in (CircleFitter, ArcFitter):
+        start = time.perf_counter()
+        output = [fitter.simplify(c) for c in contours]
+        elapsed = time.perf_counter() - start
+        nodes = sum(len(o) for o in output)
+        arcs = sum(len([n for n in o if n.is_arc()]) for o in output)
+        deviation = max(max_deviation(c, o) for c, o in zip(contours, output))
+        print(f"{fitter.__name__}: {elapsed * 1000:0.1f} ms, {nodes} nodes, {arcs} arcs, max deviation {deviation:0.4f} mm")
+        results[fitter] = elapsed
+    print(f"Speedup: {results[CircleFitter] / results[ArcFitter]:0.1f}x")
+
+if __name__ == "__main__":
+    main()
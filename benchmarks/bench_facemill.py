@@ -0,0 +1,31 @@
+# Axis-parallel face milling of a 600x400 mm sheet with a 6 mm cutter, with and
+# without islands and zigzag connections between the rows.
+import os.path
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common.geom import *
+from DerpCAM.cam import pocket
+from DerpCAM.cam.milling_tool import *
+from DerpCAM.cam.shapes import Shape
+
+def main():
+    # Measure the clipping, not the cache
+    GeometrySettings.geometry_cache = False
+    tool = standard_tool(6, 2, material_aluminium, carbide_uncoated)
+    tool.stepover = 0.5
+    sheet = Shape.rectangle(0, 0, 600, 400)
+    holes = Shape.rectangle(0, 0, 600, 400)
+    for i in range(5):
+        for j in range(3):
+            holes.add_island(Shape.circle(100 + i * 100, 100 + j * 100, 15).boundary)
+    for name, shape in (("sheet", sheet), ("sheet with holes", holes)):
+        for zigzag in (False, True):
+            start = time.perf_counter()
+            tps = pocket.axis_parallel(shape, tool, 0, 0, zigzag)
+            elapsed = time.perf_counter() - start
+            print(f"{name}, zigzag={zigzag}: {elapsed * 1000:0.1f} ms, {len(tps.toolpaths)} toolpaths")
+
+if __name__ == "__main__":
+    main()
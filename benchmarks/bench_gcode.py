@@ -0,0 +1,107 @@
+# Measures how fast the G-code text is generated from already calculated
+# toolpaths, in lines per second. Compares formatting the moves one by one
+# with formatting the runs of moves within each subpath at once, and
+# generating the operations one after another with generating them in the
+# worker processes.
+import os.path
+import random
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common.geom import *
+from DerpCAM.cam import gcodegen, shapes
+from DerpCAM.cam.gcodeops import *
+from DerpCAM.cam.milling_tool import *
+
+# Small random deviations, so that not all of the outlines are replaced with arcs
+def jitter(rng):
+    return 0.02 * rng.random()
+
+def gear(cx, cy, r, teeth, npoints):
+    rng = random.Random(1)
+    points = []
+    for i in range(npoints):
+        a = i * 2 * pi / npoints
+        rr = r + 1.5 * sin(teeth * a) + jitter(rng)
+        points.append(PathPoint(cx + rr * cos(a), cy + rr * sin(a)))
+    return shapes.Shape(points, True)
+
+def spiral(npoints):
+    rng = random.Random(2)
+    points = []
+    for i in range(npoints):
+        r = 5 + 0.002 * i + jitter(rng)
+        points.append(PathPoint(r * cos(0.01 * i), r * sin(0.01 * i)))
+    return shapes.Shape(points, False)
+
+def workloads():
+    machine_params = MachineParams(5, 1)
+    tool = standard_tool(3, 2, material_aluminium, carbide_uncoated)
+    tool.maxdoc = 0.5
+    props = OperationProps(depth=-10)
+    res = []
+    # Long contours repeated over many depths
+    operations = Operations(machine_params, tool, props)
+    operations.outside_contour(gear(0, 0, 40, 60, 5000), tabs=0)
+    res.append(("gear contour", operations))
+    operations = Operations(machine_params, tool, props)
+    rect = shapes.Shape.round_rectangle(0, 0, 120, 80, 10)
+    rect.add_island(shapes.Shape.circle(40, 40, 12).boundary)
+    operations.pocket(rect)
+    res.append(("pocket", operations))
+    operations = Operations(machine_params, tool, OperationProps(depth=-0.5))
+    operations.engrave(spiral(50000))
+    res.append(("engraved spiral", operations))
+    return res
+
+def measure(operations, repeats=3):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        lines = operations.to_gcode().gcode
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return lines, best
+
+def main():
+    # With arcs fitted to the toolpaths (the default) and without, the latter
+    # gives many more lines
+    for simplify_arcs in (True, False):
+        GeometrySettings.simplify_arcs = simplify_arcs
+        for name, operations in workloads():
+            # Calculate the toolpaths first
+            operations.to_gcode()
+            results = []
+            for mode, batch_min in [("one by one", 1 << 30), ("batched", getattr(gcodegen.Gcode, 'BATCH_MIN', 1 << 30))]:
+                old_batch_min = getattr(gcodegen.Gcode, 'BATCH_MIN', None)
+                gcodegen.Gcode.BATCH_MIN = batch_min
+                try:
+                    lines, elapsed = measure(operations)
+                finally:
+                    gcodegen.Gcode.BATCH_MIN = old_batch_min
+                results.append(lines)
+                print(f"{name}{'' if simplify_arcs else ' without arcs'}, {mode}: {len(lines)} lines in {elapsed * 1000:0.1f} ms, {len(lines) / elapsed:0.0f} lines/s")
+            assert results[0] == results[1]
+    # All of the above in one program, each operation generated in a worker
+    # process and joined in order
+    GeometrySettings.simplify_arcs = True
+    operations = Operations(MachineParams(5, 1))
+    for name, workload in workloads():
+        operations.add_all(workload.operations)
+    operations.to_gcode()
+    results = []
+    for worker_processes in (0, max(2, os.cpu_count() or 1)):
+        GeometrySettings.worker_processes = worker_processes
+        try:
+            # The first run starts the worker processes
+            operations.to_gcode()
+            lines, elapsed = measure(operations)
+        finally:
+            GeometrySettings.worker_processes = 0
+        results.append(lines)
+        print(f"all, {worker_processes} worker processes: {len(lines)} lines in {elapsed * 1000:0.1f} ms, {len(lines) / elapsed:0.0f} lines/s")
+    assert results[0] == results[1]
+
+if __name__ == "__main__":
+    main()
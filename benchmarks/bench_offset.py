@@ -0,0 +1,28 @@
+# Contour-parallel pocketing of square parts of increasing size with a 3 mm
+# cutter. The time per ring should stay roughly constant as the part (and the
+# number of rings) grows.
+import os.path
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common.geom import *
+from DerpCAM.cam import pocket
+from DerpCAM.cam.milling_tool import *
+from DerpCAM.cam.shapes import Shape
+
+def main():
+    # Measure the offsetting, not the cache
+    GeometrySettings.geometry_cache = False
+    tool = standard_tool(3, 2, material_aluminium, carbide_uncoated)
+    tool.stepover = 0.5
+    for size in (50, 100, 200, 500):
+        shape = Shape.round_rectangle(0, 0, size, size, 10)
+        start = time.perf_counter()
+        tps = pocket.contour_parallel(shape, tool)
+        elapsed = time.perf_counter() - start
+        rings = ceil((size / 2 - tool.diameter / 2) / (tool.diameter * tool.stepover))
+        print(f"{size} mm: {elapsed * 1000:0.1f} ms, {rings} rings, {elapsed * 1000 / rings:0.2f} ms per ring")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Compares the object-per-node Path with the array-backed ArrayPath:
+# memory used by the path itself and throughput of the common queries.
+import os.path
+import sys
+import time
+import tracemalloc
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common.geom import *
+
+def spiral(npoints):
+    nodes = []
+    for i in range(npoints):
+        r = 5 + i * 0.001
+        a = 0.01 * i
+        nodes.append(PathPoint(r * cos(a), r * sin(a)))
+        if i % 100 == 99:
+            # Sprinkle some arcs in, like in HSM toolpaths
+            last = nodes[-1]
+            arc = PathArc.xyra(last.x - 1, last.y, 1, 0, pi / 2)
+            nodes.append(PathPoint(arc.p1.x, arc.p1.y))
+            nodes.append(arc)
+    return nodes
+
+def measure_memory(func):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    res = func()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return res, after - before
+
+def measure_time(func, repeat=5):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def main(npoints=100000):
+    tuples = [node.as_tuple() for node in spiral(npoints)]
+    path, path_mem = measure_memory(lambda: Path([PathNode.from_tuple(t) for t in tuples], False))
+    apath, apath_mem = measure_memory(lambda: ArrayPath.from_nodes([PathNode.from_tuple(t) for t in tuples], False).compact())
+    print(f"Nodes: {len(path.nodes)}")
+    print(f"Memory: Path {path_mem / 1048576:0.2f} MB, ArrayPath {apath_mem / 1048576:0.2f} MB")
+    assert abs(path.length() - apath.length()) < 0.001
+    assert path.bounds() == apath.bounds()
+    # Bypass the cached length index
+    for name, func in [("lengths", lambda p: p.calc_lengths()), ("bounds", lambda p: p.bounds())]:
+        t1 = measure_time(lambda: func(path))
+        t2 = measure_time(lambda: func(apath))
+        print(f"{name}: Path {t1 * 1000:0.2f} ms, ArrayPath {t2 * 1000:0.2f} ms, speedup {t1 / t2:0.1f}x")
+    # Position queries, like placing tabs or entry points on a long contour
+    # (the first query includes building the length index and segment grid)
+    queries = [PathPoint(10 * cos(i), 10 * sin(i)) for i in range(100)]
+    for p in (Path(path.nodes, False), ArrayPath.from_path(apath)):
+        start = time.perf_counter()
+        for pt in queries:
+            pos, d = p.closest_point(pt)
+            p.point_at(pos)
+            p.subpath(pos, pos + 1)
+        elapsed = time.perf_counter() - start
+        print(f"{len(queries)} closest_point/point_at/subpath queries on {type(p).__name__}: {elapsed * 1000:0.2f} ms")
+    lengths = path.lengths()
+    start = time.perf_counter()
+    for pt in queries[:10]:
+        path.closest_point_on_segments(pt, range(len(lengths) - 1), lengths)
+    elapsed = time.perf_counter() - start
+    print(f"Linear scan closest_point, estimated for {len(queries)} queries: {elapsed * 10000:0.2f} ms")
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,104 @@
+# Measures how much of the pocketing time is spent converting coordinates
+# between PathPoint lists, pyclipper integer paths and shapely geometries.
+# Only the outermost conversion call is counted, so nested conversions
+# (e.g. IntPath calling PtsToInts) are not counted twice.
+import os.path
+import sys
+import time
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common import geom
+from DerpCAM.common.geom import *
+from DerpCAM.cam import pocket, shapes, toolpath
+from DerpCAM.cam.milling_tool import *
+from DerpCAM.cam.shapes import Shape
+
+class ConversionTimer(object):
+    # Module level names of the conversion functions, checked in each of the modules
+    functions = ['PtsToInts', 'PtsFromInts', 'PtsToArray', 'PtsToIntArray', 'PtsFromIntArray', 'ArrayToPts', 'circle',
+        'linestring2path', 'linestring2points', 'LinearRing']
+    modules = [geom, shapes, toolpath, pocket]
+    def __init__(self):
+        self.depth = 0
+        self.elapsed = 0
+        self.calls = 0
+        self.saved = []
+    def wrap(self, func):
+        def wrapper(*args, **kwargs):
+            if self.depth:
+                return func(*args, **kwargs)
+            self.depth += 1
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.elapsed += time.perf_counter() - start
+                self.calls += 1
+                self.depth -= 1
+        return wrapper
+    def install(self):
+        wrappers = {}
+        for module in self.modules:
+            for name in self.functions:
+                func = getattr(module, name, None)
+                if func is None:
+                    continue
+                if func not in wrappers:
+                    wrappers[func] = self.wrap(func)
+                self.saved.append((module, name, func))
+                setattr(module, name, wrappers[func])
+        # IntPath is a class, only wrap its constructor
+        self.saved_init = geom.IntPath.__init__
+        geom.IntPath.__init__ = self.wrap(geom.IntPath.__init__)
+    def uninstall(self):
+        for module, name, func in self.saved:
+            setattr(module, name, func)
+        geom.IntPath.__init__ = self.saved_init
+        self.saved = []
+
+def test_shape():
+    shape = Shape.round_rectangle(0, 0, 120, 80, 10)
+    shape.add_island(Shape.circle(30, 40, 12).boundary)
+    shape.add_island(Shape.circle(80, 40, 15).boundary)
+    gear = []
+    for i in range(720):
+        a = i * pi / 360
+        r = 8 + 1.5 * sin(12 * a)
+        gear.append(PathPoint(55 + r * cos(a), 15 + r * sin(a)))
+    shape.add_island(gear)
+    return shape
+
+def main():
+    # Repeated runs would be served from the cache otherwise
+    GeometrySettings.geometry_cache = False
+    shape = test_shape()
+    tool = standard_tool(3, 2, material_aluminium, carbide_uncoated)
+    tool.stepover = 0.4
+    # hsm_nibble is slow with small tools, and the conversions are not what dominates there
+    hsm_tool = standard_tool(6, 2, material_aluminium, carbide_uncoated)
+    tests = [
+        ("contour_parallel", lambda: pocket.contour_parallel(shape, tool)),
+        ("axis_parallel", lambda: pocket.axis_parallel(shape, tool, 0, 0, True)),
+        ("hsm_peel", lambda: pocket.hsm_peel(shape, hsm_tool, False)),
+        ("refine_shape_internal", lambda: pocket.refine_shape_internal(shape, 6, 3, 1)),
+    ]
+    repeats = 3
+    for name, func in tests:
+        func()
+        best = None
+        for i in range(repeats):
+            timer = ConversionTimer()
+            timer.install()
+            try:
+                start = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start
+            finally:
+                timer.uninstall()
+            if best is None or elapsed < best[0]:
+                best = (elapsed, timer)
+        elapsed, timer = best
+        print(f"{name}: {elapsed * 1000:0.1f} ms, conversions {timer.elapsed * 1000:0.1f} ms in {timer.calls} calls ({100 * timer.elapsed / elapsed:0.1f}%)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Measures how long the entry points take to start: importing the modules
+# each of them needs, showing the main window (measured up to the point where
+# --close makes it quit) and exporting a small project to G-Code with and
+# without the GUI. With --profile, also lists the slowest imports as reported
+# by python -X importtime.
+import json
+import os.path
+import subprocess
+import sys
+import tempfile
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Optional packages that should only be loaded when they are needed
+heavy_modules = ['PyQt5.QtWidgets', 'ezdxf', 'shapely', 'hsm_nibble', 'pyvoronoi', 'DerpCAM.cam.pocket']
+
+imports = [
+    ("gui", "from DerpCAM.gui import model, settings, cutter_mgr, main_win"),
+    ("export", "from DerpCAM.gui import model, settings"),
+    ("engine", "from DerpCAM.engine import batch, project"),
+]
+
+test_project = {
+    "material": { "_type": "WorkpieceTreeItem", "material": 1, "thickness": 3, "clearance": 5, "safe_entry_z": 1 },
+    "tools": [
+        { "_type": "EndMillCutter", "id": 1, "name": "Bench cutter", "material": "carbide", "diameter": 3, "length": 10.0, "flutes": 2 },
+    ],
+    "tool_presets": [
+        { "_type": "EndMillPreset", "id": 2, "name" : "Bench preset", "toolbit": 1,
+          "rpm": 16000, "hfeed": 500, "vfeed": 100, "maxdoc": 1, "stepover": 0.4, "direction": 1 },
+    ],
+    "default_presets": [ { "tool_id": 1, "preset_id": 2 } ],
+    "drawing": {
+        "header": { "_type": "DrawingTreeItem", "x_offset": 0, "y_offset": 0 },
+        "items": [
+            { "_type": "DrawingCircleTreeItem", "shape_id": 1, "cx": 0, "cy": 0, "r": 10 },
+            { "_type": "DrawingPolylineTreeItem", "shape_id": 2, "points": [[20, 0], [40, 0], [40, 20], [20, 20]], "closed": True},
+        ],
+    },
+    "operation_cycles": [
+        {
+            "tool_id": 1, "is_current": True,
+            "operations": [
+                { "_type": "OperationTreeItem", "operation": 1, "cutter": 1, "tool_preset": 2, "shape_id": 1 },
+                { "_type": "OperationTreeItem", "operation": 4, "cutter": 1, "tool_preset": 2, "shape_id": 2 },
+            ],
+        },
+    ],
+}
+
+def run(args, env):
+    start = time.perf_counter()
+    subprocess.run(args, env=env, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def best_of(repeats, args, env):
+    return min(run(args, env) for i in range(repeats))
+
+def loaded_modules(code, env):
+    check = code + "; import sys; print(' '.join(m for m in " + repr(heavy_modules) + " if m in sys.modules))"
+    return subprocess.run([sys.executable, "-c", check], env=env, check=True, capture_output=True, text=True).stdout.split()
+
+def import_profile(code, env, count):
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", code], env=env, check=True, capture_output=True, text=True).stderr
+    res = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        # Top level packages and DerpCAM modules only, the rest is included in those
+        name = name.strip()
+        if "." in name and not name.startswith("DerpCAM"):
+            continue
+        res.append((int(cumulative), name))
+    res.sort(reverse=True)
+    return res[:count]
+
+def main():
+    profile = "--profile" in sys.argv[1:]
+    repeats = 5
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Use separate settings, inventory and cache, so that the user's own are not touched
+        env = dict(os.environ, PYTHONPATH=os.path.join(root, 'src'), QT_QPA_PLATFORM=os.environ.get('QT_QPA_PLATFORM', 'offscreen'),
+            XDG_CONFIG_HOME=os.path.join(tmpdir, "config"), XDG_DATA_HOME=os.path.join(tmpdir, "data"), XDG_CACHE_HOME=os.path.join(tmpdir, "cache"))
+        print(f"Python startup: {best_of(repeats, [sys.executable, '-c', 'pass'], env) * 1000:0.1f} ms")
+        for name, code in imports:
+            elapsed = best_of(repeats, [sys.executable, "-c", code], env)
+            print(f"Import for {name}: {elapsed * 1000:0.1f} ms, loaded: {', '.join(loaded_modules(code, env)) or 'none'}")
+            if profile:
+                for cumulative, module in import_profile(code, env, 15):
+                    print(f"    {cumulative / 1000:8.1f} ms {module}")
+        prj_fn = os.path.join(tmpdir, "bench.dcp")
+        with open(prj_fn, "w") as f:
+            json.dump(test_project, f)
+        out_fn = os.path.join(tmpdir, "bench.ngc")
+        # The first run creates the default inventory
+        run([sys.executable, os.path.join(root, "DerpCAM"), "--close"], env)
+        print(f"Time to first window: {best_of(repeats, [sys.executable, os.path.join(root, 'DerpCAM'), '--close'], env) * 1000:0.1f} ms")
+        print(f"Time to export (DerpCAM --export-gcode): {best_of(repeats, [sys.executable, os.path.join(root, 'DerpCAM'), prj_fn, '--export-gcode', out_fn, '--no-cache'], env) * 1000:0.1f} ms")
+        print(f"Time to export (DerpCAM-batch): {best_of(repeats, [sys.executable, os.path.join(root, 'DerpCAM-batch'), prj_fn, '--no-cache'], env) * 1000:0.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -12,8 +12,8 @@ def plain_clipper(shape, diameter, outside, displace, climb):
     paths = [geom.Path(geom.PtsFromInts(path), shape.closed) for path in res]
     if geom.GeometrySettings.simplify_arcs:
         paths = [path.lines_to_arcs() for path in paths]
-    if geom.GeometrySettings.simplify_lines:
-        paths = [path.optimize_lines() for path in paths]
+    # The lines are merged later by Toolpath.optimize, with the tolerance of
+    # the operation, and doing it here too would add up the errors
     return paths
     
 def plain_shapely(shape, diameter, outside, displace, climb):
@@ -142,7 +142,7 @@ def pseudotrochoidal(shape, diameter, is_outside, displace, climb, stepover, cir
     res_out = shapes.Shape._offset(PtsToInts(shape.boundary), True, (dist2 if is_outside else -dist2) * resolution)
     if not res_out:
         return None
-    outside = shapely.geometry.MultiLineString([[(pt.x, pt.y) for pt in PtsFromInts(path + path[0:1])] for path in res_out])
+    outside = shapely.geometry.MultiLineString([geom.PtsFromIntArray(path + path[0:1], resolution) for path in res_out])
 
     res = []
     for i in res_out:
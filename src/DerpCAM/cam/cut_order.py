@@ -0,0 +1,226 @@
+import copy
+import numpy
+from DerpCAM.common.geom import *
+
+# Reordering of the cuts to shorten the rapid moves between them. Every cutpath
+# of an operation (or a whole operation, e.g. a drilled hole) is a node with a
+# start point and an end point. Nodes whose cut areas overlap are kept in
+# their original order, which keeps the islands/holes before the contours
+# around them and the refining passes after the roughing ones. Operations that
+# can't be moved (tool changes) split the program into separately optimized
+# blocks.
+
+# Larger blocks only get the nearest neighbour ordering
+MAX_IMPROVE_NODES = 500
+MAX_PASSES = 50
+
+class CutNode(object):
+    def __init__(self, operation, cutpath, start, end, bounds):
+        self.operation = operation
+        self.cutpath = cutpath
+        self.start = start
+        self.end = end
+        self.bounds = bounds
+
+# Returns (list of nodes, or None if the operation can't be moved)
+def operation_nodes(operation):
+    parts = operation.order_parts()
+    if parts is None:
+        return None
+    return [CutNode(operation, *part) for part in parts]
+
+# Rebuilds the operations from the nodes in the new order, consecutive
+# cutpaths of the same operation stay in one operation
+def nodes_to_operations(nodes):
+    res = []
+    for node in nodes:
+        if node.cutpath is None:
+            res.append((node.operation, None))
+        elif res and res[-1][0] is node.operation and res[-1][1] is not None:
+            res[-1][1].append(node.cutpath)
+        else:
+            res.append((node.operation, [node.cutpath]))
+    operations = []
+    for operation, cutpaths in res:
+        # Operations that weren't split or reordered are kept as they were
+        if cutpaths is not None and cutpaths != operation.cutpaths:
+            operation = copy.copy(operation)
+            operation.cutpaths = cutpaths
+        operations.append(operation)
+    return operations
+
+def endpoint_array(points):
+    return numpy.array([(p.x, p.y) for p in points], dtype=numpy.float64).reshape(-1, 2)
+
+# Distances for the rapids from node a (or the start position, the row after
+# the nodes) to node b (or the end position, the column after the nodes).
+# The end position is optional, the moves to it cost nothing if it's None.
+def rapid_distances(nodes, start, end):
+    ends = endpoint_array([node.end for node in nodes] + [start])
+    starts = endpoint_array([node.start for node in nodes] + [end if end is not None else start])
+    res = numpy.hypot(ends[:, None, 0] - starts[None, :, 0], ends[:, None, 1] - starts[None, :, 1])
+    if end is None:
+        res[:, -1] = 0
+    return res
+
+# Symmetric matrix of the pairs of nodes whose relative order must not change
+def order_constraints(nodes):
+    bounds = numpy.array([node.bounds for node in nodes], dtype=numpy.float64).reshape(-1, 4)
+    res = (bounds[:, None, 0] <= bounds[None, :, 2]) & (bounds[None, :, 0] <= bounds[:, None, 2]) & (bounds[:, None, 1] <= bounds[None, :, 3]) & (bounds[None, :, 1] <= bounds[:, None, 3])
+    numpy.fill_diagonal(res, False)
+    return res
+
+def tour_length(distances, tour):
+    n = len(distances) - 1
+    seq = [n] + list(tour) + [n]
+    return float(sum(distances[a, b] for a, b in zip(seq, seq[1:])))
+
+# Greedy ordering, always going to the closest node whose predecessors have
+# all been cut
+def nearest_neighbour(distances, constraints):
+    n = len(distances) - 1
+    successors = numpy.triu(constraints)
+    waiting = successors.sum(axis=0)
+    done = numpy.zeros(n, dtype=bool)
+    current = n
+    tour = []
+    for i in range(n):
+        candidates = numpy.nonzero(~done & (waiting == 0))[0]
+        current = int(candidates[numpy.argmin(distances[current, candidates])])
+        tour.append(current)
+        done[current] = True
+        waiting -= successors[current]
+    return tour
+
+# Reverses parts of the tour where that makes it shorter (2-opt). The order
+# of the constrained pairs within a reversed part would change, so those
+# reversals aren't allowed.
+def two_opt_pass(distances, constraints, tour):
+    n = len(tour)
+    improved = False
+    changed = True
+    for a in range(n - 1):
+        if changed:
+            seq = numpy.array([n] + tour + [n])
+            fwd = distances[seq[:-1], seq[1:]]
+            fwd_sum = numpy.concatenate([[0], numpy.cumsum(fwd)])
+            rev_sum = numpy.concatenate([[0], numpy.cumsum(distances[seq[1:], seq[:-1]])])
+            # Position of the last node before each node that it's constrained with
+            last_conflict = numpy.where(numpy.triu(constraints[tour][:, tour], 1), numpy.arange(n)[:, None], -1).max(axis=0)
+            changed = False
+        # Reversing tour[a..b] for all b > a, i.e. seq[i..j]
+        b = numpy.arange(a + 1, n)
+        i, j = a + 1, b + 1
+        valid = numpy.maximum.accumulate(last_conflict[a + 1:]) < a
+        old = fwd[i - 1] + (fwd_sum[j] - fwd_sum[i]) + fwd[j]
+        new = distances[seq[i - 1], seq[j]] + (rev_sum[j] - rev_sum[i]) + distances[seq[i], seq[j + 1]]
+        gain = numpy.where(valid, old - new, 0)
+        best = int(numpy.argmax(gain))
+        if gain[best] > 1e-6:
+            tour[a:b[best] + 1] = tour[a:b[best] + 1][::-1]
+            improved = changed = True
+    return improved
+
+# Moves runs of 1 to 3 nodes to a better place (Or-opt), as long as they
+# don't move past a node they're constrained with
+def or_opt_pass(distances, constraints, tour):
+    n = len(tour)
+    improved = False
+    for length in (1, 2, 3):
+        i = 1
+        while i + length <= n + 1:
+            seq = numpy.array([n] + tour + [n])
+            m = len(seq)
+            first, last = seq[i], seq[i + length - 1]
+            removed = distances[seq[i - 1], first] + distances[last, seq[i + length]] - distances[seq[i - 1], seq[i + length]]
+            blocked = numpy.append(constraints[seq[i:i + length]].any(axis=0), False)[seq]
+            # Insert between seq[p] and seq[p + 1], after or before the run
+            after = numpy.arange(i + length, m - 1)
+            before = numpy.arange(0, i - 1)
+            valid_after = ~numpy.logical_or.accumulate(blocked[i + length:m - 1])
+            valid_before = ~numpy.logical_or.accumulate(blocked[1:i][::-1])[::-1]
+            p = numpy.concatenate([before, after])
+            valid = numpy.concatenate([valid_before, valid_after])
+            added = distances[seq[p], first] + distances[last, seq[p + 1]] - distances[seq[p], seq[p + 1]]
+            gain = numpy.where(valid, removed - added, 0)
+            best = int(numpy.argmax(gain)) if len(gain) else 0
+            if len(gain) and gain[best] > 1e-6:
+                p = int(p[best])
+                run = tour[i - 1:i - 1 + length]
+                rest = tour[:i - 1] + tour[i - 1 + length:]
+                # Position in the tour without the run
+                pos = p if p < i else p - length
+                tour[:] = rest[:pos] + run + rest[pos:]
+                improved = True
+            else:
+                i += 1
+    return improved
+
+# Returns the nodes in the new order
+def order_nodes(nodes, start, end):
+    if len(nodes) < 2:
+        return nodes
+    distances = rapid_distances(nodes, start, end)
+    constraints = order_constraints(nodes)
+    tour = nearest_neighbour(distances, constraints)
+    if len(nodes) <= MAX_IMPROVE_NODES:
+        for i in range(MAX_PASSES):
+            if is_calculation_cancelled():
+                break
+            improved = two_opt_pass(distances, constraints, tour)
+            improved = or_opt_pass(distances, constraints, tour) or improved
+            if not improved:
+                break
+    # Never make it worse than the original order
+    if tour_length(distances, tour) >= tour_length(distances, range(len(nodes))) - 1e-6:
+        return nodes
+    return [nodes[i] for i in tour]
+
+def block_length(nodes, start, end):
+    if not nodes:
+        return 0 if end is None else dist(start, end)
+    return tour_length(rapid_distances(nodes, start, end), range(len(nodes)))
+
+# Returns the reordered list of operations and the total length of the rapid
+# moves between the cuts before and after reordering. The program starts and
+# ends at start.
+def optimize_order(operations, start):
+    res = []
+    before = after = 0
+    block = []
+    pos = start
+    for operation in operations + [None]:
+        nodes = operation_nodes(operation) if operation is not None else None
+        if nodes is not None:
+            block += nodes
+            continue
+        # The end of the program returns to the start point, a block followed
+        # by an operation that can't be moved can end anywhere
+        end = start if operation is None else None
+        ordered = order_nodes(block, pos, end)
+        before += block_length(block, pos, end)
+        after += block_length(ordered, pos, end)
+        res += nodes_to_operations(ordered)
+        if ordered:
+            pos = ordered[-1].end
+        block = []
+        if operation is not None:
+            res.append(operation)
+    return res, before, after
+
+# Fast ordering of many points (e.g. the holes of a pattern), in rows about as
+# tall as the average spacing of the points, cut alternately left to right and
+# right to left. Points in a row of a regular grid stay in the same row.
+# Returns the indices of the points in the new order.
+def serpentine_order(points):
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 2)
+    if len(points) < 3:
+        return numpy.arange(len(points))
+    lo = points.min(axis=0)
+    width, height = points.max(axis=0) - lo
+    row_height = sqrt(max(width * height, 1e-12) / len(points))
+    rows = numpy.floor((points[:, 1] - lo[1]) / row_height + 0.5).astype(numpy.int64)
+    # Only count the rows that have any points in them, to alternate the direction
+    rows = numpy.unique(rows, return_inverse=True)[1].reshape(-1)
+    x = numpy.where(rows % 2 == 0, points[:, 0], -points[:, 0])
+    return numpy.lexsort((x, rows))
@@ -1,9 +1,7 @@
+import copy
+import numpy
 import threading
 from DerpCAM.common.geom import *
-from DerpCAM import cam
-import DerpCAM.cam.contour
-import DerpCAM.cam.peel
-import DerpCAM.cam.pocket
 from DerpCAM.cam.wall_profile import PlainWallProfile
 
 from DerpCAM.cam import shapes, toolpath
@@ -14,21 +12,148 @@ debug_ramp = False
 debug_tabs = False
 debug_sections = True
 
+# Numbers in the output are rounded to 3 decimal places (4 in inch mode), with
+# the trailing zeros removed. The positions are compared as integers, using
+# the same rounding: the keys are 2 * the rounded value scaled to an integer,
+# or -1 for negative values that round to zero (output as -0). ABSENT is
+# used for the axes not specified.
+ABSENT = numpy.iinfo(numpy.int64).min
+FIXED_INT_DIGITS = 6
+
+# Values of GeometrySettings.gcode_subroutines
+SUBROUTINES_NONE = 0
+SUBROUTINES_OWORD = 1
+SUBROUTINES_M98 = 2
+
+def fixed_point(value, digits):
+    text = "%0.*f" % (digits, value)
+    n = int(text.replace(".", ""))
+    return text.rstrip("0").rstrip("."), -1 if n == 0 and text[0] == '-' else 2 * n
+
+# Same as fixed_point, for an array of values (NaN for the missing ones).
+# Returns a matrix with the characters of each of the numbers (0 where there
+# is no character) and an array of keys. Returns None if some of the numbers
+# are too large to be formatted this way.
+def fixed_point_array(values, digits):
+    scale = 10 ** digits
+    present = ~numpy.isnan(values)
+    scaled = numpy.where(present, values, 0) * scale
+    rounded = numpy.rint(scaled)
+    if numpy.any(numpy.abs(rounded) >= 10 ** (FIXED_INT_DIGITS + digits)):
+        return None
+    n = rounded.astype(numpy.int64)
+    negative = present & numpy.signbit(values)
+    keys = numpy.where(present, numpy.where(negative & (n == 0), -1, 2 * n), ABSENT)
+    count = len(values)
+    # Sign, integer part, decimal point, fractional part
+    chars = numpy.zeros((count, 2 + FIXED_INT_DIGITS + digits), dtype=numpy.uint8)
+    chars[:, 0] = numpy.where(negative, ord('-'), 0)
+    n = numpy.abs(n)
+    whole = n // scale
+    for col in range(FIXED_INT_DIGITS, 0, -1):
+        chars[:, col] = whole % 10 + ord('0')
+        whole //= 10
+    leading = numpy.ones(count, dtype=bool)
+    for col in range(1, FIXED_INT_DIGITS):
+        leading &= chars[:, col] == ord('0')
+        chars[leading, col] = 0
+    frac = n % scale
+    trailing = numpy.ones(count, dtype=bool)
+    for col in range(1 + FIXED_INT_DIGITS + digits, 1 + FIXED_INT_DIGITS, -1):
+        digit = frac % 10
+        trailing &= digit == 0
+        chars[:, col] = numpy.where(trailing, 0, digit + ord('0'))
+        frac //= 10
+    chars[:, 1 + FIXED_INT_DIGITS] = numpy.where(trailing, 0, ord('.'))
+    chars[~present] = 0
+    # Values very close to halfway between two possible outputs are formatted
+    # one by one, so that they're rounded exactly like the % operator does
+    for index in numpy.nonzero(present & (numpy.abs(numpy.abs(scaled - rounded) - 0.5) < 1e-4))[0]:
+        text, keys[index] = fixed_point(values[index], digits)
+        chars[index] = 0
+        chars[index, :len(text)] = numpy.frombuffer(text.encode(), dtype=numpy.uint8)
+    return chars, keys
+
 class Gcode(object):
-    def __init__(self):
+    # Lines kept in memory when writing to a sink, the last one may still be
+    # replaced by feed() or compared against by add_dedup()
+    LOOKBACK = 1
+    FLUSH_SIZE = 10000
+    # Shorter runs of moves are formatted one by one, for those it's faster
+    BATCH_MIN = 16
+    # Shorter runs of moves are never output as subroutines
+    SUBROUTINE_MIN = 8
+    SUBROUTINE_FIRST = 1000
+    MOVE_COMMANDS = numpy.frombuffer(b"G0G1G2G3", dtype=numpy.uint8).reshape(4, 2)
+    MOVE_AXES = numpy.frombuffer(b" X Y Z I J", dtype=numpy.uint8).reshape(5, 2)
+    # sink is a function called with lists of lines as they are generated,
+    # if None, all the lines are kept in self.gcode
+    def __init__(self, sink=None):
         self.inch_mode = GeometrySettings.gcode_inches
         self.gcode = []
+        self.sink = sink
+        # Number of lines already passed to the sink
+        self.flushed = 0
         self.last_feed = 0
         self.last_feed_index = None
         self.rpm = None
         self.last_rpm = None
+        # Keys of the last position, see fixed_point
         self.last_coords = None
+        # Keys of X, Y and Z of the current position, ABSENT if not known
+        self.position = (ABSENT, ABSENT, ABSENT)
+        # Grbl doesn't support subroutines
+        self.subroutine_mode = SUBROUTINES_NONE if GeometrySettings.grbl_output else GeometrySettings.gcode_subroutines
+        # Subroutine numbers by their content
+        self.subroutines = {}
+        # M98 subprograms, output after the end of the main program
+        self.subprograms = []
+        # Active canned drilling cycle as (command and parameters, safe Z)
+        self.cycle = None
+        # Added to X and Y of the absolute coordinates (not to arc centre offsets)
+        self.translation = (0, 0)
     def add(self, line):
         self.gcode.append(line)
+        if self.sink is not None and len(self.gcode) >= self.FLUSH_SIZE:
+            self.flush(self.LOOKBACK)
+    def flush(self, keep=0):
+        if self.sink is not None and len(self.gcode) > keep:
+            count = len(self.gcode) - keep
+            self.sink(self.gcode[:count])
+            del self.gcode[:count]
+            self.flushed += count
+    def line_count(self):
+        return self.flushed + len(self.gcode)
     def add_dedup(self, line):
-        if self.gcode and self.gcode[-1] == line:
+        if self.is_last_line(line):
             return
-        self.gcode.append(line)
+        self.add(line)
+    # State left by the commands output so far, see also GcodeFragment
+    def is_last_line(self, line):
+        return bool(self.gcode) and self.gcode[-1] == line
+    def is_last_line_feed(self):
+        return self.last_feed_index == self.line_count() - 1
+    def is_last_position(self, key):
+        return key == self.last_coords
+    # Appends the output of an operation generated separately, unless it
+    # would've been different if generated here. Returns True if it was added.
+    def add_fragment(self, fragment):
+        if fragment.entry_rpm != self.last_rpm or fragment.entry_coords != self.last_coords or self.cycle is not None:
+            return False
+        if (fragment.entry_feed and self.is_last_line_feed()) or any(self.is_last_line(line) for line in fragment.entry_lines):
+            return False
+        offset = self.line_count()
+        for line in fragment.gcode:
+            self.add(line)
+        if fragment.last_feed_index is not None:
+            self.last_feed_index = offset + fragment.last_feed_index
+        self.last_coords = fragment.last_coords
+        self.position = tuple(new if new != ABSENT else old for new, old in zip(fragment.position, self.position))
+        self.cycle = fragment.cycle
+        self.last_feed = fragment.last_feed
+        self.rpm = fragment.rpm
+        self.last_rpm = fragment.last_rpm
+        return True
     def comment(self, comment):
         comment = comment.replace("(", "<").replace(")",">")
         self.add(f"({comment})")
@@ -51,6 +176,7 @@ class Gcode(object):
             else:
                 self.add("M3")
     def spindle_stop(self):
+        self.end_cycle()
         if GeometrySettings.spindle_control:
             self.add("M5")
             self.last_rpm = None
@@ -62,6 +188,8 @@ class Gcode(object):
     def finish(self):
         self.spindle_stop()
         self.add("M2")
+        for line in self.subprograms:
+            self.add(line)
     def begin_section(self, rpm=None):
         self.last_feed = None
         self.rpm = rpm
@@ -69,32 +197,165 @@ class Gcode(object):
             self.spindle_start()
     def feed(self, feed):
         if feed != self.last_feed:
-            if self.last_feed_index == len(self.gcode) - 1:
+            if self.is_last_line_feed():
                 self.gcode[-1] = self.enc_feed(feed)
             else:
                 self.add(self.enc_feed(feed))
             self.last_feed = feed
-            self.last_feed_index = len(self.gcode) - 1
+            self.last_feed_index = self.line_count() - 1
     def add_dedup_g0g1(self, cmd, x=None, y=None, z=None):
-        coords = self.enc_coords(x, y, z)
-        if coords == self.last_coords:
+        self.end_cycle()
+        coords, key = self.enc_position(x, y, z)
+        if self.is_last_position(key):
             return
         self.add_dedup(cmd + coords)
-        self.last_coords = coords
+        self.set_position(key)
     def rapid(self, x=None, y=None, z=None):
         self.add_dedup_g0g1("G0", x, y, z)
     def linear(self, x=None, y=None, z=None):
         self.add_dedup_g0g1("G1", x, y, z)
     def arc_cw(self, x=None, y=None, z=None, i=None, j=None, k=None):
-        self.add("G2" + self.enc_coords_arc(x, y, z, i, j, k))
-        self.last_coords = self.enc_coords(x, y, z)
+        self.end_cycle()
+        coords, key = self.enc_position(x, y, z)
+        self.add("G2" + coords + self.enc_offsets(i, j, k))
+        self.set_position(key)
     def arc_ccw(self, x=None, y=None, z=None, i=None, j=None, k=None):
-        self.add("G3" + self.enc_coords_arc(x, y, z, i, j, k))
-        self.last_coords = self.enc_coords(x, y, z)
+        self.end_cycle()
+        coords, key = self.enc_position(x, y, z)
+        self.add("G3" + coords + self.enc_offsets(i, j, k))
+        self.set_position(key)
     def arc(self, direction, x=None, y=None, z=None, i=None, j=None, k=None):
         (self.arc_ccw if direction > 0 else self.arc_cw)(x, y, z, i, j, k)
+    # cmd is 0-3 for G0-G3
+    def move(self, cmd, x=None, y=None, z=None, i=None, j=None):
+        if cmd == 0:
+            self.rapid(x, y, z)
+        elif cmd == 1:
+            self.linear(x, y, z)
+        else:
+            self.arc(1 if cmd == 3 else -1, x, y, z, i, j)
+    def set_position(self, key):
+        self.last_coords = key
+        self.position = tuple(new if new != ABSENT else old for new, old in zip(key, self.position))
+    # Adds a run of moves, each of them a tuple of move() arguments, with None
+    # for the coordinates not specified. The output is the same as from calling
+    # move() for each of them, but the numbers are formatted all at once.
+    # In the subroutine modes, longer runs are output as a call of a subroutine
+    # with the same moves in relative coordinates, so that the same path cut
+    # again at another depth or in another place uses the same subroutine.
+    def add_moves(self, moves):
+        self.end_cycle()
+        use_subroutine = self.subroutine_mode != SUBROUTINES_NONE and len(moves) >= self.SUBROUTINE_MIN and ABSENT not in self.position
+        if len(moves) < self.BATCH_MIN and not use_subroutine:
+            for move in moves:
+                self.move(*move)
+            return
+        data = numpy.array(moves, dtype=numpy.float64)
+        cmds = data[:, 0].astype(numpy.intp)
+        values = data[:, 1:]
+        values[:, 0] += self.translation[0]
+        values[:, 1] += self.translation[1]
+        res = self.format_values(values)
+        if res is None:
+            for move in moves:
+                self.move(*move)
+            return
+        count = len(moves)
+        chars, keys = res
+        keys = keys.reshape(count, 5)
+        # Same position as the previous move (or the last one before the run)
+        positions = keys[:, :3]
+        skip = numpy.zeros(count, dtype=bool)
+        skip[1:] = (cmds[1:] <= 1) & numpy.all(positions[1:] == positions[:-1], axis=1)
+        skip[0] = cmds[0] <= 1 and self.is_last_position(tuple(int(key) for key in positions[0]))
+        # Position after each of the moves, starting with the current one
+        filled = numpy.concatenate([numpy.array([self.position], dtype=numpy.int64), positions])
+        index = numpy.where(filled != ABSENT, numpy.arange(count + 1)[:, None], 0)
+        filled = numpy.take_along_axis(filled, numpy.maximum.accumulate(index, axis=0), axis=0)
+        body = self.relative_moves(cmds, values, keys, filled, skip) if use_subroutine else None
+        if body is not None:
+            if body:
+                self.call_subroutine(body)
+        else:
+            lines = self.format_moves(cmds, chars, keys, skip)
+            if lines and cmds[~skip][0] <= 1 and self.is_last_line(lines[0]):
+                # Same as add_dedup
+                del lines[0]
+            for line in lines:
+                self.add(line)
+        self.last_coords = tuple(int(key) for key in positions[-1])
+        self.position = tuple(int(key) for key in filled[-1])
+    def digits(self):
+        return 4 if self.inch_mode else 3
+    def format_values(self, values):
+        return fixed_point_array((values / 25.4 if self.inch_mode else values).ravel(), self.digits())
+    # Text of the moves of add_moves relative to the previous position, or
+    # None if they can't be formatted. X, Y and Z are differences of the
+    # rounded positions, so the rounding errors don't accumulate.
+    def relative_moves(self, cmds, values, keys, filled, skip):
+        scaled = numpy.where(filled == -1, 0, filled // 2)
+        relative = numpy.where(keys[:, :3] != ABSENT, numpy.diff(scaled, axis=0) / 10 ** self.digits(), numpy.nan)
+        offsets = values[:, 3:] / 25.4 if self.inch_mode else values[:, 3:]
+        res = fixed_point_array(numpy.concatenate([relative, offsets], axis=1).ravel(), self.digits())
+        if res is None:
+            return None
+        return self.format_moves(cmds, res[0], keys, skip)
+    # Text of the moves not skipped, from the output of fixed_point_array
+    def format_moves(self, cmds, chars, keys, skip):
+        count = len(cmds)
+        chars = chars.reshape(count, 5, -1)
+        axes = numpy.where((keys != ABSENT)[:, :, None], self.MOVE_AXES[None, :, :], 0).astype(numpy.uint8)
+        lines = numpy.concatenate([self.MOVE_COMMANDS[cmds], numpy.concatenate([axes, chars], axis=2).reshape(count, -1), numpy.full((count, 1), ord('\n'), dtype=numpy.uint8)], axis=1)[~skip]
+        return lines[lines != 0].tobytes().decode("ascii").split("\n")[:-1]
+    # Calls the subroutine made of the given lines of relative moves, defining
+    # it first if there is no such subroutine yet. LinuxCNC subroutines are
+    # defined where they're first used, M98 subprograms after the program.
+    def call_subroutine(self, body):
+        key = "\n".join(body)
+        number = self.subroutines.get(key)
+        if number is None:
+            number = self.subroutines[key] = self.SUBROUTINE_FIRST + len(self.subroutines)
+            if self.subroutine_mode == SUBROUTINES_OWORD:
+                for line in [f"O{number} sub", "G91"] + body + ["G90", f"O{number} endsub"]:
+                    self.add(line)
+            else:
+                self.subprograms += [f"O{number}", "G91"] + body + ["G90", "M99"]
+        if self.subroutine_mode == SUBROUTINES_OWORD:
+            self.add(f"O{number} call")
+        else:
+            self.add(f"M98 P{number}")
     def dwell(self, delay):
         self.add(f"G4 P{delay:0.2f}")
+    # Drills a hole using a canned cycle: G81 (single pass), G82 (single pass
+    # with a dwell of p seconds), G83 (pecks of q, retracting to r) or G73
+    # (pecks of q, breaking the chips). The cycle starts at safe_z and goes
+    # back there after each hole (G98), so the moves between the holes clear
+    # the clamps and tabs. The holes drilled with the same parameters only
+    # need X and Y. The cycle is cancelled before the next move.
+    def drill_cycle(self, cmd, x, y, z, r, feed, safe_z, q=None, p=None):
+        params = self.enc_coord('Z', z) + self.enc_coord('R', r)
+        if q is not None:
+            params += self.enc_coord('Q', q)
+        if p is not None:
+            params += f" P{p:0.2f}"
+        cycle = (cmd + params + " " + self.enc_feed(feed), safe_z)
+        if self.cycle != cycle:
+            self.end_cycle()
+        coords, key = self.enc_position(x, y)
+        if self.cycle is None:
+            self.rapid(z=safe_z)
+            self.add(f"G98 {cmd}{coords}{params} {self.enc_feed(feed)}")
+            self.cycle = cycle
+        else:
+            self.add(coords.lstrip())
+        self.last_feed = feed
+        self.set_position((key[0], key[1], self.enc_number(safe_z)[1]))
+    def end_cycle(self):
+        if self.cycle is not None:
+            safe_z = self.cycle[1]
+            self.cycle = None
+            self.add("G80")
+            self.rapid(z=safe_z)
     def enc_feed(self, feed):
         if self.inch_mode:
             return f"F{feed / 25.4:0.3f}"
@@ -105,17 +366,29 @@ class Gcode(object):
             return (" %s%0.4f" % (letter, value / 25.4)).rstrip("0").rstrip(".")
         else:
             return (" %s%0.3f" % (letter, value)).rstrip("0").rstrip(".")
-    def enc_coords(self, x=None, y=None, z=None):
+    def enc_number(self, value):
+        if self.inch_mode:
+            return fixed_point(value / 25.4, 4)
+        else:
+            return fixed_point(value, 3)
+    # Returns the text and the keys of the position
+    def enc_position(self, x=None, y=None, z=None):
         res = ""
+        kx = ky = kz = ABSENT
         if x is not None:
-            res += self.enc_coord('X', x)
+            text, kx = self.enc_number(x + self.translation[0])
+            res += " X" + text
         if y is not None:
-            res += self.enc_coord('Y', y)
+            text, ky = self.enc_number(y + self.translation[1])
+            res += " Y" + text
         if z is not None:
-            res += self.enc_coord('Z', z)
-        return res
-    def enc_coords_arc(self, x=None, y=None, z=None, i=None, j=None, k=None):
-        res = self.enc_coords(x, y, z)
+            text, kz = self.enc_number(z)
+            res += " Z" + text
+        return res, (kx, ky, kz)
+    def enc_coords(self, x=None, y=None, z=None):
+        return self.enc_position(x, y, z)[0]
+    def enc_offsets(self, i=None, j=None, k=None):
+        res = ""
         if i is not None:
             res += self.enc_coord('I', i)
         if j is not None:
@@ -123,23 +396,30 @@ class Gcode(object):
         if k is not None:
             res += self.enc_coord('K', k)
         return res
+    def enc_coords_arc(self, x=None, y=None, z=None, i=None, j=None, k=None):
+        return self.enc_coords(x, y, z) + self.enc_offsets(i, j, k)
 
     def helix_turn(self, x, y, r, start_z, end_z, angle=0, climb=True):
+        self.add_moves(self.helix_turn_moves(x, y, r, start_z, end_z, angle, climb))
+
+    # Moves of helix_turn, as for add_moves
+    def helix_turn_moves(self, x, y, r, start_z, end_z, angle=0, climb=True):
         i = -r * cos(angle)
         j = -r * sin(angle)
         sx = x - i
         sy = y - j
-        self.linear(x = sx, y = sy)
+        res = [(1, sx, sy, None, None, None)]
         cur_z = start_z
         delta_z = end_z - start_z
-        arc_dir = direction=1 if climb else -1
+        arc_cmd = 3 if climb else 2
         if GeometrySettings.grbl_output:
             sx2 = x + i
             sy2 = y + j
-            self.arc(arc_dir, x = sx2, y = sy2, i = i, j = j, z = cur_z + delta_z / 2.0)
-            self.arc(arc_dir, x = sx, y = sy, i = -i, j = -j, z = cur_z + delta_z)
+            res.append((arc_cmd, sx2, sy2, cur_z + delta_z / 2.0, i, j))
+            res.append((arc_cmd, sx, sy, cur_z + delta_z, -i, -j))
         else:
-            self.arc(arc_dir, x = sx, i = i, j = j, z = cur_z + delta_z)
+            res.append((arc_cmd, sx, None, cur_z + delta_z, i, j))
+        return res
 
     def move_z(self, new_z, old_z, tool, semi_safe_z, already_cut_z=None):
         if new_z == old_z:
@@ -185,33 +465,36 @@ class Gcode(object):
         assert isinstance(lastpt, PathPoint)
         assert dist(lastpt, subpath.seg_start()) < 1 / GeometrySettings.RESOLUTION, f"lastpt={lastpt} != firstpt={subpath.seg_start()}"
         tdist = 0
+        # Arguments of move(), the numbers are formatted for all of them at once
+        moves = []
         for lastpt, pt in PathSegmentIterator(subpath):
             if pt.is_arc() and pt.length() > 1 / GeometrySettings.RESOLUTION and pt.c.r > 1 / GeometrySettings.RESOLUTION:
                 arc = pt
                 assert dist(lastpt, arc.p1) < 1 / GeometrySettings.RESOLUTION
                 cdist = PathPoint(arc.c.cx - arc.p1.x, arc.c.cy - arc.p1.y)
-                arc_dir = 1 if arc.sspan > 0 else -1
+                arc_cmd = 3 if arc.sspan > 0 else 2
                 if GeometrySettings.grbl_output and abs(arc.sspan) >= 3 * pi / 2:
                     # Grbl has some issues with full circles, so replace anything longer than a
                     # 270 degree arc with two half-circles
                     subarc = arc.cut(0, 0.5)[1]
                     subtdist = tdist + subarc.length()
                     dest_z = old_z + (new_z - old_z) * subtdist / tlength if new_z is not None else None
-                    self.arc(arc_dir, x=subarc.p2.x, y=subarc.p2.y, i=cdist.x, j=cdist.y, z=dest_z)
+                    moves.append((arc_cmd, subarc.p2.x, subarc.p2.y, dest_z, cdist.x, cdist.y))
                     cdist = PathPoint(subarc.c.cx - subarc.p2.x, subarc.c.cy - subarc.p2.y)
                 tdist += arc.length()
                 dest_z = old_z + (new_z - old_z) * tdist / tlength if new_z is not None else None
-                self.arc(arc_dir, x=arc.p2.x, y=arc.p2.y, i=cdist.x, j=cdist.y, z=dest_z)
+                moves.append((arc_cmd, arc.p2.x, arc.p2.y, dest_z, cdist.x, cdist.y))
             else:
                 pt = pt.seg_end() # in case this was an arc
                 if new_z is not None:
                     tdist += pt.length() if pt.is_arc() else dist(lastpt, pt) # Need to use arc length even if the arc was replaced with a line segment
-                    self.linear(x=pt.x, y=pt.y, z=old_z + (new_z - old_z) * tdist / tlength)
+                    moves.append((1, pt.x, pt.y, old_z + (new_z - old_z) * tdist / tlength, None, None))
                 else:
                     if not GeometrySettings.paranoid_mode and pt.speed_hint is toolpath.RapidMove:
-                        self.rapid(x=pt.x, y=pt.y)
+                        moves.append((0, pt.x, pt.y, None, None, None))
                     else:
-                        self.linear(x=pt.x, y=pt.y)
+                        moves.append((1, pt.x, pt.y, None, None, None))
+        self.add_moves(moves)
         lastpt = pt.seg_end()
         self.section_info("End subpath" if not subject else f"End {subject} subpath")
         return lastpt
@@ -335,6 +618,37 @@ class Gcode(object):
 # when CutPathWallProfile is used. CalculatedSubpaths is the intermediate
 # stage.
 
+# G-code of a single operation, generated without the output that comes before
+# it (possibly in a worker process). The spindle speed and the position at the
+# start are guesses made by the caller. Where the output depends on the
+# preceding lines, the fragment assumes they don't match and records that, so
+# that Gcode.add_fragment can check all of it.
+class GcodeFragment(Gcode):
+    def __init__(self, translation, last_rpm, last_coords):
+        Gcode.__init__(self)
+        self.translation = translation
+        self.entry_rpm = self.last_rpm = last_rpm
+        self.entry_coords = self.last_coords = last_coords
+        # Lines the previous line must not be equal to
+        self.entry_lines = []
+        # The previous line must not be a feed command
+        self.entry_feed = False
+    def is_last_line(self, line):
+        if not self.gcode:
+            self.entry_lines.append(line)
+            return False
+        return Gcode.is_last_line(self, line)
+    def is_last_line_feed(self):
+        if not self.gcode:
+            self.entry_feed = True
+            return False
+        return Gcode.is_last_line_feed(self)
+
+# Raised when toolpaths calculated earlier are reused with different Z parameters,
+# but the new layers need toolpaths that have not been calculated yet
+class ToolpathsNotAvailable(Exception):
+    pass
+
 class CutLayer2D(object):
     def __init__(self, prev_depth, depth, subpaths, force_join=False, helical_from_top=False):
         self.prev_depth = prev_depth
@@ -499,6 +813,24 @@ class BaseCutPath(object):
         self.tool = tool
         self.helical_entry_func = helical_entry_func
         self.over_tab_z = self.props.actual_tab_depth() + machine_params.over_tab_safety
+    # The callbacks are only used while calculating the layers, and usually
+    # can't be pickled
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['helical_entry_func'] = None
+        if 'build_layer_func' in state:
+            state['build_layer_func'] = None
+        return state
+    # Returns a copy with different depths/heights, reusing the toolpaths
+    # already calculated (XY stage) and only redoing the layering (Z stage)
+    def with_z_params(self, machine_params, props, tool):
+        res = copy.copy(self)
+        BaseCutPath.__init__(res, machine_params, props, tool, self.helical_entry_func)
+        res.reuse_toolpaths(self)
+        res.cut_layers = res.to_layers()
+        return res
+    def reuse_toolpaths(self, source):
+        pass
     def generate_preview(self, subpaths):
         for subpath in subpaths:
             if is_calculation_cancelled():
@@ -583,6 +915,9 @@ class CutPathWallProfile(BaseCutPath):
         self.calculated_layers = {}
         self.requested_layers = set()
         self.cut_layers = self.to_layers()
+    def reuse_toolpaths(self, source):
+        self.calculated_layers = { key : CalculatedSubpaths(csubpaths.subpaths, None) for key, csubpaths in source.calculated_layers.items() }
+        self.requested_layers = set()
     def cutlayers_for_layer(self, layer):
         return self.cutlayers_for_sublayer(layer)
     def cutlayers_for_sublayer(self, layer):
@@ -599,7 +934,7 @@ class CutPathWallProfile(BaseCutPath):
         layer_depth = layer.depth
         csubpaths = self.calculated_layers.get(key)
         if csubpaths is not None:
-            if layer_depth < csubpaths.max_depth:
+            if csubpaths.max_depth is None or layer_depth < csubpaths.max_depth:
                 csubpaths.max_depth = layer_depth
             subpaths = csubpaths.subpaths
         else:
@@ -607,6 +942,8 @@ class CutPathWallProfile(BaseCutPath):
             key2 = (margin, layer.is_sublayer, LayerInfo.TAB_ABOVE)
             csubpaths = self.calculated_layers.get(key2)
             if csubpaths is None:
+                if self.build_layer_func is None:
+                    raise ToolpathsNotAvailable()
                 path_output = self.build_layer_func(margin, layer.is_sublayer)
                 if path_output is None:
                     subpaths = []
@@ -614,9 +951,9 @@ class CutPathWallProfile(BaseCutPath):
                     assert isinstance(path_output, PathOutput)
                     subpaths = []
                     for path in path_output.paths:
-                        subpaths.append(path.optimize())
+                        subpaths.append(path.optimize(self.props.simplify_tolerance))
                         pbpaths = path_output.piggybacked_paths_dict.get(path, [])
-                        subpaths += [pbpath.optimize() for pbpath in pbpaths]
+                        subpaths += [pbpath.optimize(self.props.simplify_tolerance) for pbpath in pbpaths]
                     self.correct_helical_entry(subpaths)
                 self.generate_preview(subpaths)
                 csubpaths = CalculatedSubpaths(subpaths, layer.depth)
@@ -628,6 +965,8 @@ class CutPathWallProfile(BaseCutPath):
                 key3 = (margin, layer.is_sublayer, LayerInfo.TAB_FIRST)
                 csubpaths = self.calculated_layers.get(key3)
                 if csubpaths is None:
+                    if self.build_layer_func is None:
+                        raise ToolpathsNotAvailable()
                     subpaths = [subpath.tabify(self) for subpath in subpaths]
                     csubpaths = CalculatedSubpaths(subpaths, layer.depth)
                     self.calculated_layers[key3] = csubpaths
@@ -772,7 +1111,10 @@ class BaseCut2D(BaseCut):
         self.enter_or_leave_cut(gcode, cutpath, layer, subpath, newz)
         assert self.lastpt is not None
         assert isinstance(self.lastpt, PathPoint)
-        self.lastpt = gcode.apply_subpath(subpath.path, self.lastpt, subject="tab" if subpath.is_tab else None)
+        # Last chance to merge short segments, e.g. in paths created by tab splitting
+        tolerance = optimize_lines_tolerance(self.props.simplify_tolerance)
+        path = subpath.optimize_lines(tolerance).path if tolerance else subpath.path
+        self.lastpt = gcode.apply_subpath(path, self.lastpt, subject="tab" if subpath.is_tab else None)
         assert isinstance(self.lastpt, PathNode)
         self.end_subpath(subpath)
 
@@ -782,7 +1124,7 @@ class BaseCut2D(BaseCut):
                 self.enter_cut(gcode, cutpath, layer, subpath, newz)
             else:
                 # Leave a cut, always uses a rapid move
-                gcode.move_z(newz, self.curz, subpath.tool, self.machine_params.semi_safe_z)
+                gcode.move_z(newz, self.curz, cutpath.tool, self.machine_params.semi_safe_z)
                 self.curz = newz
 
     def enter_cut(self, gcode, cutpath, layer, subpath, newz):
@@ -801,7 +1143,7 @@ class BaseCut2D(BaseCut):
             plunge_entry = subpath.helical_entry
             self.lastpt = plunge_entry.start
             gcode.rapid(z=newz)
-            gcode.feed(subpath.tool.hfeed)
+            gcode.feed(cutpath.tool.hfeed)
         else:
             z_already_cut_here = cutpath.z_already_cut_here(layer, subpath)
             if z_already_cut_here >= self.props.start_depth - 0.001:
@@ -812,9 +1154,9 @@ class BaseCut2D(BaseCut):
                 z_above_cut = z_already_cut_here + self.machine_params.over_tab_safety
             if z_already_cut_here < self.curz:
                 z_already_cut_here = z_above_cut
-                gcode.move_z(z_already_cut_here, self.curz, subpath.tool, self.machine_params.semi_safe_z, z_above_cut)
+                gcode.move_z(z_already_cut_here, self.curz, cutpath.tool, self.machine_params.semi_safe_z, z_above_cut)
                 self.curz = z_already_cut_here
-            speed_ratio = subpath.tool.full_plunge_feed_ratio
+            speed_ratio = cutpath.tool.full_plunge_feed_ratio
             if subpath.was_previously_cut:
                 # no plunge penalty
                 speed_ratio = 1
@@ -822,20 +1164,20 @@ class BaseCut2D(BaseCut):
             # horizontal component of the feed rate. In this case, we're making
             # a 3D move, so some of the programmed feed rate goes into the vertical
             # component instead.
-            speed_ratio *= subpath.tool.diagonal_factor()
-            gcode.feed(subpath.tool.hfeed * speed_ratio)
+            speed_ratio *= cutpath.tool.diagonal_factor()
+            gcode.feed(cutpath.tool.hfeed * speed_ratio)
             if isinstance(subpath.helical_entry, toolpath.HelicalEntry):
                 # Descend helically to the indicated helical entry point
                 # If first layer with tabs, do all helical ramps for post-tab
                 # reentry from the very top, because they haven't been cut yet
                 curz = self.curz
-                self.lastpt = gcode.helical_move_z(newz, curz, subpath.helical_entry, subpath.tool, self.machine_params.semi_safe_z, z_above_cut, 
+                self.lastpt = gcode.helical_move_z(newz, curz, subpath.helical_entry, cutpath.tool, self.machine_params.semi_safe_z, z_above_cut, 
                     from_top = subpath.helical_from_top and curz < self.props.start_depth, top_z=self.props.start_depth)
             else:
                 if newz < self.curz:
-                    self.lastpt = gcode.ramped_move_z(newz, self.curz, subpath.path, subpath.tool, self.machine_params.semi_safe_z, z_above_cut, None)
+                    self.lastpt = gcode.ramped_move_z(newz, self.curz, subpath.path, cutpath.tool, self.machine_params.semi_safe_z, z_above_cut, None)
                 assert self.lastpt is not None
-            gcode.feed(subpath.tool.hfeed)
+            gcode.feed(cutpath.tool.hfeed)
         if self.lastpt != subpath.path.seg_start():
             # The helical entry ends somewhere else in the pocket, so feed to the right spot
             self.lastpt = subpath.path.seg_start()
@@ -1,13 +1,16 @@
+import copy
+import numpy
+import os
 import threading
 from DerpCAM.common.geom import *
 from DerpCAM import cam
 import DerpCAM.cam.contour
-import DerpCAM.cam.peel
-import DerpCAM.cam.pocket
+# The pocketing modules (and shapely and hsm_nibble they use) are only
+# imported when a pocket or a peel is calculated
 from DerpCAM.cam.wall_profile import PlainWallProfile
-from DerpCAM.cam.gcodegen import Gcode, PathOutput, BaseCut2D, CutPath2D, CutPathWallProfile
+from DerpCAM.cam.gcodegen import Gcode, GcodeFragment, PathOutput, BaseCut2D, CutPath2D, CutPathWallProfile, ToolpathsNotAvailable, SUBROUTINES_NONE
 
-from DerpCAM.cam import shapes, toolpath
+from DerpCAM.cam import cut_order, shapes, toolpath
 
 class MachineParams(object):
     def __init__(self, safe_z, semi_safe_z, min_rpm=None, max_rpm=None):
@@ -18,7 +21,7 @@ class MachineParams(object):
         self.over_tab_safety = 0.2
 
 class OperationProps(object):
-    def __init__(self, depth, start_depth=0, tab_depth=None, margin=0, zigzag=False, angle=0, roughing_offset=0, allow_helical_entry=True, wall_profile=None, sublayer_thickness=0.1, offset_tolerance=0.2):
+    def __init__(self, depth, start_depth=0, tab_depth=None, margin=0, zigzag=False, angle=0, roughing_offset=0, allow_helical_entry=True, wall_profile=None, sublayer_thickness=0.1, offset_tolerance=0.2, simplify_tolerance=None):
         self.depth = depth
         self.start_depth = start_depth
         self.tab_depth = tab_depth
@@ -31,8 +34,10 @@ class OperationProps(object):
         self.wall_profile = wall_profile or PlainWallProfile()
         self.sublayer_thickness = sublayer_thickness
         self.offset_tolerance = offset_tolerance
+        # Maximum deviation for merging short line segments, None = global setting, 0 = off
+        self.simplify_tolerance = simplify_tolerance
     def clone(self, **attrs):
-        res = OperationProps(self.depth, self.start_depth, self.tab_depth, self.margin, self.zigzag, self.angle, self.roughing_offset, self.allow_helical_entry, self.wall_profile, self.sublayer_thickness, self.offset_tolerance)
+        res = OperationProps(self.depth, self.start_depth, self.tab_depth, self.margin, self.zigzag, self.angle, self.roughing_offset, self.allow_helical_entry, self.wall_profile, self.sublayer_thickness, self.offset_tolerance, self.simplify_tolerance)
         for k, v in attrs.items():
             assert hasattr(res, k), "Unknown attribute %s" % k
             setattr(res, k, v)
@@ -66,6 +71,43 @@ class Operation(object):
         BaseCut2D(self.machine_params, self.props, self.tool, self.cutpaths).build(gcode)
     def to_preview(self):
         return sum([path.to_preview() for path in self.cutpaths], [])
+    # Parts of the operation that can be cut in any order, for shortening the
+    # rapid moves (see cut_order). Each is (cutpath, start point, end point,
+    # bounds of the area cut), cutpath is None if the operation can only be
+    # moved as a whole. None if the operation can't be moved at all.
+    def order_parts(self):
+        if not self.cutpaths:
+            return None
+        r = self.tool.diameter / 2
+        res = []
+        for cutpath in self.cutpaths:
+            layers = cutpath.cut_layers
+            if not layers:
+                return None
+            first = layers[0].subpaths[0]
+            start = first.helical_entry.start if first.helical_entry else first.path.seg_start()
+            end = layers[-1].subpaths[-1].path.seg_end()
+            bounds = max_bounds(*[layer.bounds for layer in layers])
+            res.append((cutpath, start, end, (bounds[0] - r, bounds[1] - r, bounds[2] + r, bounds[3] + r)))
+        return res
+    # Offsets of the copies of the toolpaths, for operations that cut the same
+    # toolpaths in many places (see HolePattern), None for the others
+    def instance_offsets(self):
+        return None
+    # Same toolpaths with different feeds, speeds and depths
+    def with_z_params(self, tool, machine_params, props):
+        res = copy.copy(self)
+        # The toolpaths are shared with the original operation, so they keep
+        # the old tool, and the feeds are taken from the cut path's tool instead
+        if res.tool is not None:
+            res.tool = copy.copy(self.tool)
+            for attr in ('hfeed', 'vfeed', 'maxdoc', 'rpm'):
+                setattr(res.tool, attr, getattr(tool, attr))
+        res.machine_params = machine_params
+        res.props = props
+        res.rpm = props.rpm
+        res.cutpaths = [cutpath.with_z_params(machine_params, props, res.tool) for cutpath in self.cutpaths]
+        return res
     def helical_entry(self, tp, paths_for_helical_entry):
         if not self.props.allow_helical_entry:
             return
@@ -104,7 +146,7 @@ class UntabbedOperation(Operation):
         if not path_output:
             return []
         assert isinstance(path_output, PathOutput)
-        return [CutPath2D(self.machine_params, props, self.tool, None, path.optimize()) for path in path_output.paths]
+        return [CutPath2D(self.machine_params, props, self.tool, None, path.optimize(props.simplify_tolerance)) for path in path_output.paths]
 
 class Engrave(UntabbedOperation):
     def build_paths(self, margin):
@@ -114,15 +156,17 @@ class Engrave(UntabbedOperation):
 
 class FaceMill(UntabbedOperation):
     def build_paths(self, margin):
-        return PathOutput(cam.pocket.axis_parallel(self.shape, self.tool, self.props.angle, self.props.margin + margin, self.props.zigzag, roughing_offset=self.props.roughing_offset).flattened(), None, {})
+        from DerpCAM.cam import pocket
+        return PathOutput(pocket.axis_parallel(self.shape, self.tool, self.props.angle, self.props.margin + margin, self.props.zigzag, roughing_offset=self.props.roughing_offset).flattened(), None, {})
 
 class Pocket(UntabbedOperation):
     def build_cutpaths(self):
         return [CutPathWallProfile(self.machine_params, self.props, self.tool, None, self.subpaths_for_margin, True)]
     def build_paths(self, margin):
+        from DerpCAM.cam import pocket
         if not self.shape.closed:
             raise ValueError("Pocket cuts are not supported for open shapes")
-        return PathOutput(cam.pocket.contour_parallel(self.shape, self.tool, displace=self.props.margin + margin, roughing_offset=self.props.roughing_offset).flattened(), None, {})
+        return PathOutput(pocket.contour_parallel(self.shape, self.tool, displace=self.props.margin + margin, roughing_offset=self.props.roughing_offset).flattened(), None, {})
     def subpaths_for_margin(self, margin, is_sublayer):
         if is_sublayer:
             # Edges only (this is used for refining the wall profile after a roughing pass)
@@ -141,19 +185,22 @@ class HSMOperation(UntabbedOperation):
 
 class HSMPocket(HSMOperation):
     def build_paths(self, margin):
+        from DerpCAM.cam import pocket
         if not self.shape.closed:
             raise ValueError("Pocket cuts are not supported for open shapes")
-        return PathOutput(cam.pocket.hsm_peel(self.shape, self.tool, self.props.zigzag, displace=self.props.margin + margin, shape_to_refine=self.shape_to_refine, roughing_offset=self.props.roughing_offset).flattened(), None, {})
+        return PathOutput(pocket.hsm_peel(self.shape, self.tool, self.props.zigzag, displace=self.props.margin + margin, shape_to_refine=self.shape_to_refine, roughing_offset=self.props.roughing_offset).flattened(), None, {})
 
 class OutsidePeel(UntabbedOperation):
     def build_paths(self, margin):
-        return PathOutput(cam.peel.outside_peel(self.shape, self.tool, displace=self.props.margin + margin).flattened(), None, {})
+        from DerpCAM.cam import peel
+        return PathOutput(peel.outside_peel(self.shape, self.tool, displace=self.props.margin + margin).flattened(), None, {})
 
 class OutsidePeelHSM(HSMOperation):
     def build_paths(self, margin):
+        from DerpCAM.cam import peel
         if not self.shape.closed:
             raise ValueError("Outside peel cuts are not supported for open shapes")
-        return PathOutput(cam.peel.outside_peel_hsm(self.shape, self.tool, zigzag=self.props.zigzag, displace=self.props.margin + margin, shape_to_refine=self.shape_to_refine, roughing_offset=self.props.roughing_offset).flattened(), None, {})
+        return PathOutput(peel.outside_peel_hsm(self.shape, self.tool, zigzag=self.props.zigzag, displace=self.props.margin + margin, shape_to_refine=self.shape_to_refine, roughing_offset=self.props.roughing_offset).flattened(), None, {})
 
 class TabbedOperation(Operation):
     def __init__(self, shape, tool, machine_params, props, outside, tabs, extra_attribs):
@@ -381,7 +428,28 @@ class PeckDrill(UntabbedOperation):
         self.slow_retract = slow_retract
     def build_paths(self, margin):
         return PathOutput([toolpath.Toolpath(Path([PathPoint(self.x, self.y)], True), self.tool)], None, {})
+    def order_parts(self):
+        return [(None, PathPoint(self.x, self.y), PathPoint(self.x, self.y), self.shape.bounds)]
+    # Returns the canned cycle (command and peck depth) that drills the hole
+    # like to_gcode does, or None if there isn't one or it can't be used
+    def canned_cycle(self):
+        if not GeometrySettings.canned_cycles or GeometrySettings.grbl_output or self.dwell_retract or self.slow_retract:
+            return None
+        if self.props.start_depth - self.props.depth <= self.tool.maxdoc:
+            return ("G82" if self.dwell_bottom else "G81", None)
+        if self.dwell_bottom:
+            return None
+        if isinstance(self.retract, RetractToSemiSafe):
+            return ("G83", self.tool.maxdoc)
+        if isinstance(self.retract, RetractBy):
+            return ("G73", self.tool.maxdoc)
+        return None
     def to_gcode(self, gcode):
+        cycle = self.canned_cycle()
+        if cycle is not None:
+            cmd, peck = cycle
+            gcode.drill_cycle(cmd, self.x, self.y, self.props.depth, self.machine_params.semi_safe_z, self.tool.vfeed, self.machine_params.safe_z, peck, self.dwell_bottom or None)
+            return
         gcode.rapid(x=self.x, y=self.y)
         gcode.rapid(z=self.machine_params.semi_safe_z)
         gcode.feed(self.tool.vfeed)
@@ -419,6 +487,8 @@ class HelicalDrill(UntabbedOperation):
         for cd in self.diameters():
             coords += shapes.Shape.circle(self.x, self.y, r=0.5*(cd - self.tool.diameter)).boundary
         return PathOutput([toolpath.Toolpath(Path(coords, False), self.tool)], None, {})
+    def order_parts(self):
+        return [(None, PathPoint(self.x, self.y), PathPoint(self.x, self.y), self.shape.bounds)]
     def diameters(self):
         if self.d < self.min_dia:
             return [self.d]
@@ -465,11 +535,13 @@ class HelicalDrill(UntabbedOperation):
         gcode.feed(self.tool.hfeed * rate_factor)
         dist = 2 * pi * r
         doc = min(self.tool.maxdoc, dist / self.tool.slope())
+        moves = []
         while curz > self.props.depth:
             nextz = max(curz - doc, self.props.depth)
-            gcode.helix_turn(self.x, self.y, r, curz, nextz)
+            moves += gcode.helix_turn_moves(self.x, self.y, r, curz, nextz)
             curz = nextz
-        gcode.helix_turn(self.x, self.y, r, curz, curz)
+        moves += gcode.helix_turn_moves(self.x, self.y, r, curz, curz)
+        gcode.add_moves(moves)
         gcode.section_info("End ring")
 
 # First make a helical entry and then enlarge to the target diameter
@@ -495,6 +567,41 @@ class HelicalDrillFullDepth(HelicalDrill):
             gcode.helix_turn(self.x, self.y, r, self.props.depth, self.props.depth, False)
         gcode.rapid(z=self.machine_params.safe_z)
 
+# The same hole (a PeckDrill or a HelicalDrill) made at many places. The
+# toolpaths are only calculated for the first one and shown offset for the
+# others, the G-code of the holes only depends on their centre. centres is an
+# array of (x, y) of all the holes, in the cutting order, starting with the
+# one the hole operation was created for.
+class HolePattern(Operation):
+    def __init__(self, hole, centres):
+        Operation.__init__(self, hole.shape, hole.tool, hole.machine_params, hole.props)
+        self.hole = hole
+        self.centres = centres
+        self.cutpaths = hole.cutpaths
+    def to_text(self):
+        return f"{self.hole.to_text()}, {len(self.centres)} holes"
+    def operation_name(self):
+        return self.hole.operation_name() + " pattern"
+    def instance_offsets(self):
+        return self.centres - self.centres[0]
+    def order_parts(self):
+        offsets = self.instance_offsets()
+        dsx, dsy = offsets.min(axis=0).tolist()
+        dex, dey = offsets.max(axis=0).tolist()
+        sx, sy, ex, ey = self.shape.bounds
+        return [(None, PathPoint(*self.centres[0].tolist()), PathPoint(*self.centres[-1].tolist()), (sx + dsx, sy + dsy, ex + dex, ey + dey))]
+    def with_z_params(self, tool, machine_params, props):
+        res = Operation.with_z_params(self, tool, machine_params, props)
+        res.hole = self.hole.with_z_params(tool, machine_params, props)
+        res.cutpaths = res.hole.cutpaths
+        return res
+    def to_gcode(self, gcode):
+        hole = copy.copy(self.hole)
+        for x, y in self.centres.tolist():
+            hole.x = x
+            hole.y = y
+            hole.to_gcode(gcode)
+
 def makeWithDraft(func, shape, draft_angle_deg, layer_thickness, props):
     draft = tan(draft_angle_deg * pi / 180)
     height = props.start_depth - props.depth
@@ -516,10 +623,21 @@ class Operations(object):
         self.props = props
         self.thickness = thickness
         self.operations = []
+        # Operations are calculated in drawing coordinates, this is the offset
+        # from the drawing to the work coordinates, applied when generating G-code
+        self.translation = (0, 0)
     def add(self, operation):
         self.operations.append(operation)
     def add_all(self, operations):
         self.operations += operations
+    # Reuses the toolpaths of the existing operations. The parameters must only
+    # differ in things that don't affect the toolpath shape (feeds, speeds,
+    # depths, tab height, safe Z). May raise ToolpathsNotAvailable.
+    def with_z_params(self, machine_params, tool, props, thickness):
+        res = Operations(machine_params, tool, props, thickness)
+        res.translation = self.translation
+        res.add_all([operation.with_z_params(tool, machine_params, props) for operation in self.operations])
+        return res
     def is_nothing(self):
         for i in self.operations:
             if i.cutpaths:
@@ -562,22 +680,139 @@ class Operations(object):
         self.add(HelicalDrill(x, y, d, self.tool, self.machine_params, props or self.props))
     def helical_drill_full_depth(self, x, y, d, props=None):
         self.add(HelicalDrillFullDepth(x, y, d, self.tool, self.machine_params, props or self.props))
-    def to_gcode(self):
-        gcode = Gcode()
+    # Same as peck_drill/helical_drill for a list of (x, y) of the hole centres
+    def peck_drill_pattern(self, centres, props=None):
+        centres = hole_pattern_centres(centres)
+        x, y = centres[0].tolist()
+        self.add(HolePattern(PeckDrill(x, y, self.tool, self.machine_params, props or self.props), centres))
+    def helical_drill_pattern(self, centres, d, props=None):
+        centres = hole_pattern_centres(centres)
+        x, y = centres[0].tolist()
+        self.add(HolePattern(HelicalDrill(x, y, d, self.tool, self.machine_params, props or self.props), centres))
+    # Generates the program into gcode, yielding after each operation
+    def generate_gcode(self, gcode):
         gcode.reset()
         gcode.rapid(z=self.machine_params.safe_z)
         gcode.rapid(x=0, y=0)
-        for operation in self.operations:
-            gcode.section_info(f"Start operation: {type(operation).__name__}")
-            gcode.begin_section(operation.rpm)
-            operation.to_gcode(gcode)
-            gcode.section_info(f"End operation: {type(operation).__name__}")
+        operations = self.operations
+        if GeometrySettings.reorder_cuts:
+            # The program starts and ends at the work origin
+            operations, before, after = cut_order.optimize_order(operations, PathPoint(-self.translation[0], -self.translation[1]))
+            gcode.comment(f"Rapid moves between the cuts: {before:0.1f} mm, {after:0.1f} mm after reordering")
+        gcode.translation = self.translation
+        fragments = self.generate_fragments(gcode, operations)
+        try:
+            for operation in operations:
+                # Generate it here if the workers failed or guessed the state wrong
+                fragment = next(fragments, None)
+                if fragment is None or not gcode.add_fragment(fragment):
+                    operation_to_gcode(operation, gcode)
+                gcode.flush(Gcode.LOOKBACK)
+                yield
+        finally:
+            fragments.close()
+        gcode.translation = (0, 0)
         gcode.rapid(x=0, y=0)
         gcode.finish()
+        gcode.flush()
+    # Yields the G-code of each operation as a GcodeFragment generated in the
+    # worker processes, a few operations ahead of the caller, or None if that
+    # failed. Yields nothing if there are no worker processes or generating
+    # the G-code in them is not enabled.
+    def generate_fragments(self, gcode, operations):
+        pool = get_worker_pool() if GeometrySettings.parallel_gcode else None
+        # The subroutines are numbered in the order they're defined, so it all
+        # has to be generated in one place
+        if pool is None or len(operations) < 2 or gcode.subroutine_mode != SUBROUTINES_NONE:
+            return
+        last_rpm = gcode.last_rpm
+        last_coords = gcode.last_coords
+        index = 0
+        pending = []
+        try:
+            while True:
+                while index < len(operations) and len(pending) < 2 * GeometrySettings.worker_processes:
+                    operation = operations[index]
+                    index += 1
+                    pending.append(submit_calculation(pool, operation_gcode_fragment, operation, self.translation, last_rpm, last_coords))
+                    # State expected after this operation, the cutting
+                    # operations end with a retract to safe Z
+                    if isinstance(operation, ToolChangeOperation):
+                        if GeometrySettings.spindle_control:
+                            last_rpm = None
+                    else:
+                        if GeometrySettings.spindle_control and operation.rpm is not None:
+                            last_rpm = operation.rpm
+                        last_coords = gcode.enc_position(z=operation.machine_params.safe_z)[1]
+                if not pending:
+                    return
+                try:
+                    fragment = pending.pop(0).result()
+                except Exception:
+                    # Any errors will be reported when it's generated again
+                    fragment = None
+                yield fragment
+        finally:
+            for job in pending:
+                job.cancel()
+    # If sink is specified, the lines are passed to it as they are generated
+    # instead of being kept in the returned object
+    def to_gcode(self, sink=None):
+        gcode = Gcode(sink)
+        for i in self.generate_gcode(gcode):
+            pass
         return gcode
+    # Yields the lines of the program, only keeping the output of the current
+    # operation in memory
+    def to_gcode_iter(self):
+        lines = []
+        for i in self.generate_gcode(Gcode(lines.extend)):
+            yield from lines
+            lines.clear()
+        yield from lines
+    # Writes the program to a text stream (a file, pipe or socket) as it is
+    # generated
+    def write_gcode(self, stream):
+        self.to_gcode(lambda lines: stream.write("".join(line + '\n' for line in lines)))
     def to_gcode_file(self, filename):
-        glines = self.to_gcode().gcode
-        f = open(filename, "w")
-        for line in glines:
-          f.write(line + '\n')
-        f.close()
+        if os.path.exists(filename) and not os.path.isfile(filename):
+            # Named pipe or a device
+            with open(filename, "w") as f:
+                self.write_gcode(f)
+            return
+        # Do not leave a partially written file if generating the code fails
+        tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_filename, "w") as f:
+                self.write_gcode(f)
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
+            raise
+
+# Packed array of the hole centres, in the order of cutting
+def hole_pattern_centres(centres):
+    centres = numpy.asarray(centres, dtype=numpy.float64).reshape(-1, 2)
+    if not len(centres):
+        raise ValueError("No holes in the pattern")
+    return centres[cut_order.serpentine_order(centres)]
+
+def operation_to_gcode(operation, gcode):
+    gcode.section_info(f"Start operation: {type(operation).__name__}")
+    gcode.begin_section(operation.rpm)
+    operation.to_gcode(gcode)
+    gcode.section_info(f"End operation: {type(operation).__name__}")
+
+# Generates the G-code of one operation in a worker process
+def operation_gcode_fragment(operation, translation, last_rpm, last_coords):
+    gcode = GcodeFragment(translation, last_rpm, last_coords)
+    operation_to_gcode(operation, gcode)
+    return gcode
+
+# Runs one of the methods of Operations in a worker process. Returns the list
+# of operations created, to be added to the Operations object in the parent.
+def calculate_operations(machine_params, tool, props, thickness, method, args, kwargs):
+    ops = Operations(machine_params, tool, props, thickness)
+    getattr(ops, method)(*args, **kwargs)
+    return ops.operations
@@ -11,14 +11,12 @@ def outside_peel(shape, tool, displace=0):
     expected_size = min(shape.bounds[2] - shape.bounds[0], shape.bounds[3] - shape.bounds[1]) / 2.0
     displace_now = displace - tool.diameter
     stepover = tool.stepover * tool.diameter
-    while True:
+    for displace_now, res in pocket.calc_contour_rings(shape, tool, displace_now, stepover, subtract=islands_transformed):
         if geom.is_calculation_cancelled():
             return None
         geom.set_calculation_progress(abs(displace_now), expected_size)
-        res = pocket.calc_contour(shape, tool, outside=False, displace=displace_now, subtract=islands_transformed)
         if not res:
             break
-        displace_now += stepover
         tps += res.toolpaths
     if len(tps) == 0:
         raise ValueError("Empty contour")
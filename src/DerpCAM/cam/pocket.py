@@ -1,14 +1,52 @@
-import hsm_nibble.geometry
 from DerpCAM.common import geom, guiutils
 from . import shapes, toolpath, milling_tool
-import math, threading
+import contextlib, math, threading
+import numpy
 import pyclipper
+import shapely
 from shapely.geometry import Polygon, GeometryCollection, MultiPolygon, LinearRing, Point
 
 def calc_contour(shape, tool, outside=True, displace=0, subtract=None):
     dist = (0.5 * tool.diameter + displace) * geom.GeometrySettings.RESOLUTION
     boundary = geom.PtsToInts(shape.boundary)
     res = shapes.Shape._offset(boundary, shape.closed, dist if outside else -dist)
+    return contour_toolpaths(res, shape, tool, outside, subtract)
+
+# Inside contours at displace, displace + step, displace + 2 * step... Yields
+# (displacement, toolpaths) until the toolpaths are empty. Each inward ring
+# is an offset of the previous one, which is much cheaper than offsetting the
+# original shape by an ever larger distance.
+def calc_contour_rings(shape, tool, displace, step, subtract=None):
+    for displace, ring in contour_ring_offsets(shape, tool, displace, step):
+        res = contour_toolpaths(ring, shape, tool, False, subtract)
+        yield displace, res
+        if not res:
+            return
+
+# The offsets used by calc_contour_rings, ending with an empty one
+def contour_ring_offsets(shape, tool, displace, step):
+    boundary = geom.PtsToInts(shape.boundary)
+    ring = None
+    while True:
+        dist = (0.5 * tool.diameter + displace) * geom.GeometrySettings.RESOLUTION
+        # Only shrinking can be chained, growing and then shrinking would
+        # round off the inside corners. Use whole numbers of Clipper units,
+        # rounding of x.5 coordinates would shift the rings a bit every time.
+        if ring is not None and last_dist >= 0:
+            ring = shapes.Shape._offset_paths(ring, True, round(last_dist) - round(dist))
+        else:
+            ring = shapes.Shape._offset(boundary, shape.closed, -dist)
+        yield displace, ring
+        if not ring:
+            return
+        last_dist = dist
+        displace += step
+
+def contour_toolpaths(res, shape, tool, outside, subtract):
+    return contour_paths_to_toolpaths(contour_paths(res, subtract, outside, tool.climb), shape, tool)
+
+# Offset paths minus the islands, as correctly oriented Clipper paths
+def contour_paths(res, subtract, outside, climb):
     if not res:
         return None
 
@@ -21,11 +59,14 @@ def calc_contour(shape, tool, outside=True, displace=0, subtract=None):
                 res2 += [j for j in d if pyclipper.Orientation(j.int_points) == exp_orient]
         if not res2:
             return None
-        res2 = [geom.SameOrientation(i.int_points, outside ^ tool.climb) for i in res2]
-        tps = [toolpath.Toolpath(geom.Path(geom.PtsFromInts(path), shape.closed), tool) for path in res2]
+        return [geom.SameOrientation(i.int_points, outside ^ climb) for i in res2]
     else:
-        res = [geom.SameOrientation(i, outside ^ tool.climb) for i in res]
-        tps = [toolpath.Toolpath(geom.Path(geom.PtsFromInts(path), shape.closed), tool) for path in res]
+        return [geom.SameOrientation(i, outside ^ climb) for i in res]
+
+def contour_paths_to_toolpaths(paths, shape, tool):
+    if not paths:
+        return None
+    tps = [toolpath.Toolpath(geom.Path(geom.PtsFromInts(path), shape.closed), tool) for path in paths]
     return toolpath.Toolpaths(tps)
 
 def calculate_tool_margin(shape, tool, displace):
@@ -90,14 +131,12 @@ def contour_parallel(shape, tool, displace=0, roughing_offset=0):
     # already merging the island paths.
     #for island in tps_islands:
     #    toolpath.mergeToolpaths(tps, island, tool.diameter)
-    while True:
+    for displace_now, res in calc_contour_rings(shape, tool, displace_now, stepover, subtract=islands_transformed):
         if geom.is_calculation_cancelled():
             return None
         geom.set_calculation_progress(abs(displace_now), expected_size)
-        res = calc_contour(shape, tool, False, displace_now, subtract=islands_transformed)
         if not res:
             break
-        displace_now += stepover
         toolpath.mergeToolpaths(tps, res, tool.diameter)
     if len(tps) == 0:
         return toolpath.Toolpaths([])
@@ -110,30 +149,71 @@ def contour_parallel(shape, tool, displace=0, roughing_offset=0):
         finish_contour(tps, tool, boundary_transformed, islands_transformed, islands_transformed_nonoverlap)
     return toolpath.Toolpaths(tps)
 
+# Paths with an endpoint lookup. The endpoints are put into a grid of cells of
+# the size of the matching tolerance, so only the neighbouring cells need to
+# be checked.
+class EndpointIndex(object):
+    def __init__(self, allow_reverse):
+        self.allow_reverse = allow_reverse
+        self.eps = 2.0 / geom.GeometrySettings.RESOLUTION
+        self.paths = {}
+        self.cells = {}
+        self.count = 0
+    def __len__(self):
+        return len(self.paths)
+    def __iter__(self):
+        return iter(self.paths.values())
+    def __repr__(self):
+        return repr(list(self.paths.values()))
+    def cell(self, pt):
+        return (int(math.floor(pt.x / self.eps)), int(math.floor(pt.y / self.eps)))
+    def endpoints(self, path):
+        if self.allow_reverse:
+            return [(path.seg_start(), False), (path.seg_end(), True)]
+        return [(path.seg_start(), False)]
+    def append(self, path):
+        key = self.count
+        self.count += 1
+        self.paths[key] = path
+        for pt, reverse in self.endpoints(path):
+            self.cells.setdefault(self.cell(pt), []).append((key, reverse, pt))
+    def remove(self, key):
+        path = self.paths.pop(key)
+        for pt, reverse in self.endpoints(path):
+            cell = self.cells[self.cell(pt)]
+            cell.remove((key, reverse, pt))
+        return path
+    def pop_first(self):
+        return self.remove(next(iter(self.paths)))
+    # Earliest added path starting (or ending, if reversing is allowed) at pt
+    def pop_near(self, pt):
+        cx, cy = self.cell(pt)
+        best = None
+        for x in (cx - 1, cx, cx + 1):
+            for y in (cy - 1, cy, cy + 1):
+                for key, reverse, end in self.cells.get((x, y), []):
+                    if geom.dist(end, pt) <= self.eps and (best is None or (key, reverse) < best):
+                        best = (key, reverse)
+        if best is None:
+            return None
+        path = self.remove(best[0])
+        return path.reverse() if best[1] else path
+
 class AxisParallelRow(object):
     def __init__(self):
-        self.slices = []
+        self.slices = EndpointIndex(False)
         self.areas = []
-        self.connectors = []
+        self.connectors = EndpointIndex(True)
     def add_slice(self, slice):
         self.slices.append(slice)
     def add_area(self, area):
         self.areas.append(area)
     def add_connector(self, connector):
         self.connectors.append(connector)
-    def pop_coll(self, coll, pt, allow_reverse):
-        eps = 2.0 / geom.GeometrySettings.RESOLUTION
-        for i, c in enumerate(coll):
-            if geom.dist(c.seg_start(), pt) <= eps:
-                del coll[i]
-                return c
-            if allow_reverse and geom.dist(c.seg_end(), pt) <= eps:
-                del coll[i]
-                return c.reverse()
     def pop_slice(self, pt):
-        return self.pop_coll(self.slices, pt, False)
+        return self.slices.pop_near(pt)
     def pop_connector(self, pt):
-        return self.pop_coll(self.connectors, pt, True)
+        return self.connectors.pop_near(pt)
     def dump(self):
         if self.areas:
             print ("Begin")
@@ -163,6 +243,12 @@ def get_connectors(rows, tool):
             tps.append(toolpath.Toolpath(conn, tool))
     return tps
 
+def join_row_paths(path, tool):
+    nodes = []
+    for i in path:
+        nodes += i.nodes
+    return toolpath.Toolpath(geom.Path(nodes, False), tool)
+
 def process_rows(rows, tool):
     tps = []
     finished = False
@@ -175,37 +261,37 @@ def process_rows(rows, tool):
                 if slice:
                     path.append(slice)
                 else:
-                    tps.append(toolpath.Toolpath(geom.Path(sum([i.nodes for i in path], []), False), tool))
+                    tps.append(join_row_paths(path, tool))
                     path = []
             if not path:
                 if not row.slices:
                     continue
-                slice = row.slices.pop(0)
+                slice = row.slices.pop_first()
                 path.append(slice)
             conn = row.pop_connector(path[-1].seg_end())
             if conn:
                 path.append(conn)
             else:
-                tps.append(toolpath.Toolpath(geom.Path(sum([i.nodes for i in path], []), False), tool))
+                tps.append(join_row_paths(path, tool))
                 path = []
             finished = False
         if path:
-            tps.append(toolpath.Toolpath(geom.Path(sum([i.nodes for i in path], []), False), tool))
+            tps.append(join_row_paths(path, tool))
     return tps
 
 def axis_parallel(shape, tool, angle, margin, zigzag, roughing_offset=0):
     offset_dist = (0.5 * tool.diameter - margin) * geom.GeometrySettings.RESOLUTION
     boundary_transformed, islands_transformed, islands_transformed_nonoverlap, boundary_transformed_nonoverlap = calculate_tool_margin(shape, tool, margin + roughing_offset)
 
-    coords = sum([i.int_points for i in boundary_transformed], [])
-    xcoords = [p[0] / geom.GeometrySettings.RESOLUTION for p in coords]
-    ycoords = [p[1] / geom.GeometrySettings.RESOLUTION for p in coords]
-    sx, sy, ex, ey = min(xcoords), min(ycoords), max(xcoords), max(ycoords)
+    coords = numpy.concatenate([i.real_array() for i in boundary_transformed])
+    sx, sy = coords.min(axis=0).tolist()
+    ex, ey = coords.max(axis=0).tolist()
     stepover = tool.diameter * tool.stepover
     tps = []
     maxlen = geom.dist(geom.PathPoint(sx, sy), geom.PathPoint(ex, ey))
     #p = (ex + tool.diameter / 2 * cos(angle + pi / 2), sy + tool.diameter / 2 * sin(angle + pi / 2))
     p = (ex, sy + 1 / geom.GeometrySettings.RESOLUTION)
+    p0 = p
     fsteps = maxlen / stepover
     nsteps = int(math.ceil(fsteps))
     rows = []
@@ -216,26 +302,35 @@ def axis_parallel(shape, tool, angle, margin, zigzag, roughing_offset=0):
     # Clipper bug workaround! A difference of a horizontal line and a contour that is *above* the line will be null,
     # instead of the whole line.
     subtract_hack = [geom.IntPath([geom.PathPoint(sx, sy - 1), geom.PathPoint(sx + 1, sy - 1), geom.PathPoint(sx, sy - 2)], False)]
+    lines = []
+    strips = []
     for i in range(nsteps):
         p1 = geom.PathPoint(p[0] - mx, p[1] - my)
         p2 = geom.PathPoint(p[0] + mx, p[1] + my)
-        path = geom.IntPath([p2, p1]) if zigzag and (i & 1) else geom.IntPath([p1, p2])
-        tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [], boundary_transformed, [path])
-        if islands_transformed:
-            treepaths = pyclipper.OpenPathsFromPolyTree(tree)
-            tree2 = geom.run_clipper_advanced(pyclipper.CT_DIFFERENCE, subtract_hack, islands_transformed, [geom.IntPath(path2, True) for path2 in treepaths])
-        else:
-            tree2 = tree
-        row = AxisParallelRow()
-        for path3 in pyclipper.OpenPathsFromPolyTree(tree2):
-            row.add_slice(geom.Path(geom.PtsFromInts(path3), False))
-        frac = fsteps - nsteps if i == nsteps - 1 else 1
+        lines.append(geom.IntPath([p2, p1]) if zigzag and (i & 1) else geom.IntPath([p1, p2]))
+        frac = fsteps - (nsteps - 1) if i == nsteps - 1 else 1
         p = (p[0] + frac * dx, p[1] + frac * dy)
         p3 = geom.PathPoint(p[0] - mx, p[1] - my)
         p4 = geom.PathPoint(p[0] + mx, p[1] + my)
-        slice = geom.IntPath([p1, p2, p4, p3])
+        strips.append(geom.IntPath([p1, p2, p4, p3]))
+        rows.append(AxisParallelRow())
+    # Position of a Clipper path across the rows, in multiples of the stepover
+    def row_range(path):
+        xy = geom.IntsToArray(path) / geom.GeometrySettings.RESOLUTION
+        pos = ((xy[:, 0] - p0[0]) * dx + (xy[:, 1] - p0[1]) * dy) / (stepover * stepover)
+        return pos.min(), pos.max()
 
-        if False: # use for debugging
+    # All the scanlines are clipped at once and then sorted into rows
+    tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [], boundary_transformed, lines)
+    if islands_transformed:
+        treepaths = pyclipper.OpenPathsFromPolyTree(tree)
+        tree = geom.run_clipper_advanced(pyclipper.CT_DIFFERENCE, subtract_hack, islands_transformed, [geom.IntPath(path2, True) for path2 in treepaths])
+    for path3 in pyclipper.OpenPathsFromPolyTree(tree):
+        pmin, pmax = row_range(path3)
+        rows[min(max(int(round((pmin + pmax) / 2)), 0), nsteps - 1)].add_slice(geom.Path(geom.PtsFromInts(path3), False))
+
+    if False: # use for debugging
+        for row, slice in zip(rows, strips):
             tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [slice], boundary_transformed, [])
             treepaths = pyclipper.ClosedPathsFromPolyTree(tree)
             if islands_transformed:
@@ -244,13 +339,19 @@ def axis_parallel(shape, tool, angle, margin, zigzag, roughing_offset=0):
                 tree2 = tree
             for path3 in pyclipper.ClosedPathsFromPolyTree(tree2):
                 row.add_area(geom.Path(geom.PtsFromInts(path3), True))
-        #tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [], [slice], [geom.IntPath(path.int_points + path.int_points[0:1], True) for path in boundary_transformed + islands_transformed_nonoverlap])
-        if zigzag:
-            tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [], [slice], [geom.IntPath(path.int_points + path.int_points[0:1], True) for path in boundary_transformed_nonoverlap] +
-                [geom.IntPath(pyclipper.ReversePath(path.int_points + path.int_points[0:1]), True) for path in islands_transformed_nonoverlap])
+    if zigzag:
+        outlines = [geom.IntPath(path.int_points + path.int_points[0:1], True) for path in boundary_transformed_nonoverlap] + \
+            [geom.IntPath(pyclipper.ReversePath(path.int_points + path.int_points[0:1]), True) for path in islands_transformed_nonoverlap]
+        # Adjacent strips would be merged into one polygon, so the odd and the
+        # even ones are done separately
+        for parity in (0, 1):
+            strips_now = [strip for strip in strips[parity::2] if pyclipper.Area(strip.int_points)]
+            if not strips_now:
+                continue
+            tree = geom.run_clipper_advanced(pyclipper.CT_INTERSECTION, [], strips_now, outlines)
             for path3 in pyclipper.OpenPathsFromPolyTree(tree):
-                row.add_connector(geom.Path(geom.PtsFromInts(path3), False))
-        rows.append(row)
+                pmin, pmax = row_range(path3)
+                rows[min(max(int(math.floor((pmin + pmax) / 2)), 0), nsteps - 1)].add_connector(geom.Path(geom.PtsFromInts(path3), False))
     #return toolpath.Toolpaths(get_slices(rows, tool))
     #return toolpath.Toolpaths(get_areas(rows, tool))
     #return toolpath.Toolpaths(get_connectors(rows, tool))
@@ -264,6 +365,7 @@ def axis_parallel(shape, tool, angle, margin, zigzag, roughing_offset=0):
     finish_contour(tps, tool, boundary_transformed, islands_transformed, islands_transformed_nonoverlap)
     return toolpath.Toolpaths(tps)
 
+# pyvoronoi (used by hsm_nibble) is not thread-safe
 pyvlock = threading.RLock()
 
 def sort_polygons(polygons):
@@ -304,18 +406,14 @@ def shape_to_polygons(shape, tool, displace=0, from_outside=False):
         subpockets = shapes.Shape._offset(geom.PtsToInts(shape.boundary), True, -tdist)
     all_inputs = []
     for subpocket in subpockets:
-        boundary_offset = geom.PtsFromInts(subpocket)
-        boundary = LinearRing([(p.x, p.y) for p in boundary_offset])
+        boundary = LinearRing(geom.PtsFromIntArray(subpocket))
         polygon = Polygon(boundary)
-        islands_offset = []
         holes = []
         for island in shape.islands:
             island_offsets = shapes.Shape._offset(geom.PtsToInts(island), True, tdist)
             island_offsets = pyclipper.SimplifyPolygons(island_offsets)
             for island_offset in island_offsets:
-                island_offset_pts = geom.PtsFromInts(island_offset)
-                islands_offset.append(island_offset_pts)
-                ii = LinearRing([(p.x, p.y) for p in island_offset_pts])
+                ii = LinearRing(geom.PtsFromIntArray(island_offset))
                 if not from_outside:
                     polygon = polygon.difference(Polygon(ii))
                 else:
@@ -326,9 +424,12 @@ def shape_to_polygons(shape, tool, displace=0, from_outside=False):
             all_inputs += objects_to_polygons(polygon)
     return all_inputs
 
+def linestring2points(ls, speed_hint=None):
+    return geom.ArrayToPts(shapely.get_coordinates(ls), speed_hint)
+
 # only works for closed linestrings
 def linestring2path(ls, orientation):
-    path = geom.Path([geom.PathPoint(x, y) for x, y in ls.coords], True)
+    path = geom.Path(linestring2points(ls), True)
     if orientation is not None and path.orientation() != orientation:
         return path.reverse()
     return path
@@ -412,7 +513,59 @@ def add_finishing_outlines(tps, polygon, tool, from_outside):
     for h in polygon.interiors:
         tps.append(toolpath.Toolpath(linestring2path(h, not tool.climb), tool, was_previously_cut=True, is_cleanup=True))
 
+# Picklable form of the results of hsm_nibble, so that the pockets can be
+# calculated in the worker processes. The arcs keep the attribute names used
+# by add_arcdata.
+class HSMArc(object):
+    def __init__(self, item):
+        self.origin = geom.PathPoint(item.origin.x, item.origin.y)
+        self.radius = item.radius
+        self.start = geom.PathPoint(item.start.x, item.start.y)
+        self.end = geom.PathPoint(item.end.x, item.end.y)
+        self.start_angle = item.start_angle
+        self.span_angle = item.span_angle
+
+class HSMLine(object):
+    def __init__(self, item):
+        self.move_style = item.move_style
+        self.coords = shapely.get_coordinates(item.path)
+
+class HSMPocket(object):
+    def __init__(self, tp):
+        self.start_point = tp.start_point
+        self.starting_angle = tp.starting_angle
+        self.max_starting_radius = tp.max_starting_radius
+        self.path = []
+    def has_entry_circle(self, already_cut):
+        if self.starting_angle is None:
+            return False
+        return not (already_cut and already_cut.contains(self.start_point))
+    def entry_too_small(self, already_cut, starting_radius):
+        return self.has_entry_circle(already_cut) and self.max_starting_radius < starting_radius
+
+def hsm_pocket(polygon, step, arc_dir, already_cut, tactic, starting_radius, progress_offset=0, progress_total=1000):
+    import hsm_nibble.geometry
+    # The workers have their own copies of pyvoronoi, the lock is only needed
+    # when calculating in the threads
+    with pyvlock if geom.worker_job_id is None else contextlib.nullcontext():
+        tp = hsm_nibble.geometry.Pocket(polygon, step, arc_dir, generate=True, already_cut=already_cut, starting_point_tactic=tactic, starting_radius=starting_radius)
+    res = HSMPocket(tp)
+    if res.entry_too_small(already_cut, starting_radius):
+        return res
+    generator = tp.get_arcs(100)
+    try:
+        while not geom.is_calculation_cancelled():
+            progress = max(0, min(1000, 1000 * next(generator)))
+            geom.set_calculation_progress(progress_offset + progress, progress_total)
+    except StopIteration:
+        pass
+    if tp.path:
+        res.path = [HSMArc(item) if isinstance(item, hsm_nibble.geometry.ArcData) else HSMLine(item) for item in tp.path]
+    return res
+
 def hsm_peel(shape, tool, zigzag, displace=0, from_outside=False, shape_to_refine=None, roughing_offset=0):
+    # Only loaded when an HSM operation is calculated
+    import hsm_nibble.geometry
     already_cut = None
     if not from_outside and shape_to_refine is not None:
         already_cut = MultiPolygon()
@@ -433,12 +586,13 @@ def hsm_peel(shape, tool, zigzag, displace=0, from_outside=False, shape_to_refin
     else:
         arc_dir = hsm_nibble.geometry.ArcDir.CCW if tool.climb else hsm_nibble.geometry.ArcDir.CW
     num_polys = len(all_inputs)
-    outer_progress = 0
+    step = tool.diameter * tool.stepover
+    pockets = []
     for polygon in all_inputs:
+        islands = None
         if from_outside:
             polygon, islands = polygon
         tps = []
-        step = tool.diameter * tool.stepover
         tactic = hsm_nibble.geometry.StartPointTactic.WIDEST
         if from_outside:
             tactic = hsm_nibble.geometry.StartPointTactic.PERIMETER
@@ -466,20 +620,18 @@ def hsm_peel(shape, tool, zigzag, displace=0, from_outside=False, shape_to_refin
         else:
             already_cut_for_this = already_cut.intersection(polygon) if already_cut else None
         #polygon = polygon.difference(already_cut_for_this)
-        with pyvlock:
-            tp = hsm_nibble.geometry.Pocket(polygon, step, arc_dir, generate=True, already_cut=already_cut_for_this, starting_point_tactic=tactic, starting_radius=tool.min_helix_diameter/2)
-        has_entry_circle = tp.starting_angle is not None
-        if already_cut_for_this and already_cut_for_this.contains(tp.start_point):
-            has_entry_circle = False
-        if has_entry_circle and tp.max_starting_radius < tool.min_helix_diameter / 2:
+        pockets.append((polygon, islands, tps, tactic, already_cut, already_cut_for_this))
+    pool = geom.get_worker_pool()
+    if pool is not None:
+        jobs = [geom.submit_calculation(pool, hsm_pocket, polygon, step, arc_dir, already_cut_for_this, tactic, tool.min_helix_diameter / 2) for polygon, islands, tps, tactic, already_cut, already_cut_for_this in pockets]
+        if not geom.wait_for_jobs(jobs):
+            return toolpath.Toolpaths([])
+        results = (job.result() for job in jobs)
+    else:
+        results = (hsm_pocket(polygon, step, arc_dir, already_cut_for_this, tactic, tool.min_helix_diameter / 2, 1000 * i, 1000 * num_polys) for i, (polygon, islands, tps, tactic, already_cut, already_cut_for_this) in enumerate(pockets))
+    for (polygon, islands, tps, tactic, already_cut, already_cut_for_this), tp in zip(pockets, results):
+        if tp.entry_too_small(already_cut_for_this, tool.min_helix_diameter / 2):
             raise ValueError(f"Entry location smaller than safe minimum of {guiutils.Format.cutter_dia(tool.min_helix_diameter + tool.diameter)}")
-        generator = tp.get_arcs(100)
-        try:
-            while not geom.is_calculation_cancelled():
-                progress = max(0, min(1000, 1000 * next(generator)))
-                geom.set_calculation_progress(outer_progress + progress, 1000 * num_polys)
-        except StopIteration:
-            pass
         hsm_path = tp.path
         if not hsm_path:
             continue
@@ -488,15 +640,15 @@ def hsm_peel(shape, tool, zigzag, displace=0, from_outside=False, shape_to_refin
         was_previously_cut = from_outside
         for item in hsm_path:
             MoveStyle = hsm_nibble.geometry.MoveStyle
-            if isinstance(item, hsm_nibble.geometry.LineData):
+            if isinstance(item, HSMLine):
                 #if item.start.distance(item.end) < 1e-6:
                 #    continue
                 #print (item.move_style, item.start.distance(item.end), item.start)
                 if item.move_style == MoveStyle.RAPID_OUTSIDE:
                     gen_path, was_previously_cut, tp = finalize_cut(tps, gen_path, was_previously_cut, tool, already_cut, tp)
                 else:
-                    gen_path += [geom.PathPoint(x, y, toolpath.RapidMove if item.move_style == MoveStyle.RAPID_INSIDE else None) for x, y in item.path.coords]
-            elif isinstance(item, hsm_nibble.geometry.ArcData):
+                    gen_path += geom.ArrayToPts(item.coords, toolpath.RapidMove if item.move_style == MoveStyle.RAPID_INSIDE else None)
+            elif isinstance(item, HSMArc):
                 add_arcdata(gen_path, item)
         gen_path, was_previously_cut, tp = finalize_cut(tps, gen_path, was_previously_cut, tool, already_cut, tp)
         # Add a final pass around the perimeter
@@ -509,7 +661,6 @@ def hsm_peel(shape, tool, zigzag, displace=0, from_outside=False, shape_to_refin
             else:
                 add_finishing_outlines(tps, polygon.buffer(roughing_offset), tool, from_outside)
         alltps += tps
-        outer_progress += 1000
     return toolpath.Toolpaths(alltps)
 
 def shape_to_object(shape, tool, displace=0, from_outside=False):
@@ -553,8 +704,8 @@ def refine_shape_internal(shape, previous, current, min_entry_dia):
     output_polygons = objects_to_polygons(MultiPolygon(output_polygons).buffer(0))
     output_shapes = []
     for polygon in sort_polygons(output_polygons):
-        exterior = [geom.PathPoint(x, y) for x, y in polygon.exterior.coords]
-        interiors = [[geom.PathPoint(x, y) for x, y in interior.coords] for interior in polygon.interiors]
+        exterior = linestring2points(polygon.exterior)
+        interiors = [linestring2points(interior) for interior in polygon.interiors]
         output_shapes.append(shapes.Shape(exterior, True, interiors))
     return output_shapes
 
@@ -582,8 +733,8 @@ def refine_shape_external(shape, previous, current, min_entry_dia):
     output_polygons = objects_to_polygons(MultiPolygon(output_polygons).buffer(0))
     output_shapes = []
     for polygon in sort_polygons(output_polygons):
-        exterior = [geom.PathPoint(x, y) for x, y in polygon.exterior.coords]
-        interiors = [[geom.PathPoint(x, y) for x, y in interior.coords] for interior in polygon.interiors]
+        exterior = linestring2points(polygon.exterior)
+        interiors = [linestring2points(interior) for interior in polygon.interiors]
         output_shapes.append(shapes.Shape(exterior, True, interiors))
     return output_shapes
 
@@ -593,8 +744,8 @@ def shape_to_refine_internal(shape, previous):
     output_polygons = objects_to_polygons(previous_milled)
     output_shapes = []
     for polygon in sort_polygons(output_polygons):
-        exterior = [geom.PathPoint(x, y) for x, y in polygon.exterior.coords]
-        interiors = [[geom.PathPoint(x, y) for x, y in interior.coords] for interior in polygon.interiors]
+        exterior = linestring2points(polygon.exterior)
+        interiors = [linestring2points(interior) for interior in polygon.interiors]
         output_shapes.append(shapes.Shape(exterior, True, interiors))
     return output_shapes
 
@@ -604,6 +755,6 @@ def shape_to_refine_external(shape, previous):
     output_polygons = objects_to_polygons(previous_milled)
     output_shapes = []
     for polygon in sort_polygons(output_polygons):
-        exterior = [geom.PathPoint(x, y) for x, y in polygon.exterior.coords]
+        exterior = linestring2points(polygon.exterior)
         output_shapes.append(shapes.Shape(exterior, True))
     return output_shapes
@@ -1,9 +1,46 @@
 from pyclipper import *
 from math import *
 from DerpCAM.common.geom import *
+from DerpCAM.common.guiutils import EnumClass
 from DerpCAM.cam.shapes import Shape
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
+
+class DrawingTextStyleHAlign(EnumClass):
+    LEFT = 0
+    CENTRE = 1
+    RIGHT = 2
+    ALIGNED = 3
+    MIDDLE = 4
+    FIT = 5
+    descriptions = [
+        (LEFT, "Left"),
+        (CENTRE, "Centre"),
+        (RIGHT, "Right"),
+        (ALIGNED, "Aligned"),
+        (MIDDLE, "Middle"),
+        (FIT, "Fit"),
+    ]
+
+class DrawingTextStyleVAlign(EnumClass):
+    BASELINE = 0
+    BOTTOM = 1
+    MIDDLE = 2
+    TOP = 3
+    descriptions = [
+        (BASELINE, "Baseline"),
+        (BOTTOM, "Bottom"),
+        (MIDDLE, "Middle"),
+        (TOP, "Top"),
+    ]
+
+class DrawingTextStyle(object):
+    def __init__(self, height, width, halign, valign, angle, font_name, spacing):
+        self.height = height
+        self.width = width
+        self.halign = halign
+        self.valign = valign
+        self.angle = angle
+        self.font_name = font_name
+        self.spacing = spacing
 
 def sort_polygons(polygons):
     bounds = []
@@ -36,6 +73,7 @@ def sort_polygons(polygons):
     return output
 
 def text_to_shapes(x, y, width, height, text, font_family, size, weight, italic):
+    from PyQt5.QtGui import QFont, QFontMetrics, QPainterPath
     font = QFont(font_family, int(size * GeometrySettings.RESOLUTION), weight, italic)
     metrics = QFontMetrics(font)
     twidth = metrics.horizontalAdvance(text) / GeometrySettings.RESOLUTION
@@ -60,3 +98,77 @@ def text_to_shapes(x, y, width, height, text, font_family, size, weight, italic)
         else:
             shapes.append(Shape(pts, False, islands_out))
     return shapes
+
+def font_file(font_name):
+    # ezdxf takes longer to import than the rest of the program, only load it for text
+    from ezdxf.fonts import fonts
+    face = fonts.find_best_match(family=font_name) or fonts.find_best_match()
+    if face is None:
+        raise ValueError(f"Font not found: {font_name}")
+    return face.filename
+
+# Outlines of a text drawing object, laid out the same way as DXF TEXT
+# entities. Uses TrueType fonts directly, so that it works without a GUI.
+def text_to_paths(origin, target_width, style, text):
+    from ezdxf.fonts import fonts
+    font = fonts.make_font(font_file(style.font_name), style.height)
+    glyphs = font.glyph_cache
+    width = style.width
+    angle = style.angle * pi / 180
+    advance = sum(glyphs.get_text_length(c, style.height) for c in text) + style.spacing * len(text)
+    twidth = advance * style.width
+    cap_height = style.height
+    measurements = font.measurements
+    x, y = origin.x, origin.y
+    if style.halign == DrawingTextStyleHAlign.RIGHT:
+        x -= twidth
+    elif style.halign == DrawingTextStyleHAlign.CENTRE:
+        x -= twidth / 2
+    elif style.halign == DrawingTextStyleHAlign.ALIGNED:
+        if twidth and target_width:
+            cap_height = style.height * target_width / (width * twidth)
+    elif style.halign == DrawingTextStyleHAlign.FIT:
+        if twidth and target_width:
+            width *= target_width / twidth
+    elif style.halign == DrawingTextStyleHAlign.MIDDLE:
+        x -= twidth / 2
+        # This is likely wrong, but I don't have a better idea
+        y -= measurements.cap_height / 2
+    # For non-special H alignment values, use V alignment
+    if style.halign < DrawingTextStyleHAlign.ALIGNED:
+        if style.valign == DrawingTextStyleVAlign.BOTTOM:
+            y += measurements.descender_height
+        elif style.valign == DrawingTextStyleVAlign.MIDDLE:
+            y -= measurements.cap_height / 2
+        elif style.valign == DrawingTextStyleVAlign.TOP:
+            y -= measurements.cap_height
+    tolerance = 0.5 / GeometrySettings.RESOLUTION
+    ca, sa = cos(angle), sin(angle)
+    paths = []
+    pos = 0
+    for c in text:
+        for subpath in font.text_path_ex(c, cap_height).sub_paths():
+            points = []
+            for p in subpath.flattening(tolerance):
+                px = (p.x + pos) * width
+                points.append(PathPoint(x + px * ca - p.y * sa, y + px * sa + p.y * ca))
+            if len(points) > 1 and points[0] == points[-1]:
+                del points[-1]
+            if len(points) > 2:
+                paths.append(Path(points, True))
+        pos += glyphs.get_text_length(c, cap_height) + style.spacing
+    return paths
+
+# Glyph outlines grouped into shapes with islands (holes in letters)
+def paths_to_shapes(paths):
+    res = []
+    last_bounds = None
+    for path in sorted(paths, key=lambda path: path.bounds()[0]):
+        path_bounds = path.bounds()
+        if len(res) and inside_bounds(path_bounds, last_bounds):
+            res[-1].add_island(path.nodes)
+        else:
+            shape = Shape(path.nodes, path.closed)
+            last_bounds = path_bounds
+            res.append(shape)
+    return list(sorted(res, key=lambda item: item.bounds[0]))
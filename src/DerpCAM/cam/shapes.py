@@ -3,7 +3,6 @@ from math import *
 from DerpCAM.common.geom import *
 from . import toolpath
 import threading
-import shapely.geometry
 
 class Shape(object):
     def __init__(self, boundary, closed=True, islands=None):
@@ -28,7 +27,8 @@ class Shape(object):
         def offset_path(boundary, closed, offset):
             if offset == 0:
                 return Path(boundary, closed)
-            pts = [shapely.geometry.Point(pt.x, pt.y) for pt in boundary]
+            import shapely.geometry
+            pts = PtsToArray(boundary)
             if closed:
                 ls = shapely.geometry.LinearRing(pts)
             else:
@@ -36,26 +36,44 @@ class Shape(object):
             ls = ls.simplify(1.0 / GeometrySettings.RESOLUTION)
             lso = ls.parallel_offset(abs(offset), 'right' if offset > 0 else 'left', 4)
             lso = lso.simplify(1.0 / GeometrySettings.RESOLUTION)
-            return Path([PathPoint(x, y) for x, y in lso.coords], closed)
+            return Path(ArrayToPts(lso.coords), closed)
         tps = [toolpath.Toolpath(offset_path(self.boundary, self.closed, offset), tool)] + [
             toolpath.Toolpath(offset_path(island, True, offset), tool) for island in self.islands ]
         tps = [tp for tp in tps if not tp.is_empty()]
         return toolpath.Toolpaths(tps)
     @staticmethod
     def _offset(points, closed, dist):
-        if abs(dist) > 10 * GeometrySettings.RESOLUTION:
-            res = Shape._offset(points, closed, int(dist / 2))
-            if not res:
-                return
-            res2 = []
-            for contour in res:
-                offset = Shape._offset(contour, closed, dist - int(dist / 2))
-                if offset:
-                    res2 += offset
-            return res2
-        pc = PyclipperOffset()
-        pc.AddPath(points, JT_ROUND, ET_CLOSEDPOLYGON if closed else ET_OPENROUND)
-        return pc.Execute(dist)
+        return Shape._offset_paths([points], closed, dist)
+    # Offset several paths at once, the results are merged
+    @staticmethod
+    def _offset_paths(paths, closed, dist):
+        key = ('offset', closed, dist, GeometrySettings.offset_arc_tolerance, GeometrySettings.max_offset_step)
+        res = geometry_cache.lookup(key, [paths], lambda: GeometryCache.freeze_paths(Shape._offset_uncached(paths, closed, dist)))
+        return GeometryCache.thaw_paths(res)
+    @staticmethod
+    def _offset_uncached(paths, closed, dist):
+        # Round joins at large distances have lots of vertices, and all of them
+        # are added at every vertex of the input, so going in smaller steps is
+        # much faster. Each step smooths the outline for the next one.
+        if not closed and dist < 0:
+            # Open paths can't be shrunk
+            return []
+        max_step = GeometrySettings.max_offset_step * GeometrySettings.RESOLUTION
+        steps = max(1, ceil(abs(dist) / max_step))
+        done = 0
+        for i in range(steps):
+            # Intermediate steps are whole Clipper units, so that the rounding
+            # of x.5 coordinates doesn't shift the result
+            target = round(dist * (i + 1) / steps) if i < steps - 1 else dist
+            pc = PyclipperOffset()
+            pc.ArcTolerance = GeometrySettings.offset_arc_tolerance * GeometrySettings.RESOLUTION
+            pc.AddPaths(paths, JT_ROUND, ET_CLOSEDPOLYGON if closed else ET_OPENROUND)
+            paths = pc.Execute(target - done)
+            done = target
+            if not paths:
+                return []
+            closed = True
+        return paths
     def warp(self, transform):
         def interpolate(pts):
             res = []
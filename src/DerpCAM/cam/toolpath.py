@@ -119,7 +119,9 @@ class Toolpath(object):
         self.is_tab = is_tab
         self.transformed_cache = None
         self.lines_to_arcs_cache = None
-        self.optimize_lines_cache = None
+        self.optimize_lines_cache = {}
+        # Tolerance of the line simplification already applied, if any
+        self.simplified_tolerance = None
         self.segmentation = segmentation
         self.was_previously_cut = was_previously_cut
         self.helical_from_top = helical_from_top
@@ -140,6 +142,21 @@ class Toolpath(object):
             self.transformed_cache = self.transform(self)
         return self.transformed_cache
 
+    # Simplified variants are not pickled, as they can be recalculated if
+    # needed. Preview outlines are stored as arrays.
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['lines_to_arcs_cache'] = None
+        state['optimize_lines_cache'] = {}
+        if 'rendered_outlines' in state:
+            state['rendered_outlines'] = [PtsToArray(outline) for outline in state['rendered_outlines']]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'rendered_outlines' in state:
+            self.rendered_outlines = [ArrayToPts(outline) for outline in state['rendered_outlines']]
+
     def calc_bounds(self):
         if self.path.is_empty():
             return None
@@ -150,20 +167,30 @@ class Toolpath(object):
 
     def lines_to_arcs(self):
         if self.lines_to_arcs_cache is None:
-            self.lines_to_arcs_cache = Toolpath(Path(CircleFitter.simplify(self.path.nodes), self.path.closed), self.tool, transform=self.transform, helical_entry=self.helical_entry, bounds=self.bounds, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=self.helical_from_top, tab_maker=self.tab_maker)
+            self.lines_to_arcs_cache = Toolpath(Path(ArcFitter.simplify(self.path.nodes), self.path.closed), self.tool, transform=self.transform, helical_entry=self.helical_entry, bounds=self.bounds, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=self.helical_from_top, tab_maker=self.tab_maker)
         return self.lines_to_arcs_cache
 
-    def optimize_lines(self):
-        if self.optimize_lines_cache is None:
-            self.optimize_lines_cache = Toolpath(Path(LineOptimizer.simplify(self.path.nodes), self.path.closed), self.tool, transform=self.transform, helical_entry=self.helical_entry, bounds=self.bounds, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=self.helical_from_top, tab_maker=self.tab_maker)
-        return self.optimize_lines_cache
+    def optimize_lines(self, tolerance=None):
+        tolerance = LineSimplifier.tolerance(tolerance)
+        # Already simplified with the same or tighter tolerance, simplifying
+        # again would add up the errors
+        if self.simplified_tolerance is not None and self.simplified_tolerance <= tolerance:
+            return self
+        tp = self.optimize_lines_cache.get(tolerance)
+        if tp is None:
+            tp = Toolpath(self.path.optimize_lines(tolerance), self.tool, transform=self.transform, helical_entry=self.helical_entry, bounds=self.bounds, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=self.helical_from_top, tab_maker=self.tab_maker)
+            tp.simplified_tolerance = tolerance
+            self.optimize_lines_cache[tolerance] = tp
+        return tp
 
-    def optimize(self):
+    # tolerance = None means the global setting, 0 disables line simplification
+    def optimize(self, tolerance=None):
         path = self
         if GeometrySettings.simplify_arcs:
             path = path.lines_to_arcs()
-        if GeometrySettings.simplify_lines:
-            path = path.optimize_lines()
+        tolerance = optimize_lines_tolerance(tolerance)
+        if tolerance:
+            path = path.optimize_lines(tolerance)
         return path
 
     def subpath(self, start, end, is_tab=False, helical_entry=None):
@@ -171,6 +198,7 @@ class Toolpath(object):
         if path is None:
             return None
         tp = Toolpath(path, self.tool, transform=self.transform, helical_entry=helical_entry, is_tab=is_tab, was_previously_cut=self.was_previously_cut and start == 0, is_cleanup=self.is_cleanup, tab_maker=self.tab_maker)
+        tp.simplified_tolerance = self.simplified_tolerance
         return tp
 
     def for_tab_below(self):
@@ -178,13 +206,17 @@ class Toolpath(object):
 
     def without_circles(self):
         assert self.is_tab
-        return Toolpath(self.path.without_circles(), self.tool, helical_entry=self.helical_entry, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=False, tab_maker=self.tab_maker)
+        tp = Toolpath(self.path.without_circles(), self.tool, helical_entry=self.helical_entry, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=False, tab_maker=self.tab_maker)
+        tp.simplified_tolerance = self.simplified_tolerance
+        return tp
 
     def with_helical_from_top(self, value=True):
         assert not value or not self.is_tab
         if self.helical_from_top == value:
             return self
-        return Toolpath(self.path, self.tool, helical_entry=self.helical_entry, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=value, tab_maker=self.tab_maker)
+        tp = Toolpath(self.path, self.tool, helical_entry=self.helical_entry, is_tab=self.is_tab, was_previously_cut=self.was_previously_cut, is_cleanup=self.is_cleanup, helical_from_top=value, tab_maker=self.tab_maker)
+        tp.simplified_tolerance = self.simplified_tolerance
+        return tp
 
     def roll_breakpoint(self, tabs):
         if not tabs.tabs:
@@ -364,10 +396,10 @@ class Toolpaths(object):
         return max_bounds(*[tp.bounds for tp in self.toolpaths])
     def lines_to_arcs(self):
         return Toolpaths([tp.lines_to_arcs() for tp in self.toolpaths])
-    def optimize_lines(self):
-        return Toolpaths([tp.optimize_lines() for tp in self.toolpaths])
-    def optimize(self):
-        return Toolpaths([tp.optimize() for tp in self.toolpaths])
+    def optimize_lines(self, tolerance=None):
+        return Toolpaths([tp.optimize_lines(tolerance) for tp in self.toolpaths])
+    def optimize(self, tolerance=None):
+        return Toolpaths([tp.optimize(tolerance) for tp in self.toolpaths])
     def is_empty(self):
         return all([tp.is_empty() for tp in self.toolpaths])
     def for_tab_below(self):
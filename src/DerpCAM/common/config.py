@@ -0,0 +1,178 @@
+import configparser
+import os.path
+
+from DerpCAM.common.geom import GeometrySettings
+from DerpCAM.common.guiutils import GuiSettings
+
+def xdg_dir(variable, default):
+    return os.environ.get(variable) or os.path.join(os.path.expanduser("~"), default)
+
+# Read-only access to the settings file written by QSettings on Linux, for
+# applications that don't use Qt. Keys outside any group are stored in the
+# [General] section.
+class IniSettings(object):
+    def __init__(self, filename):
+        self.filename = filename
+        self.values = {}
+        self.sync()
+    def sync(self):
+        parser = configparser.RawConfigParser(strict=False)
+        parser.optionxform = str
+        try:
+            parser.read(self.filename, encoding="utf-8")
+        except configparser.Error:
+            return
+        self.values = {}
+        for section in parser.sections():
+            for name, value in parser.items(section):
+                if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+                self.values[name if section == 'General' else f"{section}/{name}"] = value
+    def contains(self, name):
+        return name in self.values
+    def value(self, name):
+        return self.values[name]
+    # Changes are not written back to the file
+    def setValue(self, name, value):
+        self.values[name] = value
+    def remove(self, name):
+        self.values.pop(name, None)
+
+class ConfigSetting(object):
+    def __init__(self, attr_name, setting_pathname, def_value):
+        self.attr_name = attr_name
+        self.setting_pathname = setting_pathname
+        self.def_value = def_value
+    def init(self, target):
+        setattr(target, self.attr_name, self.def_value)
+    def load(self, settings, target):
+        if settings.contains(self.setting_pathname):
+            setattr(target, self.attr_name, self.from_setting(settings.value(self.setting_pathname)))
+    def save(self, settings, source):
+        settings.setValue(self.setting_pathname, self.to_setting(getattr(source, self.attr_name)))
+    def from_setting(self, cfgvalue):
+        return str(cfgvalue)
+    def to_setting(self, value):
+        return str(value)
+
+class IntConfigSetting(ConfigSetting):
+    def from_setting(self, cfgvalue):
+        return int(cfgvalue)
+    def to_setting(self, value):
+        return str(value)
+
+class FloatConfigSetting(ConfigSetting):
+    def __init__(self, attr_name, setting_pathname, def_value, digits):
+        ConfigSetting.__init__(self, attr_name, setting_pathname, def_value)
+        self.digits = digits
+    def from_setting(self, cfgvalue):
+        return float(cfgvalue)
+    def to_setting(self, value):
+        return f"{value:0.{self.digits}f}"
+
+class BoolConfigSetting(ConfigSetting):
+    def from_setting(self, cfgvalue):
+        return cfgvalue == 'true'
+    def to_setting(self, value):
+        return 'true' if value else 'false'
+
+class ConfigSettings(object):
+    setting_list = [
+        FloatConfigSetting('resolution', 'geometry/resolution', GeometrySettings.RESOLUTION, 1),
+        BoolConfigSetting('simplify_arcs', 'geometry/simplify_arcs', GeometrySettings.simplify_arcs),
+        BoolConfigSetting('simplify_lines', 'geometry/simplify_lines', GeometrySettings.simplify_lines),
+        FloatConfigSetting('simplify_tolerance', 'geometry/simplify_tolerance', GeometrySettings.simplify_tolerance, 3),
+        IntConfigSetting('worker_processes', 'geometry/worker_processes', GeometrySettings.worker_processes),
+        BoolConfigSetting('parallel_gcode', 'gcode/parallel_gcode', GeometrySettings.parallel_gcode),
+        BoolConfigSetting('cam_cache', 'geometry/cam_cache', True),
+        IntConfigSetting('cam_cache_size', 'geometry/cam_cache_size', GeometrySettings.cam_cache_size),
+        BoolConfigSetting('paranoid_mode', 'gcode/paranoid_mode', GeometrySettings.paranoid_mode),
+        BoolConfigSetting('grbl_output', 'geometry/grbl_output', GeometrySettings.grbl_output),
+        BoolConfigSetting('spindle_control', 'gcode/spindle_control', GeometrySettings.spindle_control),
+        BoolConfigSetting('reorder_cuts', 'gcode/reorder_cuts', GeometrySettings.reorder_cuts),
+        BoolConfigSetting('canned_cycles', 'gcode/canned_cycles', GeometrySettings.canned_cycles),
+        IntConfigSetting('gcode_subroutines', 'gcode/subroutines', GeometrySettings.gcode_subroutines),
+        FloatConfigSetting('spindle_warmup', 'gcode/spindle_warmup', 0, 1),
+        FloatConfigSetting('spindle_min_rpm', 'gcode/spindle_min_rpm', 8000, 1),
+        FloatConfigSetting('spindle_max_rpm', 'gcode/spindle_max_rpm', 24000, 1),
+        ConfigSetting('run_after_export', 'gcode/run_after_export', ''),
+        BoolConfigSetting('draw_arrows', 'display/draw_arrows', GeometrySettings.draw_arrows),
+        FloatConfigSetting('grid_resolution', 'display/grid_resolution', 50, 2),
+        FloatConfigSetting('grid_resolution_minor', 'display/grid_resolution_minor', 10, 2),
+        ConfigSetting('input_directory', 'paths/input', ''),
+        ConfigSetting('last_input_directory', 'paths/last_input', ''),
+        ConfigSetting('gcode_directory', 'paths/gcode', ''),
+        ConfigSetting('last_gcode_directory', 'paths/last_gcode', ''),
+        FloatConfigSetting('clearance_z', 'defaults/clearance_z', 5, 2),
+        FloatConfigSetting('safe_entry_z', 'defaults/safe_entry_z', 1, 2),
+        BoolConfigSetting('dxf_inches', 'units/dxf_inches', GeometrySettings.dxf_inches),
+        BoolConfigSetting('gcode_inches', 'units/gcode_inches', GeometrySettings.gcode_inches),
+        BoolConfigSetting('display_inches', 'units/display_inches', GuiSettings.inch_mode),
+        IntConfigSetting('min_tabs', 'tabs/min_tabs', 2),
+        IntConfigSetting('max_tabs', 'tabs/max_tabs', 8),
+        FloatConfigSetting('tab_dist', 'tabs/tab_dist', 200, 1),
+        FloatConfigSetting('tab_min_length', 'tabs/tab_min_length', 50, 1),
+    ]
+    NUM_MRU = 4
+    def __init__(self):
+        self.settings = self.createSettingsObj()
+        for i in self.setting_list:
+            i.init(self)
+        # Set from the command line, not saved
+        self.no_cache = False
+        self.load()
+    def createSettingsObj(self):
+        return IniSettings(os.path.join(xdg_dir('XDG_CONFIG_HOME', '.config'), "kfoltman", "DerpCAM.conf"))
+    def camCacheDir(self):
+        return os.path.join(xdg_dir('XDG_CACHE_HOME', '.cache'), "DerpCAM", "toolpaths")
+    def loadMru(self):
+        self.settings.sync()
+        res = []
+        for i in range(self.NUM_MRU):
+            label = f"mru{i}"
+            if self.settings.contains(label):
+                filename = self.settings.value(label)
+                if os.path.exists(filename):
+                    res.append(filename)
+        return res
+    def saveMru(self, data):
+        for i in range(self.NUM_MRU):
+            label = f"mru{i}"
+            if i < len(data):
+                self.settings.setValue(label, data[i])
+            else:
+                self.settings.remove(label)
+        self.settings.sync()
+    def load(self):
+        settings = self.settings
+        settings.sync()
+        for i in self.setting_list:
+            i.load(settings, self)
+    def save(self):
+        settings = self.settings
+        for i in self.setting_list:
+            i.save(settings, self)
+        settings.sync()
+    def update(self):
+        GeometrySettings.RESOLUTION = self.resolution
+        GeometrySettings.simplify_arcs = self.simplify_arcs
+        GeometrySettings.simplify_lines = self.simplify_lines
+        GeometrySettings.simplify_tolerance = self.simplify_tolerance
+        GeometrySettings.worker_processes = self.worker_processes
+        GeometrySettings.parallel_gcode = self.parallel_gcode
+        GeometrySettings.cam_cache_dir = self.camCacheDir() if self.cam_cache and not self.no_cache else None
+        GeometrySettings.cam_cache_size = self.cam_cache_size
+        GeometrySettings.paranoid_mode = self.paranoid_mode
+        GeometrySettings.draw_arrows = self.draw_arrows
+        GeometrySettings.dxf_inches = self.dxf_inches
+        GeometrySettings.gcode_inches = self.gcode_inches
+        GeometrySettings.grbl_output = self.grbl_output
+        GeometrySettings.spindle_control = self.spindle_control
+        GeometrySettings.reorder_cuts = self.reorder_cuts
+        GeometrySettings.canned_cycles = self.canned_cycles
+        GeometrySettings.gcode_subroutines = self.gcode_subroutines
+        GeometrySettings.spindle_warmup = self.spindle_warmup
+        GeometrySettings.spindle_min_rpm = self.spindle_min_rpm
+        GeometrySettings.spindle_max_rpm = self.spindle_max_rpm
+        GeometrySettings.run_after_export = self.run_after_export
+        GuiSettings.inch_mode = self.display_inches
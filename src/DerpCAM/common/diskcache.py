@@ -0,0 +1,150 @@
+import os
+import hashlib
+import pickle
+import threading
+import zlib
+
+from .geom import GeometrySettings
+
+# Calculated toolpaths kept on disk between sessions, so that loading or
+# exporting a project that hasn't changed doesn't need to calculate them
+# again. Entries are files named after a hash of the key and the version of
+# the code, the least recently used ones are removed when the total size goes
+# over the limit. The access time is tracked using the modification time of the
+# files.
+class DiskCache(object):
+    MAGIC = b"DCAMTP01"
+    SUFFIX = ".dct"
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Total size of the entries, None if not known yet
+        self.size = None
+        self.hits = 0
+        self.misses = 0
+    def filename(self, key):
+        h = hashlib.blake2b(code_version().encode(), digest_size=20)
+        h.update(repr(key).encode())
+        return os.path.join(self.directory, h.hexdigest() + self.SUFFIX)
+    def load(self, key):
+        fn = self.filename(key)
+        try:
+            with open(fn, "rb") as f:
+                data = f.read()
+            if not data.startswith(self.MAGIC):
+                raise ValueError("Not a cache file")
+            value = pickle.loads(zlib.decompress(data[len(self.MAGIC):]))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Damaged or created by an incompatible version
+            self.misses += 1
+            self.remove(fn)
+            return None
+        try:
+            os.utime(fn)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+    def store(self, key, value):
+        fn = self.filename(key)
+        try:
+            data = self.MAGIC + zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 1)
+        except Exception:
+            # Not worth failing the calculation for
+            return False
+        if len(data) > self.max_size:
+            return False
+        # Write to a temporary file first, so that other instances never see partial entries
+        tmp_fn = f"{fn}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_fn, "wb") as f:
+                f.write(data)
+            old_size = os.path.getsize(fn) if os.path.exists(fn) else 0
+            os.replace(tmp_fn, fn)
+        except OSError:
+            self.remove(tmp_fn)
+            return False
+        with self.lock:
+            if self.size is not None:
+                self.size += len(data) - old_size
+            if self.size is None or self.size > self.max_size:
+                self.evict()
+        return True
+    def entries(self):
+        res = []
+        try:
+            with os.scandir(self.directory) as it:
+                for entry in it:
+                    if entry.name.endswith(self.SUFFIX):
+                        try:
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        res.append((st.st_mtime, st.st_size, entry.path))
+        except OSError:
+            pass
+        return res
+    def evict(self):
+        entries = self.entries()
+        self.size = sum(size for mtime, size, path in entries)
+        if self.size <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if self.size <= self.max_size:
+                break
+            if self.remove(path):
+                self.size -= size
+    def remove(self, fn):
+        try:
+            os.unlink(fn)
+            return True
+        except OSError:
+            return False
+    def clear(self):
+        with self.lock:
+            for mtime, size, path in self.entries():
+                self.remove(path)
+            self.size = 0
+    def stats(self):
+        return { 'hits' : self.hits, 'misses' : self.misses, 'size' : self.size }
+
+# Hash of the source code of the package, cached results from other versions
+# are not used. Development versions don't change the version number, so this
+# is used instead.
+source_hash = None
+
+def code_version():
+    global source_hash
+    if source_hash is None:
+        h = hashlib.blake2b(digest_size=20)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        for dirpath, dirnames, filenames in sorted(os.walk(root)):
+            for fn in sorted(filenames):
+                if fn.endswith(".py"):
+                    h.update(os.path.relpath(os.path.join(dirpath, fn), root).encode())
+                    with open(os.path.join(dirpath, fn), "rb") as f:
+                        h.update(f.read())
+        source_hash = h.hexdigest()
+    return source_hash
+
+toolpath_cache = None
+
+# Returns the toolpath cache as configured in GeometrySettings, or None if disabled
+def get_toolpath_cache():
+    global toolpath_cache
+    directory = GeometrySettings.cam_cache_dir
+    if not directory:
+        return None
+    max_size = GeometrySettings.cam_cache_size * 1048576
+    if toolpath_cache is None or toolpath_cache.directory != directory:
+        toolpath_cache = DiskCache(directory, max_size)
+    elif toolpath_cache.max_size != max_size:
+        toolpath_cache.max_size = max_size
+        toolpath_cache.size = None
+    return toolpath_cache
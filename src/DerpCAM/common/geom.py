@@ -1,27 +1,93 @@
 from pyclipper import *
 from math import *
+import atexit
 import threading
+import hashlib
+import multiprocessing
+import concurrent.futures
+import itertools
+import numpy
+from bisect import bisect_left
+from collections import OrderedDict
 
 class GeometrySettings:
     RESOLUTION = 25.0
     fillMode = PFT_POSITIVE
     simplify_arcs = True
     simplify_lines = False
+    # Maximum deviation introduced by merging short line segments
+    simplify_tolerance = 0.01
     draw_arrows = False
     dxf_inches = False
     gcode_inches = False
     grbl_output = False
     spindle_control = False
+    # The machine supports canned drilling cycles (G81, G82, G83, G73)
+    canned_cycles = False
+    # Repeated toolpaths are output once and called as subroutines, 0 = off,
+    # 1 = LinuxCNC O-word subroutines, 2 = M98/M99 subprograms
+    gcode_subroutines = 0
     spindle_warmup = 0
     spindle_min_rpm = None
     spindle_max_rpm = None
     paranoid_mode = False
+    # Change the order of the cuts to shorten the rapid moves between them
+    reorder_cuts = False
+    # Maximum deviation of the round joins in offsets (mm)
+    offset_arc_tolerance = 0.01
+    # Longer offsets are done in several steps (mm)
+    max_offset_step = 10
+    # Reuse results of identical offset/boolean operations (turn off for debugging)
+    geometry_cache = True
+    # Number of processes for the parts of the calculations that can run in
+    # parallel, 0 = do everything in the calculation thread
+    worker_processes = 0
+    # Also generate the G-code of the operations in the worker processes. The
+    # operations are copied to the workers, which often takes longer than
+    # generating their G-code here, so it's off unless enabled separately.
+    parallel_gcode = False
+    # Directory for keeping the calculated toolpaths between sessions, None = don't keep them
+    cam_cache_dir = None
+    # Size limit for that directory (MB)
+    cam_cache_size = 256
 
+# Coordinate buffers: (n, 2) float64 arrays of real coordinates and (n, 2)
+# int64 arrays of Clipper coordinates. Shapely takes and returns them directly,
+# so geometry can go from pyclipper to shapely and back without a PathPoint
+# per vertex.
+def PtsToArray(points):
+    if isinstance(points, numpy.ndarray):
+        return points
+    return numpy.array([[p.x for p in points], [p.y for p in points]], dtype=numpy.float64).T.reshape(-1, 2)
+
+def IntsToArray(points):
+    return numpy.asarray(points, dtype=numpy.int64).reshape(-1, 2)
+
+def ArrayToPts(xy, speed_hint=None):
+    xs, ys = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2).T.tolist()
+    if speed_hint is not None:
+        return list(map(PathPoint, xs, ys, [speed_hint] * len(xs)))
+    return list(map(PathPoint, xs, ys))
+
+def PtsToIntArray(points, res=None):
+    res = res or GeometrySettings.RESOLUTION
+    return numpy.rint(PtsToArray(points) * res).astype(numpy.int64)
+
+def PtsFromIntArray(points, res=None):
+    res = res or GeometrySettings.RESOLUTION
+    return IntsToArray(points) / res
+
+# Lists are still the fastest input format for pyclipper, the arrays only
+# help if the points are already in one
 def PtsToInts(points, res=None):
+    if isinstance(points, numpy.ndarray):
+        return PtsToIntArray(points, res).tolist()
     res = res or GeometrySettings.RESOLUTION
     return [(round(p.x * res), round(p.y * res)) for p in points]
 
 def PtsFromInts(points, res=None):
+    if isinstance(points, numpy.ndarray):
+        return ArrayToPts(PtsFromIntArray(points, res))
     res = res or GeometrySettings.RESOLUTION
     return [PathPoint(x / res, y / res) for x, y in points]
     
@@ -37,20 +103,22 @@ def PtsToIntsNeg(points):
         res = list(reversed(res))
     return res
 
-def circle(x, y, r, n=None, sa=0, ea=2*pi):
+def circle_array(x, y, r, n=None, sa=0, ea=2*pi):
     if not r:
-        return [PathPoint(x, y)]
+        return numpy.array([(x, y)], dtype=numpy.float64)
     if n is None:
         n = pi * r * GeometrySettings.RESOLUTION
     n *= abs((ea - sa) / (2 * pi))
     n = ceil(n)
-    res = []
-    for i in range(n + 1):
-        a = sa + i * (ea - sa) / n
-        newpt = PathPoint(x + r * cos(a), y + r * sin(a))
-        if not res or newpt != res[-1]:
-            res.append(newpt)
-    return res
+    a = sa + numpy.arange(n + 1) * (ea - sa) / n
+    res = numpy.column_stack((x + r * numpy.cos(a), y + r * numpy.sin(a)))
+    # Remove repeated points
+    keep = numpy.ones(len(res), dtype=bool)
+    keep[1:] = numpy.any(res[1:] != res[:-1], axis=1)
+    return res[keep]
+
+def circle(x, y, r, n=None, sa=0, ea=2*pi):
+    return ArrayToPts(circle_array(x, y, r, n, sa, ea))
 
 def circle2(x, y, r, n=None, sa=0, ea=2*pi):
     if n is None:
@@ -234,13 +302,39 @@ class Path(object):
     def __init__(self, nodes, closed):
         self.nodes = nodes
         self.closed = closed
+        self.index_key = None
     def __eq__(self, other):
         return other is not None and self.nodes == other.nodes and self.closed == other.closed
+    # Pickled in the ArrayPath format, which is several times smaller and
+    # faster to transfer between processes than the node objects
+    def __getstate__(self):
+        compact = ArrayPath.from_nodes(self.nodes, self.closed)
+        return (compact.xy, self.closed, compact.arc_index, compact.arc_data, compact.speed_hints)
+    def __setstate__(self, state):
+        Path.__init__(self, ArrayPath(*state).nodes, state[1])
     def is_empty(self):
         return len(self.nodes) == 0
     def length(self):
-        return sum([(dist(start, end) if end.is_point() else end.length()) for start, end in PathSegmentIterator(self)])
+        return self.lengths()[-1]
+    # Position lookups use a cumulative length index and (for long paths)
+    # a segment grid. Both are calculated on first use, and discarded if
+    # the node list is replaced or changes size.
+    def cache_key(self):
+        return self.nodes
+    def check_index(self):
+        key = self.cache_key()
+        if self.index_key is not key or self.index_count != len(key):
+            self.index_key = key
+            self.index_count = len(key)
+            self.lengths_cache = None
+            self.segment_grid_cache = None
+    # Cumulative lengths at segment boundaries. Shared, do not modify.
     def lengths(self):
+        self.check_index()
+        if self.lengths_cache is None:
+            self.lengths_cache = self.calc_lengths()
+        return self.lengths_cache
+    def calc_lengths(self):
         res = [0]
         lval = 0
         for start, end in PathSegmentIterator(self):
@@ -255,7 +349,14 @@ class Path(object):
         return Path([i for i in self.nodes if not i.is_circle()], self.closed)
     def subpath(self, start, end, hint=None):
         res = []
-        if hint is None or hint is Ellipsis:
+        if hint is None:
+            # Skip the segments that end before the start position
+            lengths = self.lengths()
+            index = max(0, bisect_left(lengths, start, 1) - 1)
+            it = PathSegmentIterator(self, index)
+            tlen = lengths[index]
+            prev = None
+        elif hint is Ellipsis:
             it = PathSegmentIterator(self)
             tlen = 0
             prev = hint
@@ -265,6 +366,8 @@ class Path(object):
         while True:
             if hint is not None and tlen < start:
                 prev = (it.clone(), tlen)
+            if hint is None and tlen > end:
+                break
             try:
                 last, p = next(it)
             except StopIteration:
@@ -335,15 +438,58 @@ class Path(object):
     # Returns the curve-length to a matching point *on* the path and the distance
     # from that point to the given point.
     def closest_point(self, pt):
+        lengths = self.lengths()
+        grid = self.segment_grid()
+        if grid is None:
+            return self.closest_point_on_segments(pt, range(len(lengths) - 1), lengths)
+        # Collect segments from grid cells progressively further away from
+        # the point, until no unvisited segment can possibly be closer.
+        # The final result is computed in path order, so that it is identical
+        # to a full scan in the case of ties.
+        visited = set()
+        mindist = None
+        for found, bound in grid.candidates(pt):
+            found = set(found) - visited
+            if found:
+                visited |= found
+                closest, dist = self.closest_point_on_segments(pt, found, lengths)
+                if mindist is None or dist < mindist:
+                    mindist = dist
+            if bound is None or (mindist is not None and mindist < bound):
+                break
+        return self.closest_point_on_segments(pt, sorted(visited), lengths)
+    def segment(self, i):
+        nodes = self.nodes
+        if i + 1 < len(nodes):
+            return nodes[i].seg_end(), nodes[i + 1]
+        assert self.closed
+        return nodes[-1].seg_end(), nodes[0]
+    def segment_grid(self):
+        self.check_index()
+        if self.segment_grid_cache is None:
+            nsegs = len(self.lengths()) - 1
+            if nsegs < SegmentGrid.min_segments:
+                return None
+            boxes = []
+            for i in range(nsegs):
+                pt1, pt2 = self.segment(i)
+                if pt2.is_arc():
+                    c = pt2.c
+                    boxes.append((min(pt1.x, c.cx - c.r), min(pt1.y, c.cy - c.r), max(pt1.x, c.cx + c.r), max(pt1.y, c.cy + c.r)))
+                else:
+                    boxes.append((min(pt1.x, pt2.x), min(pt1.y, pt2.y), max(pt1.x, pt2.x), max(pt1.y, pt2.y)))
+            self.segment_grid_cache = SegmentGrid(boxes)
+        return self.segment_grid_cache
+    # Same as closest_point, but only considers the segments with specified
+    # indexes (in the order given)
+    def closest_point_on_segments(self, pt, indexes, lengths):
         def rotate(x, y, angle):
             cosv, sinv = -cos(angle), sin(angle)
             return x * cosv - y * sinv, x * sinv + y * cosv
         mindist = None
         closest = None
-        lengths = self.lengths()
-        tlen = 0
-        i = 0
-        for pt1, pt2 in PathSegmentIterator(self):
+        for i in indexes:
+            pt1, pt2 = self.segment(i)
             dist1 = pt.dist(pt1)
             if pt2.is_arc():
                 arc = pt2
@@ -374,7 +520,6 @@ class Path(object):
                     if abs(my) < mindist:
                         mindist = abs(my)
                         closest = lengths[i] + (lengths[i + 1] - lengths[i]) * mx / d
-            i += 1
         assert closest is None or closest <= lengths[-1]
         return closest, mindist
     # Calculate a point on a path, then offset it by 'dist' (positive = outwards from the shape)
@@ -397,7 +542,24 @@ class Path(object):
         return IntPath([i.seg_end() for i in self.nodes]).orientation()
     # Return the point at 'pos' position along the path.
     def point_at(self, pos):
-        return self.point_at_hint(pos, self.start_hint())[0]
+        lengths = self.lengths()
+        nsegs = len(lengths) - 1
+        assert pos >= 0
+        if nsegs == 0:
+            return self.nodes[0]
+        # First segment boundary at or after pos
+        i = bisect_left(lengths, pos)
+        if i > nsegs or (i == nsegs and pos == lengths[i]):
+            if self.closed and pos > lengths[-1]:
+                return self.point_at(pos % lengths[-1])
+            return self.segment(nsegs - 1)[0]
+        if pos == lengths[i]:
+            return self.segment(i)[0]
+        last, p = self.segment(i - 1)
+        if p.is_arc():
+            return p.at_fraction((pos - lengths[i - 1]) / p.length())
+        else:
+            return weighted(last, p, (pos - lengths[i - 1]) / last.dist(p))
     def start_hint(self):
         return (PathSegmentIterator(self), 0)
     def point_at_hint(self, pos, hint):
@@ -432,9 +594,9 @@ class Path(object):
     def has_arcs(self):
         return any([p.is_arc() for p in self.nodes])
     def lines_to_arcs(self):
-        return Path(CircleFitter.simplify(self.nodes), self.closed)
-    def optimize_lines(self):
-        return Path(LineOptimizer.simplify(self.nodes), self.closed)
+        return Path(ArcFitter.simplify(self.nodes), self.closed)
+    def optimize_lines(self, tolerance=None):
+        return Path(LineSimplifier.simplify(self.nodes, tolerance), self.closed)
     def bounds(self):
         xcoords = MinMax()
         ycoords = MinMax()
@@ -462,6 +624,155 @@ class Path(object):
     def interpolated(self):
         return Path(CircleFitter.interpolate_arcs(self.nodes, False, 1), self.closed)
 
+# Compact variant of Path that keeps end points of all nodes in a single
+# (n, 2) NumPy array, with arcs stored in a side table (one row per arc,
+# indexed by the node number). Node objects are only created when something
+# accesses .nodes, so it can be used anywhere a Path is expected, while the
+# length/bounds calculations work on the arrays directly.
+class ArrayPath(Path):
+    # Columns of the arc table
+    ARC_P1X = 0
+    ARC_P1Y = 1
+    ARC_CX = 2
+    ARC_CY = 3
+    ARC_R = 4
+    ARC_SSTART = 5
+    ARC_SSPAN = 6
+    ARC_STEPS = 7
+    ARC_COLUMNS = 8
+    def __init__(self, xy, closed, arc_index=None, arc_data=None, speed_hints=None):
+        self.xy = numpy.asarray(xy, dtype=numpy.float64).reshape(-1, 2)
+        self.closed = closed
+        self.arc_index = numpy.asarray(arc_index if arc_index is not None else [], dtype=numpy.intp)
+        self.arc_data = numpy.asarray(arc_data if arc_data is not None else [], dtype=numpy.float64).reshape(-1, ArrayPath.ARC_COLUMNS)
+        # Sparse, most nodes don't have a speed hint
+        self.speed_hints = speed_hints if speed_hints is not None else {}
+        self.nodes_cache = None
+        self.index_key = None
+        assert len(self.arc_index) == len(self.arc_data)
+        assert not len(self.arc_index) or self.arc_index[0] > 0
+    @staticmethod
+    def from_nodes(nodes, closed):
+        coords = []
+        arc_index = []
+        arc_data = []
+        speed_hints = {}
+        for i, node in enumerate(nodes):
+            end = node.seg_end()
+            coords.append((end.x, end.y))
+            if node.is_arc():
+                arc_index.append(i)
+                arc_data.append((node.p1.x, node.p1.y, node.c.cx, node.c.cy, node.c.r, node.sstart, node.sspan, node.steps))
+            if node.speed_hint is not None:
+                speed_hints[i] = node.speed_hint
+        res = ArrayPath(coords, closed, arc_index, arc_data, speed_hints)
+        res.nodes_cache = nodes
+        return res
+    @staticmethod
+    def from_path(path):
+        if isinstance(path, ArrayPath):
+            return path
+        return ArrayPath.from_nodes(path.nodes, path.closed)
+    def to_path(self):
+        return Path(self.nodes, self.closed)
+    def __getstate__(self):
+        return (self.xy, self.closed, self.arc_index, self.arc_data, self.speed_hints)
+    def __setstate__(self, state):
+        ArrayPath.__init__(self, *state)
+    # Free the node objects, keeping only the arrays
+    def compact(self):
+        self.nodes_cache = None
+        return self
+    def node(self, i):
+        if self.nodes_cache is not None:
+            return self.nodes_cache[i]
+        return self.make_node(i, self.arc_lookup())
+    def arc_lookup(self):
+        return {index: row for row, index in enumerate(self.arc_index.tolist())}
+    def make_node(self, i, arcs):
+        x, y = self.xy[i].tolist()
+        speed_hint = self.speed_hints.get(i)
+        row = arcs.get(i)
+        if row is None:
+            return PathPoint(x, y, speed_hint)
+        p1x, p1y, cx, cy, r, sstart, sspan, steps = self.arc_data[row].tolist()
+        return PathArc(PathPoint(p1x, p1y), PathPoint(x, y), CandidateCircle(cx, cy, r), int(steps), sstart, sspan, speed_hint)
+    @property
+    def nodes(self):
+        if self.nodes_cache is None:
+            arcs = self.arc_lookup()
+            self.nodes_cache = [self.make_node(i, arcs) for i in range(len(self.xy))]
+        return self.nodes_cache
+    @nodes.setter
+    def nodes(self, nodes):
+        other = ArrayPath.from_nodes(nodes, self.closed)
+        self.xy = other.xy
+        self.arc_index = other.arc_index
+        self.arc_data = other.arc_data
+        self.speed_hints = other.speed_hints
+        self.nodes_cache = other.nodes_cache
+    def __len__(self):
+        return len(self.xy)
+    def is_empty(self):
+        return len(self.xy) == 0
+    # Lengths of the segments, in the same order as PathSegmentIterator returns them
+    def segment_lengths(self):
+        xy = self.xy
+        if self.closed:
+            d = numpy.roll(xy, -1, axis=0) - xy
+        else:
+            d = xy[1:] - xy[:-1]
+        res = numpy.sqrt(d[:, 0] * d[:, 0] + d[:, 1] * d[:, 1])
+        if len(self.arc_index):
+            res[self.arc_index - 1] = numpy.abs(self.arc_data[:, ArrayPath.ARC_SSPAN]) * self.arc_data[:, ArrayPath.ARC_R]
+        return res
+    def cache_key(self):
+        return self.xy
+    def calc_lengths(self):
+        return [0] + numpy.cumsum(self.segment_lengths()).tolist()
+    def has_arcs(self):
+        return len(self.arc_index) > 0
+    def seg_start(self):
+        return self.node(0)
+    def seg_end(self):
+        return self.node(0) if self.closed else self.node(len(self.xy) - 1).seg_end()
+    def bounds(self):
+        if not len(self.xy):
+            return (None, None, None, None)
+        sx, sy = self.xy.min(axis=0).tolist()
+        ex, ey = self.xy.max(axis=0).tolist()
+        if len(self.arc_index):
+            arcs = self.arc_lookup()
+            extra = []
+            for i in self.arc_index.tolist():
+                arc = self.node(i) if self.nodes_cache is not None else self.make_node(i, arcs)
+                extra += [arc.p1] + arc.quadrant_seps()
+            sx = min(sx, min(p.x for p in extra))
+            sy = min(sy, min(p.y for p in extra))
+            ex = max(ex, max(p.x for p in extra))
+            ey = max(ey, max(p.y for p in extra))
+        return (sx, sy, ex, ey)
+    def optimize_lines(self, tolerance=None):
+        tolerance = LineSimplifier.tolerance(tolerance)
+        if len(self.xy) < 3 or tolerance <= 0:
+            return self
+        keep = numpy.zeros(len(self.xy), dtype=bool)
+        keep[self.arc_index] = True
+        keep[self.arc_index - 1] = True
+        for i in self.speed_hints:
+            if i > 0 and self.speed_hints.get(i - 1) != self.speed_hints[i]:
+                keep[i - 1] = True
+            if i + 1 < len(self.xy) and self.speed_hints.get(i + 1) != self.speed_hints[i]:
+                keep[i] = True
+        index = numpy.flatnonzero(LineSimplifier.simplify_xy(self.xy, keep, tolerance))
+        positions = {old: new for new, old in enumerate(index.tolist())}
+        speed_hints = {positions[i]: hint for i, hint in self.speed_hints.items() if i in positions}
+        return ArrayPath(self.xy[index], self.closed, numpy.searchsorted(index, self.arc_index), self.arc_data.copy(), speed_hints)
+    def translated(self, dx, dy):
+        arc_data = self.arc_data.copy()
+        arc_data[:, ArrayPath.ARC_P1X:ArrayPath.ARC_CY + 1] += (dx, dy, dx, dy)
+        return ArrayPath(self.xy + (dx, dy), self.closed, self.arc_index.copy(), arc_data, dict(self.speed_hints))
+
 class PathSegmentIterator(object):
     def __init__(self, path, index=0):
         self.path = path
@@ -487,6 +798,61 @@ class PathSegmentIterator(object):
         else:
             raise StopIteration
 
+# Uniform grid of segment bounding boxes, used for nearest point queries
+# on long paths.
+class SegmentGrid(object):
+    # Below this, a linear scan is cheaper than building the grid
+    min_segments = 64
+    def __init__(self, boxes):
+        sx, sy, ex, ey = max_bounds(*boxes)
+        self.sx = sx
+        self.sy = sy
+        self.cell = max(max(ex - sx, ey - sy) / sqrt(len(boxes)), eps)
+        self.nx = int((ex - sx) / self.cell) + 1
+        self.ny = int((ey - sy) / self.cell) + 1
+        self.cells = {}
+        for i, (bsx, bsy, bex, bey) in enumerate(boxes):
+            for cx in range(self.col(bsx), self.col(bex) + 1):
+                for cy in range(self.row(bsy), self.row(bey) + 1):
+                    self.cells.setdefault((cx, cy), []).append(i)
+    def col(self, x):
+        return min(self.nx - 1, max(0, int((x - self.sx) // self.cell)))
+    def row(self, y):
+        return min(self.ny - 1, max(0, int((y - self.sy) // self.cell)))
+    # Yields lists of segment indexes from rings of cells of increasing size
+    # around the point, together with the lower bound of the distance
+    # from the point to any segment not returned yet (None if there are none).
+    def candidates(self, pt):
+        cx = self.col(pt.x)
+        cy = self.row(pt.y)
+        k = 0
+        while True:
+            found = []
+            if k == 0:
+                found += self.cells.get((cx, cy), [])
+            else:
+                for ix in range(cx - k, cx + k + 1):
+                    found += self.cells.get((ix, cy - k), [])
+                    found += self.cells.get((ix, cy + k), [])
+                for iy in range(cy - k + 1, cy + k):
+                    found += self.cells.get((cx - k, iy), [])
+                    found += self.cells.get((cx + k, iy), [])
+            # Distance to the unexplored part of the grid
+            bounds = []
+            if cx - k > 0:
+                bounds.append(pt.x - (self.sx + (cx - k) * self.cell))
+            if cx + k < self.nx - 1:
+                bounds.append(self.sx + (cx + k + 1) * self.cell - pt.x)
+            if cy - k > 0:
+                bounds.append(pt.y - (self.sy + (cy - k) * self.cell))
+            if cy + k < self.ny - 1:
+                bounds.append(self.sy + (cy + k + 1) * self.cell - pt.y)
+            bound = min(bounds) if bounds else None
+            yield found, bound
+            if bound is None:
+                return
+            k += 1
+
 def dist(a, b):
     a = a.seg_end()
     b = b.seg_start()
@@ -760,23 +1126,25 @@ class CircleFitter(object):
             res += arcs
         return res
 
-    @staticmethod
-    def simplify(pts):
+    @classmethod
+    def simplify(klass, pts):
         if len(pts) < 3:
             return pts
         pts_out = []
         last = 0
         for i, p in enumerate(pts):
             if p.is_arc():
-                pts_out += CircleFitter.simplify_noarcs(pts[last:i - 1]) + [p.p1, p]
+                pts_out += klass.simplify_noarcs(pts[last:i - 1]) + [p.p1, p]
                 last = i + 1
         if pts_out:
-            return pts_out + CircleFitter.simplify_noarcs(pts[last:])
-        return CircleFitter.simplify_noarcs(pts)
+            return pts_out + klass.simplify_noarcs(pts[last:])
+        return klass.simplify_noarcs(pts)
+    @classmethod
+    def simplify_noarcs(klass, pts):
+        return klass.arcs_to_nodes(pts, klass.fit_arcs2(pts, 0, len(pts)))
     @staticmethod
-    def simplify_noarcs(pts):
+    def arcs_to_nodes(pts, arcs):
         pts_out = []
-        arcs = CircleFitter.fit_arcs2(pts, 0, len(pts))
         last = 0
         for start, end, c, error, adir in arcs:
             pts_out += pts[last:start]
@@ -813,73 +1181,239 @@ class CircleFitter(object):
                 pts.append(p)
         return pts
 
-class LineOptimizer(object):
-    @staticmethod
-    def simplify(points):
-        last = points[0]
-        assert last.is_point()
-        # XXXKF make it settable
-        # Detection threshold (the shortest line that will initiate coalescing)
-        threshold = 1.0
-        # Error threshold (coalesce until one of the removed points sticks out by this much)
-        threshold2 = 0.2
-        run_start = None
-        output = points[0:1]
-        for i in range(1, len(points)):
-            pt = points[i]
-            if pt.is_arc():
-                # Copy arcs verbatim
-                if run_start is not None:
-                    output.append(last)
-                    run_start = None
-                output.append(pt)
-                last = pt.seg_end()
+# Least squares replacement for the CircleFitter. Circles are fitted
+# algebraically (Kasa method, using centered moments), with the moments
+# calculated from prefix sums of the coordinates, so fitting any range
+# of points is O(1). The fit is then checked against the points (and the
+# midpoints of the lines between them) using NumPy. The ranges are found
+# greedily, taking the longest arc that fits at each point.
+class ArcFitter(CircleFitter):
+    # Shortest range of points that will be replaced by an arc
+    min_points = 4
+    # Larger circles are treated as straight lines
+    max_radius = 1000
+    def __init__(self, pts):
+        xy = numpy.array([(p.x, p.y) for p in pts], dtype=numpy.float64).reshape(-1, 2)
+        # Work in local coordinates to reduce the rounding errors
+        self.origin = xy[0].tolist() if len(xy) else [0, 0]
+        x = xy[:, 0] - self.origin[0]
+        y = xy[:, 1] - self.origin[1]
+        self.x = x
+        self.y = y
+        # Lengths of the lines between the points, and the number of the
+        # changes of direction before each of them
+        dx = numpy.diff(x)
+        dy = numpy.diff(y)
+        self.lengths = numpy.hypot(dx, dy)
+        bends = (numpy.abs(dx[1:] * dy[:-1] - dy[1:] * dx[:-1]) > 1e-9) | (dx[1:] * dx[:-1] + dy[1:] * dy[:-1] <= 0)
+        self.bends = numpy.concatenate(([0], numpy.cumsum(bends)))
+        moments = numpy.stack([numpy.ones_like(x), x, y, x * x, x * y, y * y, x * x * x, x * x * y, x * y * y, y * y * y], axis=1)
+        self.sums = numpy.zeros((len(xy) + 1, moments.shape[1]))
+        numpy.cumsum(moments, axis=0, out=self.sums[1:])
+    # Circle fitted to points start..end - 1, as centre and radius in local coordinates
+    def fit(self, start, end):
+        n, sx, sy, sxx, sxy, syy, sxxx, sxxy, sxyy, syyy = (self.sums[end] - self.sums[start]).tolist()
+        a = sx / n
+        b = sy / n
+        suu = sxx - a * sx
+        suv = sxy - a * sy
+        svv = syy - b * sy
+        suuu = sxxx - 3 * a * sxx + 2 * n * a ** 3
+        svvv = syyy - 3 * b * syy + 2 * n * b ** 3
+        suvv = sxyy - 2 * b * sxy - a * syy + 2 * n * a * b * b
+        svuu = sxxy - 2 * a * sxy - b * sxx + 2 * n * a * a * b
+        det = suu * svv - suv * suv
+        if det <= 1e-12 * (suu + svv) ** 2:
+            return None
+        rhs1 = 0.5 * (suuu + suvv)
+        rhs2 = 0.5 * (svvv + svuu)
+        uc = (rhs1 * svv - rhs2 * suv) / det
+        vc = (suu * rhs2 - suv * rhs1) / det
+        r = sqrt(uc * uc + vc * vc + (suu + svv) / n)
+        if r < 5 / GeometrySettings.RESOLUTION or r > self.max_radius:
+            return None
+        return a + uc, b + vc, r
+    # Returns (circle, error, direction) if the points start..end - 1 can be
+    # replaced by an arc, None otherwise
+    def try_fit(self, start, end):
+        fit = self.fit(start, end)
+        if fit is None:
+            return None
+        cx, cy, r = fit
+        x = self.x[start:end] - cx
+        y = self.y[start:end] - cy
+        mx = 0.5 * (x[1:] + x[:-1])
+        my = 0.5 * (y[1:] + y[:-1])
+        error = max(numpy.max(numpy.abs(r - numpy.sqrt(x * x + y * y))), numpy.max(numpy.abs(r - numpy.sqrt(mx * mx + my * my))))
+        if error >= self.error_threshold:
+            return None
+        # Same rules as CandidateCircle.count_angles
+        dangles = numpy.diff(numpy.arctan2(y, x))
+        dangles = dangles[dangles != 0] % (2 * pi)
+        neg = dangles >= pi
+        dangles[neg] -= 2 * pi
+        nangles = int(numpy.count_nonzero(neg))
+        pangles = len(dangles) - nangles
+        if pangles and nangles:
+            maxpos = numpy.max(dangles[~neg])
+            maxneg = -numpy.min(dangles[neg])
+            if pangles > 10 * nangles and maxpos > 10 * maxneg:
+                pangles += nangles
+                nangles = 0
+            elif nangles > 10 * pangles and maxneg > 10 * maxpos:
+                nangles += pangles
+                pangles = 0
+            else:
+                return None
+        sweep = abs(float(numpy.sum(dangles)))
+        if sweep > 1.5 * pi:
+            return None
+        # An arc that doesn't bulge out of its chord clearly more than the
+        # points stray from it is just fitted to the rounding errors, and could
+        # as well have any other radius or direction
+        if r * (1 - cos(sweep / 2)) < 2 * error:
+            return None
+        # A straight run longer than the arc could have (with the points
+        # within the error threshold) is a line leading into a corner
+        runs = numpy.bincount(self.bends[start:end - 1] - self.bends[start], weights=self.lengths[start:end - 1])
+        if numpy.max(runs) ** 2 > 8 * r * self.error_threshold:
+            return None
+        return CandidateCircle(cx + self.origin[0], cy + self.origin[1], r), float(error), 1 if pangles else -1
+    # Longest range of points starting at pos that can be replaced by an arc,
+    # as (end, (circle, error, direction)), None if there is none. Short
+    # ranges are dominated by the rounding of the coordinates, so a failed fit
+    # doesn't mean that a longer one fails too. The lengths are doubled all
+    # the way to the end, and the longest one that fits is then extended by
+    # bisection.
+    def longest_fit(self, pos, end):
+        good = fit = bad = None
+        candidate = pos + self.min_points
+        step = 1
+        while True:
+            candidate = min(candidate, end)
+            res = self.try_fit(pos, candidate)
+            if res is not None:
+                good, fit, bad = candidate, res, None
+            elif bad is None:
+                bad = candidate
+            if candidate == end:
+                break
+            candidate += step
+            step *= 2
+        if good is None:
+            return None
+        while bad is not None and bad - good > 1:
+            candidate = (good + bad) // 2
+            res = self.try_fit(pos, candidate)
+            if res is None:
+                bad = candidate
+            else:
+                good, fit = candidate, res
+        return good, fit
+    def fit_range(self, start, end):
+        arcs = []
+        pos = start
+        while end - pos >= self.min_points:
+            found = self.longest_fit(pos, end)
+            if found is None:
+                pos += 1
                 continue
-            d = last.dist(pt)
-            if d < threshold:
-                if run_start is None:
-                    run_start = i
-                    prev_error = None
-                    output.append(pt)
-                    last = pt
-                    continue
-            if run_start is not None:
-                ptrs = points[run_start]
-                d2 = dist(ptrs, pt)
-                if d2 != 0:
-                    maxerr = 0
-                    # Checks the intermediate points against a straight line from run_start to i
-                    runlen = 0
-                    for j in range(run_start + 1, i):
-                        # Distance to the start point
-                        d1 = dist(ptrs, points[j])
-                        # Distance to the end point
-                        d3 = dist(pt, points[j])
-                        if d1 <= d2 and d3 <= d2:
-                            papprox = weighted(ptrs, pt, d1/d2)
-                            error = papprox.dist(points[j])
-                            maxerr = max(maxerr, error)
-                        else:
-                            error = threshold2
-                        if d1 > d2 or error >= threshold2:
-                            print (i - 1 - run_start, "items skipped, prev maxerr", preverr, "now", error, "runlen", runlen)
-                            if last != output[-1]:
-                                output.append(last)
-                            run_start = i
-                            last = pt
-                            break
-                        runlen += dist(points[j-1], points[j])
-                    preverr = maxerr
-            if run_start is None:
-                output.append(pt)
-            last = pt
-        if run_start is not None:
-            output.append(last)
-        return output
+            good, (c, error, adir) = found
+            arcs.append((pos, good, c, error, adir))
+            pos = good
+        return arcs
+    @classmethod
+    def simplify_noarcs(klass, pts):
+        if len(pts) < klass.min_points:
+            return pts
+        fitter = klass(pts)
+        # Split into runs at long jumps, like fit_arcs2
+        steps = numpy.sqrt(numpy.diff(fitter.x) ** 2 + numpy.diff(fitter.y) ** 2)
+        jumps = numpy.nonzero(steps > klass.line_segment_threshold)[0].tolist()
+        arcs = []
+        run_start = 0
+        for pos in jumps + [len(pts) - 1]:
+            run_end = pos + 1
+            arcs += fitter.fit_range(run_start, run_end)
+            run_start = run_end
+        return klass.arcs_to_nodes(pts, arcs)
+
+# Tolerance for the automatic line simplification: None = use the global settings
+def optimize_lines_tolerance(tolerance=None):
+    if tolerance is None:
+        return GeometrySettings.simplify_tolerance if GeometrySettings.simplify_lines else 0
+    return tolerance
+
+# Douglas-Peucker polyline simplification, the chord deviation of the result
+# never exceeds the tolerance. Arcs and changes of speed hints are never merged.
+class LineSimplifier(object):
+    @staticmethod
+    def tolerance(tolerance=None):
+        return tolerance if tolerance is not None else GeometrySettings.simplify_tolerance
+    @staticmethod
+    def deviation(xy, start, end):
+        a = xy[start]
+        d = xy[end] - a
+        v = xy[start + 1:end] - a
+        dd = d[0] * d[0] + d[1] * d[1]
+        if dd > 0:
+            t = numpy.clip((v[:, 0] * d[0] + v[:, 1] * d[1]) / dd, 0, 1)
+            v = v - t[:, None] * d
+        return v[:, 0] * v[:, 0] + v[:, 1] * v[:, 1]
+    # xy is an (n, 2) array of segment end points, keep is a boolean array
+    # of the points that must be preserved (updated in place).
+    @staticmethod
+    def simplify_xy(xy, keep, tolerance):
+        keep[0] = keep[-1] = True
+        tolerance2 = tolerance * tolerance
+        anchors = numpy.flatnonzero(keep)
+        stack = [(start, end) for start, end in zip(anchors[:-1].tolist(), anchors[1:].tolist()) if end - start > 1]
+        while stack:
+            start, end = stack.pop()
+            dist2 = LineSimplifier.deviation(xy, start, end)
+            i = int(numpy.argmax(dist2))
+            if dist2[i] > tolerance2:
+                i += start + 1
+                keep[i] = True
+                if i - start > 1:
+                    stack.append((start, i))
+                if end - i > 1:
+                    stack.append((i, end))
+        return keep
+    @staticmethod
+    def fixed_points(nodes):
+        keep = numpy.zeros(len(nodes), dtype=bool)
+        for i, node in enumerate(nodes):
+            if node.is_arc():
+                keep[i - 1] = keep[i] = True
+            elif i + 1 < len(nodes) and node.speed_hint != nodes[i + 1].speed_hint:
+                keep[i] = True
+        return keep
+    @classmethod
+    def simplify(klass, points, tolerance=None):
+        tolerance = klass.tolerance(tolerance)
+        if len(points) < 3 or tolerance <= 0:
+            return points
+        assert points[0].is_point()
+        xy = numpy.array([(p.x, p.y) for p in (node.seg_end() for node in points)], dtype=numpy.float64)
+        keep = klass.simplify_xy(xy, klass.fixed_points(points), tolerance)
+        return [points[i] for i in numpy.flatnonzero(keep).tolist()]
 
 class IntPath(object):
     def __init__(self, real_points, ints_already=False):
-        self.int_points = PtsToInts(real_points) if not ints_already else real_points
+        if ints_already:
+            self.int_points = real_points.tolist() if isinstance(real_points, numpy.ndarray) else real_points
+        else:
+            self.int_points = PtsToInts(real_points)
+        self.hash = None
+    def content_hash(self):
+        if self.hash is None:
+            self.hash = GeometryCache.path_hash(self.int_points)
+        return self.hash
+    def int_array(self):
+        return IntsToArray(self.int_points)
+    def real_array(self):
+        return PtsFromIntArray(self.int_points)
     def real_points(self):
         return PtsFromInts(self.int_points)
     def orientation(self):
@@ -894,24 +1428,100 @@ class IntPath(object):
     def area(self):
         return Area(self.int_points)
 
+# Process-wide LRU cache of Clipper results, keyed by a hash of the integer
+# coordinates of the inputs and the operation parameters. The size limit is
+# the total number of points stored.
+class GeometryCache(object):
+    def __init__(self, max_points=2000000):
+        self.max_points = max_points
+        self.lock = threading.Lock()
+        self.clear()
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.points = 0
+            self.hits = 0
+            self.misses = 0
+    @staticmethod
+    def path_hash(points):
+        data = numpy.asarray(points)
+        return hashlib.blake2b(data.dtype.str.encode() + data.tobytes(), digest_size=16).digest()
+    @staticmethod
+    def key(params, *groups):
+        h = hashlib.blake2b(repr(params).encode(), digest_size=20)
+        for group in groups:
+            h.update(b"|%d|" % len(group))
+            for path in group:
+                h.update(path.content_hash() if isinstance(path, IntPath) else GeometryCache.path_hash(path))
+        return h.digest()
+    # func returns (value, number of points in it)
+    def lookup(self, params, groups, func):
+        if not GeometrySettings.geometry_cache:
+            return func()[0]
+        key = GeometryCache.key(params, *groups)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        value, size = func()
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.points += size
+                while self.points > self.max_points and len(self.entries) > 1:
+                    _, (_, old_size) = self.entries.popitem(last=False)
+                    self.points -= old_size
+        return value
+    def stats(self):
+        return { 'hits' : self.hits, 'misses' : self.misses, 'entries' : len(self.entries), 'points' : self.points }
+    # Cached paths are stored as tuples of arrays, so that the callers can't modify them
+    @staticmethod
+    def freeze_paths(paths):
+        paths = tuple(IntsToArray(i) for i in paths or [])
+        return paths, sum(len(i) for i in paths) + 1
+    @staticmethod
+    def thaw_paths(paths):
+        return [i.tolist() for i in paths]
+    @staticmethod
+    def copy_polytree(node, parent=None):
+        res = PyPolyNode()
+        res.Contour = [list(i) for i in node.Contour]
+        res.Parent = parent
+        res.IsHole = node.IsHole
+        res.IsOpen = node.IsOpen
+        res.depth = node.depth
+        res.Childs = [GeometryCache.copy_polytree(i, res) for i in node.Childs]
+        return res
+    @staticmethod
+    def polytree_size(node):
+        return len(node.Contour) + 1 + sum(GeometryCache.polytree_size(i) for i in node.Childs)
+
+geometry_cache = GeometryCache()
+
 def run_clipper_simple(operation, subject_polys=[], clipper_polys=[], bool_only=False, return_ints=False, fillMode=None):
     if fillMode is None:
         fillMode = GeometrySettings.fillMode
-    pc = Pyclipper()
-    for path in subject_polys:
-        try:
-            pc.AddPath(path.int_points, PT_SUBJECT, True)
-        except ClipperException:
-            pass #print (path.int_points)
-    for path in clipper_polys:
+    def execute():
+        pc = Pyclipper()
+        for path in subject_polys:
+            try:
+                pc.AddPath(path.int_points, PT_SUBJECT, True)
+            except ClipperException:
+                pass #print (path.int_points)
+        for path in clipper_polys:
+            try:
+                pc.AddPath(path.int_points, PT_CLIP, True)
+            except ClipperException:
+                pass #print (path.int_points)
         try:
-            pc.AddPath(path.int_points, PT_CLIP, True)
+            res = pc.Execute(operation, fillMode, fillMode)
         except ClipperException:
-            pass #print (path.int_points)
-    try:
-        res = pc.Execute(operation, fillMode, fillMode)
-    except ClipperException:
-        res = None
+            res = None
+        return GeometryCache.freeze_paths(res)
+    res = GeometryCache.thaw_paths(geometry_cache.lookup(('clipper', operation, fillMode), [subject_polys, clipper_polys], execute))
     if bool_only:
         return True if res else False
     if not res:
@@ -942,14 +1552,16 @@ def run_clipper_advanced(operation, subject_polys=[], clipper_polys=[], subject_
             import traceback
             print ("Warning: CT_DIFFERENCE may trigger a Clipper bug affecting horizontal lines and no workaround geometry has been passed!")
             traceback.print_stack()
-    for path in subject_polys:
-        pc.AddPath(path.int_points, PT_SUBJECT, True)
-    for path in subject_paths:
-        pc.AddPath(path.int_points, PT_SUBJECT, False)
-    for path in clipper_polys:
-        pc.AddPath(path.int_points, PT_CLIP, True)
-    tree = pc.Execute2(operation, fillMode, fillMode)
-    return tree
+    def execute():
+        for path in subject_polys:
+            pc.AddPath(path.int_points, PT_SUBJECT, True)
+        for path in subject_paths:
+            pc.AddPath(path.int_points, PT_SUBJECT, False)
+        for path in clipper_polys:
+            pc.AddPath(path.int_points, PT_CLIP, True)
+        tree = pc.Execute2(operation, fillMode, fillMode)
+        return tree, GeometryCache.polytree_size(tree)
+    return GeometryCache.copy_polytree(geometry_cache.lookup(('clipper_tree', operation, fillMode), [subject_polys, subject_paths, clipper_polys], execute))
 
 def run_clipper_checkpath(operation, subject_polys=[], clipper_polys=[], subject_paths=[], fillMode=None):
     tree = run_clipper_advanced(operation, subject_polys, clipper_polys, subject_paths, fillMode)
@@ -1000,7 +1612,147 @@ def dxf_polyline_to_points(entity, scaling=1):
     return points, entity.closed
 
 def is_calculation_cancelled():
+    if worker_job_id is not None:
+        return worker_cancel_slot is not None and bool(worker_cancel_flags[worker_cancel_slot])
     return getattr(threading.current_thread(), 'cancelled', False)
 
 def set_calculation_progress(amount_done, amount_total):
-    setattr(threading.current_thread(), 'progress', (min(amount_done, amount_total - 1), amount_total))
+    progress = (min(amount_done, amount_total - 1), amount_total)
+    if worker_job_id is not None:
+        worker_progress_queue.put((worker_job_id, progress))
+    else:
+        setattr(threading.current_thread(), 'progress', progress)
+
+# Process pool for the parallel parts of the calculations. The workers are
+# started with forkserver where available and spawned elsewhere, never forked
+# from this process, as it may be running Qt and other threads. They import
+# the main script again, so the scripts need a __main__ guard.
+worker_pool = None
+worker_pool_size = 0
+worker_pool_lock = threading.Lock()
+# Progress and cancellation of the jobs running in the workers. The queue and
+# the flags are created with the first pool and passed to each worker when it
+# starts.
+worker_progress_queue = None
+worker_cancel_flags = None
+# Progress of the jobs that haven't finished yet, by job id
+worker_progress = {}
+# Slots in worker_cancel_flags not used by any unfinished job
+worker_free_slots = []
+worker_jobs_lock = threading.Lock()
+# Job being run by this process, if it is a worker, and its cancel flag
+worker_job_id = None
+worker_cancel_slot = None
+
+def worker_start_method():
+    return 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+def get_worker_pool():
+    global worker_pool, worker_pool_size, worker_progress_queue, worker_cancel_flags
+    processes = GeometrySettings.worker_processes
+    # Workers don't start pools of their own
+    if not processes or worker_job_id is not None:
+        return None
+    with worker_pool_lock:
+        if worker_pool is None or worker_pool_size != processes:
+            context = multiprocessing.get_context(worker_start_method())
+            if worker_progress_queue is None:
+                worker_progress_queue = context.SimpleQueue()
+                worker_cancel_flags = context.RawArray('b', 1024)
+                worker_free_slots[:] = range(len(worker_cancel_flags))
+                threading.Thread(target=forward_worker_progress, daemon=True).start()
+            if worker_pool is not None:
+                worker_pool.shutdown(wait=False, cancel_futures=True)
+            worker_pool = concurrent.futures.ProcessPoolExecutor(processes, mp_context=context, initializer=init_worker, initargs=(worker_progress_queue, worker_cancel_flags))
+            worker_pool_size = processes
+        return worker_pool
+
+@atexit.register
+def shutdown_worker_pool():
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is not None:
+            worker_pool.shutdown(wait=False, cancel_futures=True)
+            worker_pool = None
+
+def init_worker(progress_queue, cancel_flags):
+    global worker_progress_queue, worker_cancel_flags
+    worker_progress_queue = progress_queue
+    worker_cancel_flags = cancel_flags
+
+def forward_worker_progress():
+    while True:
+        job_id, progress = worker_progress_queue.get()
+        with worker_jobs_lock:
+            # Reports arriving after the job has finished are dropped
+            if job_id in worker_progress:
+                worker_progress[job_id] = progress
+
+def run_job(job_id, cancel_slot, settings, func, *args):
+    global worker_job_id, worker_cancel_slot
+    for name, value in settings.items():
+        setattr(GeometrySettings, name, value)
+    worker_job_id = job_id
+    worker_cancel_slot = cancel_slot
+    try:
+        return func(*args)
+    finally:
+        worker_job_id = worker_cancel_slot = None
+
+# func(*args) running in the pool, with the current settings. The function may
+# use set_calculation_progress and is_calculation_cancelled like it would in
+# the calculation thread.
+class CalculationJob(object):
+    next_id = itertools.count()
+    def __init__(self, pool, func, args):
+        self.id = next(self.next_id)
+        with worker_jobs_lock:
+            worker_progress[self.id] = None
+            # The flag is kept until the job has finished, even if it's
+            # cancelled. With all of them taken, the job can only be cancelled
+            # before it starts.
+            self.cancel_slot = worker_free_slots.pop() if worker_free_slots else None
+        if self.cancel_slot is not None:
+            worker_cancel_flags[self.cancel_slot] = 0
+        settings = {name: value for name, value in vars(GeometrySettings).items() if not name.startswith('_')}
+        self.future = pool.submit(run_job, self.id, self.cancel_slot, settings, func, *args)
+        self.future.add_done_callback(self.finished)
+    def finished(self, future):
+        with worker_jobs_lock:
+            worker_progress.pop(self.id, None)
+            if self.cancel_slot is not None:
+                worker_free_slots.append(self.cancel_slot)
+                self.cancel_slot = None
+    # Last (amount_done, amount_total) reported by the job, None if nothing
+    # has been reported yet
+    def progress(self):
+        return worker_progress.get(self.id)
+    def fraction_done(self):
+        if self.future.done():
+            return 1
+        progress = self.progress()
+        return progress[0] / progress[1] if progress else 0
+    def cancel(self):
+        with worker_jobs_lock:
+            if self.cancel_slot is not None:
+                worker_cancel_flags[self.cancel_slot] = 1
+        self.future.cancel()
+    def result(self):
+        return self.future.result()
+
+def submit_calculation(pool, func, *args):
+    return CalculationJob(pool, func, args)
+
+# Wait for the jobs, reporting their combined progress as the progress of the
+# calling thread. Returns False if the calculation got cancelled.
+def wait_for_jobs(jobs):
+    futures = [job.future for job in jobs]
+    while True:
+        done, pending = concurrent.futures.wait(futures, timeout=0.1)
+        if is_calculation_cancelled():
+            for job in jobs:
+                job.cancel()
+            return False
+        set_calculation_progress(1000 * sum(job.fraction_done() for job in jobs), 1000 * len(jobs))
+        if not pending:
+            return True
@@ -1,10 +1,10 @@
-from PyQt5.QtCore import *
-from PyQt5.QtGui import *
-from PyQt5.QtWidgets import *
+import sys
+
+# Used by the headless engine as well, so PyQt5 is only imported by the
+# functions that need it
 
 class GuiSettings(object):
     inch_mode = False
-    batch_text_hack = False
 
 class UnitConverter(object):
     alt_units = {"in", "sfm", "ipm", "ipt"}
@@ -226,15 +226,36 @@ class Format(object):
     def point(value, brief=False):
         return Format.point_tuple((value.x, value.y), brief=brief)
 
+class EnumClass(object):
+    @classmethod
+    def toString(classInst, value):
+        for data in classInst.descriptions:
+            if value == data[0]:
+                return data[1]
+        return None
+    @classmethod
+    def toTuple(classInst, value):
+        for data in classInst.descriptions:
+            if value == data[0]:
+                return data
+        return None
+
 def is_gui_application():
-    return isinstance(QCoreApplication.instance(), QGuiApplication) and not GuiSettings.batch_text_hack
+    if 'PyQt5.QtGui' not in sys.modules:
+        return False
+    from PyQt5.QtCore import QCoreApplication
+    from PyQt5.QtGui import QGuiApplication
+    return isinstance(QCoreApplication.instance(), QGuiApplication)
 
 class Spinner(object):
     def __enter__(self):
         if is_gui_application():
+            from PyQt5.QtCore import Qt
+            from PyQt5.QtGui import QCursor, QGuiApplication
             QGuiApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
     def __exit__(self, exc_type, exc_value, exc_traceback):
         if is_gui_application():
+            from PyQt5.QtGui import QGuiApplication
             QGuiApplication.restoreOverrideCursor()
 
 cursor_cache = {}
@@ -318,6 +339,7 @@ cursor_shapes = {
 
 
 def dataToBitmap(shape):
+    from PyQt5.QtGui import QColor, QPixmap
     pixmap = QPixmap(["16 16 3 1", "- c #FFFFFF", "0 c #000000", ". c #FF00FF" ] + shape)
     mask = pixmap.createMaskFromColor(QColor(255, 0, 255))
     pixmap.setMask(mask)
@@ -330,6 +352,7 @@ def newCursor(shape):
 def customCursor(name):
     res = cursor_cache.get(name, None)
     if not res:
+        from PyQt5.QtGui import QCursor
         shape = cursor_shapes[name]
         res = cursor_cache[name] = QCursor(dataToBitmap(shape[2:]), shape[0], shape[1])
     return res
@@ -5,6 +5,7 @@ from .geom import *
 from .guiutils import Spinner
 from DerpCAM.cam import gcodegen
 from DerpCAM.cam import toolpath
+import contextlib
 import sys
 import time
 
@@ -37,6 +38,11 @@ class OperationsRenderer(object):
             opb = op.shape.bounds
             for depth, paths in op.to_preview():
                 opb = max_bounds(opb, paths.bounds)
+            offsets = op.instance_offsets()
+            if offsets is not None:
+                dsx, dsy = offsets.min(axis=0).tolist()
+                dex, dey = offsets.max(axis=0).tolist()
+                opb = (opb[0] + dsx, opb[1] + dsy, opb[2] + dex, opb[3] + dey)
             if b is None:
                 b = opb
             else:
@@ -67,26 +73,33 @@ class OperationsRenderer(object):
         for op in self.operations.operations:
             preview = op.to_preview()
             if preview:
-                for stage in (1, 2):
-                    # Null passes (we should probably warn about these)
-                    if op.props.start_depth <= op.props.depth:
-                        continue
-                    for depth, toolpath in preview:
-                        if self.operations.thickness:
-                            alpha = int(255 * alpha_scale * self.depth2intensity(depth, self.operations.thickness))
-                        else:
-                            alpha = int(255 * alpha_scale * (op.props.start_depth - depth) / (op.props.start_depth - op.props.depth))
-                        if stage == 1:
-                            pen = self.toolPenFunc(toolpath, alpha, op)
-                        if stage == 2:
-                            pen = self.penColInt(0, 0, 0, alpha, 0)
-                        self.addToolpaths(owner, pen, toolpath, stage, op)
+                with owner.instancedDrawing(op.instance_offsets()):
+                    for stage in (1, 2):
+                        # Null passes (we should probably warn about these)
+                        if op.props.start_depth <= op.props.depth:
+                            continue
+                        for depth, toolpath in preview:
+                            if self.operations.thickness:
+                                alpha = int(255 * alpha_scale * self.depth2intensity(depth, self.operations.thickness))
+                            else:
+                                alpha = int(255 * alpha_scale * (op.props.start_depth - depth) / (op.props.start_depth - op.props.depth))
+                            if stage == 1:
+                                pen = self.toolPenFunc(toolpath, alpha, op)
+                            if stage == 2:
+                                pen = self.penColInt(0, 0, 0, alpha, 0)
+                            self.addToolpaths(owner, pen, toolpath, stage, op)
     def isHighlighted(self, operation):
         return False
     def renderRapids(self, owner, lastpt = PathPoint(0, 0)):
         # Red rapid moves
         pen = QPen(QColor(192, 0, 0), 0)
         for op in self.operations.operations:
+            if op.instance_offsets() is not None:
+                # Only the moves between the copies
+                centres = [PathPoint(x, y) for x, y in op.centres.tolist()]
+                owner.addLines(pen, [lastpt] + centres, False, darken=False)
+                lastpt = centres[-1]
+                continue
             for i in op.cutpaths:
                 last_depth = self.operations.machine_params.safe_z
                 for depth, subpath in i.to_preview():
@@ -97,10 +110,11 @@ class OperationsRenderer(object):
         penOutside = QPen(QColor(0, 0, 255), 0)
         penIslands = QPen(QColor(0, 255, 0), 0)
         for op in self.operations.operations:
-            p = op.shape.boundary
-            owner.addLines(penOutside, p, op.shape.closed)
-            for p in op.shape.islands:
-                owner.addLines(penIslands, p, True)
+            with owner.instancedDrawing(op.instance_offsets()):
+                p = op.shape.boundary
+                owner.addLines(penOutside, p, op.shape.closed)
+                for p in op.shape.islands:
+                    owner.addLines(penIslands, p, True)
     def renderDrawing(self, owner):
         self.renderToolpaths(owner)
         self.renderRapids(owner)
@@ -237,6 +251,31 @@ class ScaledFillDrawingOp(object):
                 qp.fillPath(self.path, self.brush())
         qp.setTransform(transform)
 
+# Wraps another drawing op, moving it by dx, dy when painting
+class TranslatedDrawingOp(object):
+    def __init__(self, op, dx, dy):
+        self.op = op
+        self.dx = dx
+        self.dy = dy
+    def paint(self, qp, transform, drawingArea, is_draft, scale):
+        transform2 = QTransform(transform).translate(self.dx, self.dy)
+        qp.setTransform(transform2)
+        self.op.paint(qp, transform2, drawingArea, is_draft, scale)
+        qp.setTransform(transform)
+
+# Wraps another drawing op, painting it once for each of the (dx, dy) offsets.
+# Used for the operations that repeat the same toolpaths in many places.
+class InstancedDrawingOp(object):
+    def __init__(self, op, offsets):
+        self.op = op
+        self.offsets = offsets
+    def paint(self, qp, transform, drawingArea, is_draft, scale):
+        for dx, dy in self.offsets:
+            transform2 = QTransform(transform).translate(dx, dy)
+            qp.setTransform(transform2)
+            self.op.paint(qp, transform2, drawingArea, is_draft, scale)
+        qp.setTransform(transform)
+
 class PathViewer(QWidget):
     coordsUpdated = pyqtSignal([float, float])
     coordsInvalid = pyqtSignal([])
@@ -321,6 +360,28 @@ class PathViewer(QWidget):
         self.drawingOps = []
         self.renderer.renderDrawing(self)
 
+    # Anything added within the block is moved by dx, dy when painting
+    @contextlib.contextmanager
+    def translatedDrawing(self, dx, dy):
+        start = len(self.drawingOps)
+        try:
+            yield
+        finally:
+            if dx or dy:
+                self.drawingOps[start:] = [TranslatedDrawingOp(op, dx, dy) for op in self.drawingOps[start:]]
+
+    # Anything added within the block is painted once for each of the offsets
+    # (a numpy array of dx, dy), or just once if offsets is None
+    @contextlib.contextmanager
+    def instancedDrawing(self, offsets):
+        start = len(self.drawingOps)
+        try:
+            yield
+        finally:
+            if offsets is not None:
+                offsets = offsets.tolist()
+                self.drawingOps[start:] = [InstancedDrawingOp(op, offsets) for op in self.drawingOps[start:]]
+
     def isDraft(self):
         return self.click_data or self.draft_time
 
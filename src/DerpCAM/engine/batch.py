@@ -0,0 +1,115 @@
+import argparse
+import multiprocessing
+import os.path
+import sys
+import time
+import traceback
+
+from DerpCAM.common import config, geom
+from DerpCAM.engine import project
+
+# Conversion of many project files to G-code, one process per project. Does
+# not use Qt, and the worker processes only load the modules needed for the
+# calculation.
+
+config_settings = None
+debug = False
+
+def init_settings(settings_file, no_cache, worker_processes):
+    global config_settings
+    config_settings = config.ConfigSettings()
+    if settings_file is not None:
+        config_settings.settings = config.IniSettings(settings_file)
+        config_settings.load()
+    config_settings.no_cache = no_cache
+    if worker_processes is not None:
+        config_settings.worker_processes = worker_processes
+    config_settings.update()
+
+def init_worker(settings_file, no_cache, is_debug):
+    global debug
+    debug = is_debug
+    # Parallelism comes from converting several projects at once
+    init_settings(settings_file, no_cache, 0)
+
+# Returns (input filename, output filename, error message or None, warnings, time taken)
+def export_project(input_fn, output_fn):
+    start = time.time()
+    warnings = []
+    try:
+        prj = project.Project(config_settings)
+        prj.loadProject(input_fn)
+        prj.validateForOutput()
+        prj.waitForUpdateCAM()
+        errors = [error for error in prj.checkCAMErrors() if error is not None]
+        if errors:
+            raise ValueError("\n".join(errors))
+        warnings = [warning for warning in prj.checkCAMWarnings() if warning is not None]
+        prj.exportGcode(output_fn)
+        error = None
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        if debug:
+            traceback.print_exc()
+    finally:
+        # Results of the geometry operations are not shared between projects
+        geom.geometry_cache.clear()
+    return input_fn, output_fn, error, warnings, time.time() - start
+
+def export_project_job(job):
+    return export_project(*job)
+
+def output_filename(input_fn, output_dir, suffix):
+    base = os.path.splitext(os.path.basename(input_fn))[0] + suffix
+    return os.path.join(output_dir if output_dir is not None else os.path.dirname(input_fn), base)
+
+def main(argv):
+    global debug
+    parser = argparse.ArgumentParser(description="Convert DerpCAM project files to G-Code without a GUI")
+    parser.add_argument('input', type=str, nargs='+', help="Project files to convert")
+    parser.add_argument('-o', '--output-dir', type=str, help="Directory for the G-Code files (default: same as the project file)")
+    parser.add_argument('--suffix', type=str, default=".ngc", help="Extension of the G-Code files (default: .ngc)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Number of projects converted at the same time (default: number of CPUs)")
+    parser.add_argument('--settings', type=str, help="Settings file to use instead of DerpCAM's own (INI format, as written by the GUI)")
+    parser.add_argument('--no-cache', action='store_true', help="Do not use or update the cache of calculated toolpaths")
+    parser.add_argument('--debug', action='store_true', help="Display additional debugging information on errors")
+    args = parser.parse_args(argv)
+
+    for fn in args.input:
+        if not fn.endswith(".dcp"):
+            sys.stderr.write(f"Error: {fn} is not a project file\n")
+            return 1
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    jobs = [(fn, output_filename(fn, args.output_dir, args.suffix)) for fn in args.input]
+    if len(set(output_fn for input_fn, output_fn in jobs)) != len(jobs):
+        sys.stderr.write("Error: Some of the projects would be written to the same output file\n")
+        return 1
+
+    processes = max(1, min(args.jobs, len(jobs)))
+    if processes == 1:
+        # No point in starting another process, the calculation can use the
+        # worker processes from the settings instead
+        debug = args.debug
+        init_settings(args.settings, args.no_cache, None)
+        results = (export_project(*job) for job in jobs)
+        pool = None
+    else:
+        context = multiprocessing.get_context(geom.worker_start_method())
+        pool = context.Pool(processes, initializer=init_worker, initargs=(args.settings, args.no_cache, args.debug))
+        results = pool.imap_unordered(export_project_job, jobs)
+    retcode = 0
+    try:
+        for input_fn, output_fn, error, warnings, duration in results:
+            if error is not None:
+                sys.stderr.write(f"Cannot generate G-Code for {input_fn}: {error}\n")
+                retcode = 2
+            else:
+                for warning in warnings:
+                    sys.stderr.write(f"Warning: {input_fn}: {warning}\n")
+                print (f"{input_fn} -> {output_fn} ({duration:0.2f}s)")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return retcode
@@ -0,0 +1,556 @@
+import hashlib
+import json
+import math
+
+from DerpCAM.common import diskcache, geom
+from DerpCAM.common.guiutils import EnumClass, Format
+from DerpCAM import cam
+from DerpCAM.cam import dogbone, gcodegen, gcodeops, milling_tool, shapes
+from DerpCAM.gui import inventory
+
+# Project data and toolpath calculation shared by the GUI document model and
+# the headless engine. Nothing here may depend on Qt.
+
+class MaterialType(EnumClass):
+    WOOD = 0
+    PLASTICS = 1
+    ALU = 2
+    MILD_STEEL = 3
+    ALLOY_STEEL = 4
+    TOOL_STEEL = 5
+    STAINLESS_STEEL = 6
+    CAST_IRON = 7
+    MALLEABLE_IRON = 8
+    BRASS = 9
+    FOAM = 10
+    descriptions = [
+        (FOAM, "Foam", milling_tool.material_foam),
+        (WOOD, "Wood/MDF", milling_tool.material_wood),
+        (PLASTICS, "Plastics", milling_tool.material_plastics),
+        (ALU, "Aluminium", milling_tool.material_aluminium),
+        (BRASS, "Brass", milling_tool.material_brass),
+        (MILD_STEEL, "Mild steel", milling_tool.material_mildsteel),
+        (ALLOY_STEEL, "Alloy or MC steel", milling_tool.material_alloysteel),
+        (TOOL_STEEL, "Tool steel", milling_tool.material_toolsteel),
+        (STAINLESS_STEEL, "Stainless steel", milling_tool.material_stainlesssteel),
+        (CAST_IRON, "Cast iron - gray", milling_tool.material_castiron),
+        (MALLEABLE_IRON, "Cast iron - malleable", milling_tool.material_malleableiron),
+    ]
+
+class OperationType(EnumClass):
+    OUTSIDE_CONTOUR = 1
+    INSIDE_CONTOUR = 2
+    POCKET = 3
+    ENGRAVE = 4
+    INTERPOLATED_HOLE = 5
+    DRILLED_HOLE = 6
+    OUTSIDE_PEEL = 7
+    REFINE = 8
+    descriptions = [
+        (OUTSIDE_CONTOUR, "Outside contour"),
+        (INSIDE_CONTOUR, "Inside contour"),
+        (POCKET, "Pocket"),
+        (ENGRAVE, "Engrave"),
+        (INTERPOLATED_HOLE, "H-Hole"),
+        (DRILLED_HOLE, "Drill"),
+        (OUTSIDE_PEEL, "Outside peel"),
+        (REFINE, "Refine"),
+    ]
+
+def not_none(*args):
+    for i in args:
+        if i is not None:
+            return True
+    return False
+
+class PresetDerivedAttributeItem(object):
+    def __init__(self, name, preset_name=None, preset_scale=None, def_value=None):
+        self.name = name
+        self.preset_name = preset_name or name
+        self.preset_scale = preset_scale
+        self.def_value = def_value
+    def resolve(self, operation, preset):
+        if operation is not None:
+            op_value = getattr(operation, self.name)
+            if op_value is not None:
+                return (True, op_value)
+        preset_value = getattr(preset, self.preset_name, None) if preset else None
+        if preset_value is not None:
+            if self.preset_scale is not None:
+                preset_value *= self.preset_scale
+            return (operation is None, preset_value)
+        return (False, self.def_value)
+
+class PresetDerivedAttributes(object):
+    attrs_common = [
+        PresetDerivedAttributeItem('rpm'),
+        PresetDerivedAttributeItem('vfeed'),
+        PresetDerivedAttributeItem('doc', preset_name='maxdoc'),
+    ]
+    attrs_endmill = [
+        PresetDerivedAttributeItem('hfeed'),
+        PresetDerivedAttributeItem('offset', def_value=0),
+        PresetDerivedAttributeItem('roughing_offset', def_value=0),
+        PresetDerivedAttributeItem('stepover', preset_scale=100),
+        PresetDerivedAttributeItem('extra_width', preset_scale=100, def_value=0),
+        PresetDerivedAttributeItem('trc_rate', preset_scale=100, def_value=0),
+        PresetDerivedAttributeItem('direction', def_value=inventory.MillDirection.CONVENTIONAL),
+        PresetDerivedAttributeItem('pocket_strategy', def_value=inventory.PocketStrategy.CONTOUR_PARALLEL),
+        PresetDerivedAttributeItem('axis_angle', def_value=0),
+        PresetDerivedAttributeItem('eh_diameter', preset_scale=100, def_value=50),
+        PresetDerivedAttributeItem('entry_mode', def_value=inventory.EntryMode.PREFER_HELIX),
+    ]
+    attrs_all = attrs_common + attrs_endmill
+    attrs = {
+        inventory.EndMillCutter : {i.name : i for i in attrs_all},
+        inventory.DrillBitCutter : {i.name : i for i in attrs_common},
+    }
+    def __init__(self, operation, preset=None, addError=None):
+        if preset is None:
+            preset = operation.tool_preset
+        self.operation = operation
+        attrs = self.attrs[operation.cutter.__class__]
+        self.dirty = False
+        for attr in attrs.values():
+            dirty, value = attr.resolve(operation, preset)
+            setattr(self, attr.name, value)
+            self.dirty = self.dirty or dirty
+        # Material defaults
+        if operation.document.material.material is not None and operation.cutter is not None:
+            m = MaterialType.toTuple(operation.document.material.material)[2]
+            t = operation.cutter
+            try:
+                if isinstance(operation.cutter, inventory.EndMillCutter):
+                    if not all([self.rpm, self.hfeed, self.vfeed, self.doc, self.stepover]):
+                        # Slotting penalty
+                        f = 1
+                        if operation.operation in (OperationType.OUTSIDE_CONTOUR, OperationType.INSIDE_CONTOUR):
+                            f = 0.6
+                        st = milling_tool.standard_tool(t.diameter, t.flutes or 2, m, milling_tool.carbide_uncoated, not operation.cutter.material.is_carbide(), f, flute_length=t.length, machine_params=operation.document.gcode_machine_params)
+                        if self.rpm is None:
+                            self.rpm = st.rpm
+                        if self.hfeed is None:
+                            self.hfeed = st.hfeed * f
+                        if self.vfeed is None:
+                            self.vfeed = st.vfeed * f
+                        if self.doc is None:
+                            self.doc = st.maxdoc * f
+                        if self.stepover is None:
+                            self.stepover = st.stepover * 100
+                elif isinstance(operation.cutter, inventory.DrillBitCutter):
+                    if not all([self.rpm, self.vfeed, self.doc]):
+                        st = milling_tool.standard_tool(t.diameter, t.flutes or 2, m, milling_tool.carbide_uncoated, not operation.cutter.material.is_carbide(), 1.0, flute_length=t.length, machine_params=operation.document.gcode_machine_params, is_drill=True)
+                        if self.rpm is None:
+                            self.rpm = st.rpm
+                        if self.vfeed is None:
+                            self.vfeed = st.vfeed
+                        if self.doc is None:
+                            self.doc = st.maxdoc
+            except ValueError as e:
+                if addError:
+                    addError(str(e))
+    def validate(self, errors):
+        if self.vfeed is None:
+            errors.append("Plunge rate is not set")
+        if self.doc is None:
+            errors.append("Maximum depth of cut per pass is not set")
+        if isinstance(self.operation.cutter, inventory.EndMillCutter):
+            if self.hfeed is None:
+                if self.operation.operation != OperationType.DRILLED_HOLE:
+                    errors.append("Feed rate is not set")
+            elif self.hfeed < 0.1 or self.hfeed > 10000:
+                errors.append("Feed rate is out of range (0.1-10000)")
+            if self.stepover is None or self.stepover < 0.1 or self.stepover > 100:
+                if self.operation.operation == OperationType.POCKET or self.operation.operation == OperationType.OUTSIDE_PEEL or self.operation.operation == OperationType.REFINE:
+                    if self.stepover is None:
+                        errors.append("Horizontal stepover is not set")
+                    else:
+                        errors.append("Horizontal stepover is out of range")
+                else:
+                    # Fake value that is never used
+                    self.stepover = 0.5
+    @staticmethod
+    def valuesFromPreset(preset, cutter_type):
+        values = {}
+        if preset:
+            values['name'] = preset.name
+            for attr in PresetDerivedAttributes.attrs[cutter_type].values():
+                present, value = attr.resolve(None, preset)
+                values[attr.name] = value if present is not None else None
+        else:
+            for attr in PresetDerivedAttributes.attrs[cutter_type].values():
+                if attr.def_value is not None:
+                    values[attr.name] = attr.def_value
+        return values
+    def toPreset(self, name):
+        return self.toPresetFromAny(name, self, self.operation.cutter, type(self.operation.cutter))
+    @classmethod
+    def toPresetFromAny(klass, name, src, cutter, cutter_type):
+        kwargs = {}
+        is_dict = isinstance(src, dict)
+        for attr in klass.attrs[cutter_type].values():
+            value = src[attr.name] if is_dict else getattr(src, attr.name)
+            if value is not None and attr.preset_scale is not None:
+                value /= attr.preset_scale
+            kwargs[attr.preset_name] = value
+        return cutter_type.preset_type.new(None, name, cutter, **kwargs)
+    @classmethod
+    def resetPresetDerivedValues(klass, target):
+        for attr in klass.attrs_all:
+            setattr(target, attr.name, None)
+        target.emitPropertyChanged()
+
+def workerExceptionText(e):
+    import traceback
+    errorText = str(e)
+    if not errorText:
+        if isinstance(e, AssertionError):
+            errorText = traceback.format_exc(limit=1)
+        else:
+            errorText = type(e).__name__
+    return errorText
+
+# Document-level part of the calculation. Expects material, drawing,
+# config_settings and forEachOperation.
+class DocumentCAM(object):
+    def makeMachineParams(self):
+        self.gcode_machine_params = gcodeops.MachineParams(safe_z=self.material.clearance, semi_safe_z=self.material.safe_entry_z,
+            min_rpm=geom.GeometrySettings.spindle_min_rpm, max_rpm=geom.GeometrySettings.spindle_max_rpm)
+    def largerDiameterForShape(self, shape, min_size):
+        candidates = []
+        for operation in self.forEachOperation(lambda operation: operation):
+            pda = PresetDerivedAttributes(operation)
+            diameter_plus = operation.cutter.diameter + 2 * pda.offset
+            if (operation.shape_id is shape.shape_id) and (diameter_plus > min_size):
+                candidates.append((diameter_plus, operation))
+        if not candidates:
+            return None, None, None
+        islands = None
+        candidates = list(sorted(candidates, key = lambda item: item[0]))
+        for diameter_plus, operation in candidates:
+            if operation.areIslandsEditable() and operation.islands:
+                islands = operation.islands
+                break
+        return candidates[0][0], candidates[0][1], islands
+    def checkCAMErrors(self):
+        return self.forEachOperation(lambda item: item.error)
+    def checkCAMWarnings(self):
+        return self.forEachOperation(lambda item: item.warning)
+    def validateForOutput(self):
+        def validateOperation(item):
+            if item.depth is None:
+                if self.material.thickness is None or self.material.thickness == 0:
+                    raise ValueError("Default material thickness not set")
+            if item.error is not None:
+                raise ValueError(item.error)
+        self.forEachOperation(validateOperation)
+
+# Operation-level part of the calculation. Expects the attributes of the
+# operation (including the preset-derived ones), document, orig_shape,
+# cam_input_hash, areIslandsEditable and addWarning.
+class OperationCAM(object):
+    # Inputs that affect only the layers, feeds and speeds, and not the shape
+    # of the toolpaths
+    z_stage_attrs = ('depth', 'start_depth', 'tab_height', 'rpm', 'hfeed', 'vfeed', 'doc')
+    # Settings that don't affect the calculation, only how it's done or how
+    # the G-code is written
+    unhashed_settings = ('worker_processes', 'parallel_gcode', 'geometry_cache', 'cam_cache_dir', 'cam_cache_size',
+        'grbl_output', 'canned_cycles', 'gcode_subroutines', 'reorder_cuts', 'gcode_inches', 'spindle_control', 'spindle_warmup')
+    def inputHash(self):
+        # Everything the toolpaths depend on, in a form that is stable between
+        # calls as long as the effective values stay the same. Returns a pair
+        # of hashes: toolpath shape (XY) inputs and layer/feed (Z) inputs.
+        pda = PresetDerivedAttributes(self)
+        cs = self.document.config_settings
+        settings = {k: v for k, v in vars(geom.GeometrySettings).items() if not k.startswith('_') and k not in self.unhashed_settings}
+        # Preset and per-operation overrides only matter through the values they resolve to
+        attrs = PresetDerivedAttributes.attrs[self.cutter.__class__]
+        dump = {k: v for k, v in self.store().items() if k not in attrs and k not in ('cutter', 'tool_preset') and k not in self.z_stage_attrs}
+        # Object IDs are assigned on load, they can't be used in the hashes kept on disk
+        cutter = {k: v for k, v in self.cutter.store().items() if k not in ('id', 'name')}
+        values = {name: getattr(pda, name) for name in attrs}
+        z_inputs = [{k: getattr(self, k) for k in self.z_stage_attrs if k not in attrs},
+            {k: v for k, v in values.items() if k in self.z_stage_attrs},
+            self.document.material.store(), vars(self.document.gcode_machine_params)]
+        # Toolpaths are calculated in drawing coordinates, the translation only
+        # matters for things placed in the work coordinates
+        translation = self.document.drawing.translation() if self.user_tabs or self.entry_exit else None
+        inputs = [dump, cutter, translation,
+            {k: v for k, v in values.items() if k not in self.z_stage_attrs},
+            (cs.min_tabs, cs.max_tabs, cs.tab_dist, cs.tab_min_length), settings]
+        shape_ids = [self.shape_id] + list(sorted(self.islands))
+        if self.operation == OperationType.REFINE and self.orig_shape:
+            # Refine operations also depend on the operation being refined
+            diameter_plus = self.cutter.diameter + 2 * pda.offset
+            prev_diameter, prev_operation, islands = self.document.largerDiameterForShape(self.orig_shape, diameter_plus)
+            inputs.append((prev_diameter, prev_operation.operation if prev_operation else None))
+            shape_ids += list(sorted(islands or []))
+        for shape_id in shape_ids:
+            item = self.document.drawing.itemById(shape_id) if shape_id is not None else None
+            inputs.append(item.store() if item is not None else None)
+        inputs += [item.store() for item in self.patternShapes()]
+        return tuple(hashlib.sha1(json.dumps(i, sort_keys=True, default=repr).encode()).hexdigest() for i in (inputs, z_inputs))
+    # Returns the Operations method to call and its arguments, as a tuple of (name, args, kwargs)
+    def operationCall(self, shape, pda):
+        dx, dy = self.document.drawing.translation()
+        # Tabs and entry/exit points are in work coordinates
+        entry_exit = [(s.translated(-dx, -dy), e.translated(-dx, -dy)) for s, e in self.entry_exit]
+        if len(self.user_tabs):
+            tabs = set(pt.translated(-dx, -dy) for pt in self.user_tabs)
+        else:
+            cs = self.document.config_settings
+            tabs = self.tab_count if self.tab_count is not None else shape.default_tab_count(cs.min_tabs, cs.max_tabs, cs.tab_dist, cs.tab_min_length)
+        if self.operation == OperationType.OUTSIDE_CONTOUR:
+            if pda.trc_rate:
+                return ('outside_contour_trochoidal', (shape, pda.extra_width / 100.0, pda.trc_rate / 100.0), {'tabs': tabs, 'entry_exit': entry_exit})
+            else:
+                return ('outside_contour', (shape,), {'tabs': tabs, 'widen': pda.extra_width / 50.0, 'entry_exit': entry_exit})
+        elif self.operation == OperationType.INSIDE_CONTOUR:
+            if pda.trc_rate:
+                return ('inside_contour_trochoidal', (shape, pda.extra_width / 100.0, pda.trc_rate / 100.0), {'tabs': tabs, 'entry_exit': entry_exit})
+            else:
+                return ('inside_contour', (shape,), {'tabs': tabs, 'widen': pda.extra_width / 50.0, 'entry_exit': entry_exit})
+        elif self.operation == self.operation == OperationType.REFINE and self.shape_to_refine is not None:
+            assert pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG
+            if self.is_external:
+                if isinstance(self.shape_to_refine, dict):
+                    return ('outside_peel_hsm', (shape,), {'shape_to_refine': self.shape_to_refine.get(shape, None)})
+                else:
+                    return ('outside_peel_hsm', (shape,), {'shape_to_refine': self.shape_to_refine})
+            else:
+                if isinstance(self.shape_to_refine, dict):
+                    return ('pocket_hsm', (shape,), {'shape_to_refine': self.shape_to_refine.get(shape, None)})
+                else:
+                    return ('pocket_hsm', (shape,), {'shape_to_refine': self.shape_to_refine})
+        elif self.operation == OperationType.POCKET or self.operation == OperationType.REFINE:
+            if pda.pocket_strategy == inventory.PocketStrategy.CONTOUR_PARALLEL:
+                return ('pocket', (shape,), {})
+            elif pda.pocket_strategy == inventory.PocketStrategy.AXIS_PARALLEL or pda.pocket_strategy == inventory.PocketStrategy.AXIS_PARALLEL_ZIGZAG:
+                return ('face_mill', (shape,), {})
+            elif pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG:
+                return ('pocket_hsm', (shape,), {})
+        elif self.operation == OperationType.OUTSIDE_PEEL:
+            if pda.pocket_strategy == inventory.PocketStrategy.CONTOUR_PARALLEL:
+                return ('outside_peel', (shape,), {})
+            elif pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG:
+                return ('outside_peel_hsm', (shape,), {})
+            else:
+                raise ValueError("Strategy not supported for outside cuts")
+        elif self.operation == OperationType.ENGRAVE:
+            return ('engrave', (shape,), {})
+        elif self.operation == OperationType.INTERPOLATED_HOLE:
+            if self.pattern:
+                return ('helical_drill_pattern', (self.patternCentres(), 2 * self.orig_shape.r), {})
+            return ('helical_drill', (self.orig_shape.centre.x, self.orig_shape.centre.y, 2 * self.orig_shape.r), {})
+        elif self.operation == OperationType.DRILLED_HOLE:
+            if self.pattern:
+                return ('peck_drill_pattern', (self.patternCentres(),), {})
+            return ('peck_drill', (self.orig_shape.centre.x, self.orig_shape.centre.y), {})
+        raise ValueError("Unsupported operation")
+    # The other circles of a hole pattern, the ones deleted from the drawing
+    # are skipped
+    def patternShapes(self):
+        if not self.pattern:
+            return []
+        return [item for item in self.document.drawing.itemsById(sorted(self.pattern)) if item is not None]
+    # Centres of all the holes of a hole pattern, starting with the operation's
+    # own circle
+    def patternCentres(self):
+        centres = [(self.orig_shape.centre.x, self.orig_shape.centre.y)]
+        for item in self.patternShapes():
+            if not hasattr(item, 'r') or abs(item.r - self.orig_shape.r) > 0.001:
+                raise ValueError("All holes of the pattern must be circles of the same diameter")
+            centres.append((item.centre.x, item.centre.y))
+        return centres
+    def shapeToRefine(self, shape, previous, is_external):
+        from DerpCAM.cam import pocket
+        if is_external:
+            return pocket.shape_to_refine_external(shape, previous)
+        else:
+            return pocket.shape_to_refine_internal(shape, previous)
+    def refineShape(self, shape, previous, current, min_entry_dia, is_external):
+        from DerpCAM.cam import pocket
+        if is_external:
+            return pocket.refine_shape_external(shape, previous, current, min_entry_dia)
+        else:
+            return pocket.refine_shape_internal(shape, previous, current, min_entry_dia)
+    # The shapes are in drawing coordinates, the translation to work coordinates
+    # is applied at the preview and G-code output stage
+    def createShapeObject(self):
+        self.shape = self.orig_shape.toShape()
+        if not isinstance(self.shape, list) and self.operation in (OperationType.POCKET, OperationType.OUTSIDE_PEEL):
+            extra_shapes = []
+            for island in self.islands:
+                item = self.document.drawing.itemById(island).toShape()
+                if isinstance(item, list):
+                    for i in item:
+                        self.shape.add_island(i.boundary)
+                        if i.islands:
+                            extra_shapes += [shapes.Shape(j, True) for j in i.islands]
+                elif item.closed:
+                    self.shape.add_island(item.boundary)
+                    if item.islands:
+                        extra_shapes += [shapes.Shape(j, True) for j in item.islands]
+            if extra_shapes:
+                self.shape = [self.shape] + extra_shapes
+    def addDogbonesToIslands(self, shape, tool):
+        new_islands = []
+        for i in shape.islands:
+            new_shapes = cam.dogbone.add_dogbones(shapes.Shape(i, True), tool, True, self.dogbones, False)
+            if isinstance(new_shapes, list):
+                new_islands += [j.boundary for j in new_shapes]
+            else:
+                new_islands.append(new_shapes.boundary)
+        shape.islands = new_islands
+    # Checks the inputs and sets up the tool and the depths, returns the
+    # effective values of the preset-derived attributes and the tool
+    def prepareCAM(self):
+        errors = []
+        thickness = self.document.material.thickness
+        depth = self.depth if self.depth is not None else thickness
+        if depth is None or depth == 0:
+            raise ValueError("Neither material thickness nor cut depth is set")
+        start_depth = self.start_depth if self.start_depth is not None else 0
+        if self.cutter.length and depth > self.cutter.length:
+            self.addWarning(f"Cut depth ({depth:0.1f} mm) greater than usable flute length ({self.cutter.length:0.1f} mm)")
+        # Only checking for end mills because most drill bits have a V tip and may require going slightly past
+        if thickness and isinstance(self.cutter, inventory.EndMillCutter) and depth > thickness:
+            self.addWarning(f"Cut depth ({depth:0.1f} mm) greater than material thickness ({thickness:0.1f} mm)")
+        if self.operation == OperationType.DRILLED_HOLE and self.cutter.diameter > 2 * self.orig_shape.r + 0.01:
+            self.addWarning(f"Cutter diameter ({self.cutter.diameter:0.1f} mm) greater than hole diameter ({2 * self.orig_shape.r:0.1f} mm)")
+        tab_depth = max(start_depth, depth - self.tab_height) if self.tab_height is not None else start_depth
+
+        pda = PresetDerivedAttributes(self, addError=lambda error: errors.append(error))
+        pda.validate(errors)
+        if errors:
+            raise ValueError("\n".join(errors))
+        if pda.rpm is not None:
+            mp = self.document.gcode_machine_params
+            if mp.min_rpm is not None and pda.rpm < mp.min_rpm:
+                self.addWarning(f"Spindle speed {pda.rpm:1f} lower than the minimum of {mp.min_rpm:1f}")
+            if mp.max_rpm is not None and pda.rpm > mp.max_rpm:
+                self.addWarning(f"Spindle speed {pda.rpm:1f} higher than the maximum of {mp.max_rpm:1f}")
+
+        if isinstance(self.cutter, inventory.EndMillCutter):
+            tool = milling_tool.Tool(self.cutter.diameter, pda.hfeed, pda.vfeed, pda.doc, stepover=pda.stepover / 100.0, climb=(pda.direction == inventory.MillDirection.CLIMB), min_helix_ratio=pda.eh_diameter / 100.0)
+            zigzag = pda.pocket_strategy in (inventory.PocketStrategy.HSM_PEEL_ZIGZAG, inventory.PocketStrategy.AXIS_PARALLEL_ZIGZAG, )
+            self.gcode_props = gcodeops.OperationProps(-depth, -start_depth, -tab_depth, pda.offset, zigzag, pda.axis_angle * math.pi / 180, pda.roughing_offset, pda.entry_mode != inventory.EntryMode.PREFER_RAMP, simplify_tolerance=self.simplify_tolerance)
+        else:
+            tool = milling_tool.Tool(self.cutter.diameter, 0, pda.vfeed, pda.doc)
+            self.gcode_props = gcodeops.OperationProps(-depth, -start_depth, -tab_depth, 0)
+        self.gcode_props.rpm = pda.rpm
+        return pda, tool
+    # Shapes to calculate the toolpaths for, with dogbones added and the
+    # refined areas worked out
+    def createShapes(self, pda, tool):
+        if self.orig_shape:
+            self.createShapeObject()
+        else:
+            self.shape = None
+        if self.dogbones and self.operation == OperationType.OUTSIDE_PEEL and not isinstance(self.shape, list):
+            self.addDogbonesToIslands(self.shape, tool)
+        if self.dogbones and self.operation not in (OperationType.ENGRAVE, OperationType.DRILLED_HOLE, OperationType.INTERPOLATED_HOLE, OperationType.OUTSIDE_PEEL):
+            is_outside = self.operation == OperationType.OUTSIDE_CONTOUR
+            is_refine = self.operation == OperationType.REFINE
+            is_pocket = self.operation == OperationType.POCKET
+            if isinstance(self.shape, list):
+                res = []
+                for i in self.shape:
+                    res.append(cam.dogbone.add_dogbones(i, tool, is_outside, self.dogbones, is_refine))
+                if is_pocket:
+                    for i in res:
+                        self.addDogbonesToIslands(self.shape, tool)
+                self.shape = res
+            else:
+                self.shape = cam.dogbone.add_dogbones(self.shape, tool, is_outside, self.dogbones, is_refine)
+                if is_pocket:
+                    self.addDogbonesToIslands(self.shape, tool)
+        if self.operation == OperationType.REFINE:
+            diameter_plus = self.cutter.diameter + 2 * pda.offset
+            prev_diameter, prev_operation, islands = self.document.largerDiameterForShape(self.orig_shape, diameter_plus)
+            self.prev_diameter = prev_diameter
+            if prev_diameter is None:
+                if pda.offset:
+                    raise ValueError(f"No matching milling operation to refine with cutter diameter {Format.cutter_dia(self.cutter.diameter)} and offset {Format.coord(pda.offset)}")
+                else:
+                    raise ValueError(f"No matching milling operation to refine with cutter diameter {Format.cutter_dia(self.cutter.diameter)}")
+            is_hsm = pda.pocket_strategy in (inventory.PocketStrategy.HSM_PEEL, inventory.PocketStrategy.HSM_PEEL_ZIGZAG)
+            if prev_operation.operation == OperationType.OUTSIDE_PEEL:
+                # Make up a list of shapes from shape's islands?
+                raise ValueError("Refining outside peel operations is not supported yet")
+            self.is_external = (prev_operation.operation == OperationType.OUTSIDE_CONTOUR)
+            self.shape_to_refine = None
+            if islands and not isinstance(self.shape, list):
+                for island in islands:
+                    item = self.document.drawing.itemById(island).toShape()
+                    if item.closed:
+                        self.shape.add_island(item.boundary)
+            if is_hsm:
+                if isinstance(self.shape, list):
+                    self.shape_to_refine = { i : self.shapeToRefine(i, prev_diameter, self.is_external) for i in self.shape }
+                else:
+                    self.shape_to_refine = self.shapeToRefine(self.shape, prev_diameter, self.is_external)
+            elif isinstance(self.shape, list):
+                res = []
+                for i in self.shape:
+                    res += self.refineShape(i, prev_diameter, diameter_plus, tool.min_helix_diameter, self.is_external)
+                self.shape = res
+            else:
+                self.shape = self.refineShape(self.shape, prev_diameter, diameter_plus, tool.min_helix_diameter, self.is_external)
+        else:
+            self.prev_diameter = None
+        if isinstance(self.shape, list) and len(self.shape) == 1:
+            self.shape = self.shape[0]
+    def operationCalls(self, pda):
+        if not self.shape:
+            return []
+        calls = [self.operationCall(shape, pda) for shape in (self.shape if isinstance(self.shape, list) else [self.shape])]
+        return [call for call in calls if call is not None]
+    def updateZStage(self, prev_cam, tool):
+        try:
+            self.cam = prev_cam.with_z_params(self.document.gcode_machine_params, tool, self.gcode_props, self.document.material.thickness)
+        except gcodegen.ToolpathsNotAvailable:
+            # Needs calculating toolpaths for new tab layers
+            return False
+        if self.cam.is_nothing():
+            self.addWarning("No cuts produced")
+        return True
+    # The toolpaths are cached on disk by the hash of the XY inputs, the layers
+    # are recalculated as when only the depths have changed
+    def loadCachedCAM(self, pda, tool):
+        cache = diskcache.get_toolpath_cache()
+        if cache is None or self.cam_input_hash is None:
+            return False
+        cached_cam = cache.load(self.cam_input_hash[0])
+        if not isinstance(cached_cam, gcodeops.Operations):
+            return False
+        if self.operation == OperationType.REFINE:
+            diameter_plus = self.cutter.diameter + 2 * pda.offset
+            self.prev_diameter = self.document.largerDiameterForShape(self.orig_shape, diameter_plus)[0]
+        return self.updateZStage(cached_cam, tool)
+    def storeCachedCAM(self):
+        cache = diskcache.get_toolpath_cache()
+        if cache is not None and self.cam is not None and self.cam_input_hash is not None:
+            cache.store(self.cam_input_hash[0], self.cam)
+
+class OpExporter(object):
+    def __init__(self, document):
+        document.waitForUpdateCAM()
+        self.machine_params = document.gcode_machine_params
+        self.operations = gcodeops.Operations(document.gcode_machine_params)
+        self.operations.translation = document.drawing.translation()
+        self.all_cutters = set([])
+        self.cutter = None
+        document.forEachOperation(self.add_cutter)
+        document.forEachOperation(self.process_operation)
+    def add_cutter(self, item):
+        if item.cam:
+            self.all_cutters.add(item.cutter)
+    def process_operation(self, item):
+        if item.cam:
+            if item.cutter != self.cutter and len(self.all_cutters) > 1:
+                self.operations.add(gcodeops.ToolChangeOperation(item.cutter, self.machine_params))
+                self.cutter = item.cutter
+            self.operations.add_all(item.cam.operations)
+    def write(self, fn):
+        self.operations.to_gcode_file(fn)
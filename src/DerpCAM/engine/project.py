@@ -0,0 +1,328 @@
+import json
+
+from DerpCAM.common import geom
+from DerpCAM.cam import gcodeops, milling_tool, ptext, shapes
+from DerpCAM.cam.dogbone import DogboneMode
+from DerpCAM.cam.ptext import DrawingTextStyle
+from DerpCAM.gui import inventory
+
+from .operation import MaterialType, OperationType, PresetDerivedAttributes, workerExceptionText, \
+    DocumentCAM, OperationCAM, OpExporter
+
+# Project files loaded straight into the CAM layer, without PyQt5. Used for
+# converting projects to G-code without a GUI. The stored form of every
+# object is the same as in the GUI's document model, so that the hashes of the
+# inputs (and the toolpaths cached on disk) are shared with the GUI.
+
+class Workpiece(object):
+    def __init__(self, document):
+        self.material = None
+        self.thickness = None
+        self.clearance = document.config_settings.clearance_z
+        self.safe_entry_z = document.config_settings.safe_entry_z
+    def store(self):
+        return { '_type' : 'WorkpieceTreeItem', 'material' : self.material, 'thickness' : self.thickness,
+            'clearance' : self.clearance, 'safe_entry_z' : self.safe_entry_z }
+    def reload(self, dump):
+        for name in ('material', 'thickness', 'clearance', 'safe_entry_z'):
+            if name in dump:
+                setattr(self, name, dump[name])
+
+class DrawingItem(object):
+    def __init__(self, shape_id):
+        self.shape_id = shape_id
+    def store(self):
+        return { '_type' : self.type_name, 'shape_id' : self.shape_id }
+    @staticmethod
+    def load(dump):
+        rtype = dump['_type']
+        if rtype == 'DrawingPolyline' or rtype == 'DrawingPolylineTreeItem':
+            points = [geom.PathNode.from_tuple(i) for i in dump['points']]
+            return DrawingPolyline(dump['shape_id'], points, dump.get('closed', True))
+        elif rtype == 'DrawingCircle' or rtype == 'DrawingCircleTreeItem':
+            return DrawingCircle(dump['shape_id'], geom.PathPoint(dump['cx'], dump['cy']), dump['r'])
+        elif rtype == 'DrawingTextTreeItem':
+            return DrawingText(dump['shape_id'], geom.PathPoint(dump['x'], dump['y']), dump.get('target_width', None),
+                DrawingTextStyle(dump['height'], dump['width'], dump['halign'], dump['valign'], dump['angle'], dump['font'], dump.get('spacing', 0)), dump['text'])
+        else:
+            raise ValueError("Unexpected type: %s" % rtype)
+
+class DrawingCircle(DrawingItem):
+    type_name = 'DrawingCircleTreeItem'
+    def __init__(self, shape_id, centre, r):
+        DrawingItem.__init__(self, shape_id)
+        self.centre = centre
+        self.r = r
+    def store(self):
+        res = DrawingItem.store(self)
+        res['cx'] = self.centre.x
+        res['cy'] = self.centre.y
+        res['r'] = self.r
+        return res
+    def toShape(self):
+        return shapes.Shape.circle(self.centre.x, self.centre.y, self.r)
+
+class DrawingPolyline(DrawingItem):
+    type_name = 'DrawingPolylineTreeItem'
+    def __init__(self, shape_id, points, closed):
+        DrawingItem.__init__(self, shape_id)
+        self.points = points
+        self.closed = closed
+    def store(self):
+        res = DrawingItem.store(self)
+        res['points'] = [ i.as_tuple() for i in self.points ]
+        res['closed'] = self.closed
+        return res
+    def toShape(self):
+        return shapes.Shape(geom.CircleFitter.interpolate_arcs(self.points, False, 1.0), self.closed)
+
+class DrawingText(DrawingItem):
+    type_name = 'DrawingTextTreeItem'
+    def __init__(self, shape_id, origin, target_width, style, text):
+        DrawingItem.__init__(self, shape_id)
+        self.origin = origin
+        self.target_width = target_width
+        self.style = style
+        self.text = text
+        self.closed = True
+        self.paths = ptext.text_to_paths(self.origin, self.target_width, self.style, self.text)
+    def store(self):
+        return { '_type' : self.type_name, 'shape_id' : self.shape_id,
+            'text' : self.text, 'x' : self.origin.x, 'y' : self.origin.y,
+            'target_width' : self.target_width,
+            'height' : self.style.height, 'width' : self.style.width,
+            'halign' : self.style.halign, 'valign' : self.style.valign,
+            'angle' : self.style.angle,
+            'font' : self.style.font_name, 'spacing' : self.style.spacing}
+    def toShape(self):
+        return ptext.paths_to_shapes(self.paths)
+
+class Drawing(object):
+    def __init__(self):
+        self.x_offset = 0
+        self.y_offset = 0
+        self.items = {}
+    def store(self):
+        return { '_type' : 'DrawingTreeItem', 'x_offset' : self.x_offset, 'y_offset' : self.y_offset }
+    def reload(self, dump):
+        self.x_offset = dump.get('x_offset', 0)
+        self.y_offset = dump.get('y_offset', 0)
+    def addItem(self, item):
+        self.items[item.shape_id] = item
+    def itemById(self, shape_id):
+        return self.items.get(shape_id)
+    def itemsById(self, shape_ids):
+        return [self.items.get(shape_id) for shape_id in shape_ids]
+    def translation(self):
+        return (-self.x_offset, -self.y_offset)
+
+class ProjectOperation(OperationCAM):
+    # Attributes saved in the project file, in the same order as the
+    # properties of the GUI's operation item
+    stored_attrs = ['operation', 'cutter', 'tool_preset', 'depth', 'start_depth',
+        'tab_height', 'tab_count', 'user_tabs', 'entry_exit', 'dogbones', 'extra_width',
+        'islands', 'pattern', 'pocket_strategy', 'axis_angle', 'direction', 'doc', 'hfeed', 'vfeed',
+        'offset', 'roughing_offset', 'stepover', 'eh_diameter', 'entry_mode', 'trc_rate', 'rpm', 'simplify_tolerance']
+    def __init__(self, document):
+        self.document = document
+        self.active = True
+        self.cutter = None
+        self.tool_preset = None
+        self.operation = OperationType.OUTSIDE_CONTOUR
+        self.depth = None
+        self.start_depth = 0
+        self.tab_height = None
+        self.tab_count = None
+        self.simplify_tolerance = None
+        self.islands = set()
+        # Other circles drilled by the same hole operation
+        self.pattern = set()
+        self.dogbones = DogboneMode.DISABLED
+        self.user_tabs = set()
+        self.entry_exit = []
+        for attr in PresetDerivedAttributes.attrs_all:
+            setattr(self, attr.name, None)
+        self.shape_id = None
+        self.orig_shape = None
+        self.shape = None
+        self.shape_to_refine = None
+        self.prev_diameter = None
+        self.cam = None
+        self.cam_input_hash = None
+        self.error = None
+        self.warning = None
+    def reload(self, dump):
+        if dump['_type'] != 'OperationTreeItem':
+            raise ValueError("Unexpected type: %s" % dump['_type'])
+        for name in self.stored_attrs:
+            if name in dump:
+                setattr(self, name, dump[name])
+        self.shape_id = dump.get('shape_id', None)
+        self.islands = set(dump.get('islands', []))
+        self.pattern = set(dump.get('pattern', []))
+        self.user_tabs = set(geom.PathPoint(i[0], i[1]) for i in dump.get('user_tabs', []))
+        self.entry_exit = [(geom.PathPoint(i[0][0], i[0][1]), geom.PathPoint(i[1][0], i[1][1])) for i in dump.get('entry_exit', [])]
+        self.active = dump.get('active', True)
+    def store(self):
+        dump = { '_type' : 'OperationTreeItem' }
+        for name in self.stored_attrs:
+            dump[name] = getattr(self, name)
+        dump['active'] = self.active
+        dump['shape_id'] = self.shape_id
+        dump['islands'] = list(sorted(self.islands))
+        dump['pattern'] = list(sorted(self.pattern))
+        dump['user_tabs'] = list(sorted([(pt.x, pt.y) for pt in self.user_tabs]))
+        dump['entry_exit'] = [[(pts[0].x, pts[0].y), (pts[1].x, pts[1].y)] for pts in self.entry_exit]
+        dump['cutter'] = self.cutter.id
+        dump['tool_preset'] = self.tool_preset.id if self.tool_preset else None
+        return dump
+    def areIslandsEditable(self):
+        if self.operation not in (OperationType.POCKET, OperationType.OUTSIDE_PEEL):
+            return False
+        return not isinstance(self.orig_shape, DrawingText)
+    def addWarning(self, warning):
+        self.warning = warning if self.warning is None else self.warning + "\n" + warning
+    def updateOrigShape(self):
+        self.orig_shape = self.document.drawing.itemById(self.shape_id) if self.shape_id is not None else None
+    # Sets up the calculation, returns the Operations calls still to be made
+    # (the toolpaths might have been found in the cache)
+    def startUpdateCAM(self):
+        self.error = None
+        self.warning = None
+        self.cam = None
+        self.cam_input_hash = None
+        self.updateOrigShape()
+        if not self.cutter:
+            self.error = "Cutter not set"
+            return []
+        if not self.active:
+            return []
+        try:
+            self.cam_input_hash = self.inputHash()
+            pda, tool = self.prepareCAM()
+            if self.loadCachedCAM(pda, tool):
+                return []
+            self.createShapes(pda, tool)
+            self.cam = gcodeops.Operations(self.document.gcode_machine_params, tool, self.gcode_props, self.document.material.thickness)
+            return self.operationCalls(pda)
+        except ValueError as e:
+            self.cam = None
+            self.error = str(e)
+            return []
+
+class ToolCycle(object):
+    def __init__(self, cutter):
+        self.cutter = cutter
+        self.operations = []
+
+class Project(DocumentCAM):
+    def __init__(self, config_settings):
+        self.config_settings = config_settings
+        self.material = Workpiece(self)
+        self.makeMachineParams()
+        self.drawing = Drawing()
+        self.cycles = []
+        self.filename = None
+    def forEachOperation(self, func):
+        return [func(operation) for cycle in self.cycles for operation in cycle.operations]
+    def loadOperation(self, dump):
+        operation = ProjectOperation(self)
+        operation.reload(dump)
+        return operation
+    def load(self, data):
+        self.material.reload(data['material'])
+        self.makeMachineParams()
+        cycleForCutter = {}
+        if 'tool' in data:
+            # Old style singleton tool
+            material = MaterialType.toTuple(self.material.material)[2] if self.material.material is not None else milling_tool.material_plastics
+            tool = data['tool']
+            prj_cutter = inventory.EndMillCutter.new(None, "Project tool", inventory.CutterMaterial.carbide, tool['diameter'], tool['cel'], tool['flutes'])
+            std_tool = milling_tool.standard_tool(prj_cutter.diameter, prj_cutter.flutes, material, milling_tool.carbide_uncoated).clone_with_overrides(
+                hfeed=tool['hfeed'], vfeed=tool['vfeed'], maxdoc=tool['depth'], rpm=tool['rpm'], stepover=tool.get('stepover', None))
+            prj_preset = inventory.EndMillPreset.new(None, "Project preset", prj_cutter,
+                std_tool.rpm, std_tool.hfeed, std_tool.vfeed, std_tool.maxdoc, 0, std_tool.stepover,
+                tool.get('direction', 0), 0, 0, None, 0, 0.5, inventory.EntryMode.PREFER_RAMP, 0)
+            prj_cutter.presets.append(prj_preset)
+            self.cycles.append(ToolCycle(prj_cutter))
+        add_cycles = 'operation_cycles' not in data
+        if 'tools' in data:
+            cutters = [inventory.CutterBase.load(i, default_type='EndMillCutter') for i in data['tools']]
+            presets = [inventory.PresetBase.load(i, default_type='EndMillPreset') for i in data['tool_presets']]
+            cutter_map = { i.orig_id : i for i in cutters }
+            preset_map = { i.orig_id : i for i in presets }
+            if add_cycles:
+                for cutter in cutters:
+                    cycleForCutter[cutter.orig_id] = ToolCycle(cutter)
+                    self.cycles.append(cycleForCutter[cutter.orig_id])
+            # Fixup cutter references (they're initially loaded as ints instead)
+            for i in presets:
+                i.toolbit = cutter_map[i.toolbit]
+                i.toolbit.presets.append(i)
+        self.drawing.reload(data['drawing']['header'])
+        for i in data['drawing']['items']:
+            self.drawing.addItem(DrawingItem.load(i))
+        if 'operations' in data:
+            for i in data['operations']:
+                operation = self.loadOperation(i)
+                if ('cutter' not in i) and ('tool' in data):
+                    cycle = self.cycles[0]
+                    operation.cutter = prj_cutter
+                    operation.tool_preset = prj_preset
+                else:
+                    cycle = cycleForCutter[operation.cutter]
+                    operation.cutter = cutter_map[operation.cutter]
+                    operation.tool_preset = preset_map[operation.tool_preset] if operation.tool_preset else None
+                operation.updateOrigShape()
+                if operation.orig_shape is None:
+                    print ("Warning: dangling reference to shape %d, ignoring the referencing operation" % (operation.shape_id, ))
+                else:
+                    cycle.operations.append(operation)
+        elif 'operation_cycles' in data:
+            for i in data['operation_cycles']:
+                cycle = ToolCycle(cutter_map[i['tool_id']])
+                self.cycles.append(cycle)
+                for j in i['operations']:
+                    operation = self.loadOperation(j)
+                    operation.cutter = cutter_map[operation.cutter]
+                    operation.tool_preset = preset_map[operation.tool_preset] if operation.tool_preset else None
+                    cycle.operations.append(operation)
+    def loadProject(self, fn):
+        with open(fn, "r") as f:
+            data = json.load(f)
+        self.filename = fn
+        self.load(data)
+    # Calculates the toolpaths of all the operations. Same as the GUI, the
+    # parallel parts run in the worker process pool if one is configured.
+    def waitForUpdateCAM(self):
+        pool = geom.get_worker_pool()
+        work = []
+        for operation in self.forEachOperation(lambda operation: operation):
+            for method, args, kwargs in operation.startUpdateCAM():
+                if pool is not None:
+                    cam = operation.cam
+                    work.append((operation, geom.submit_calculation(pool, gcodeops.calculate_operations, cam.machine_params, cam.tool, cam.props, cam.thickness, method, args, kwargs)))
+                else:
+                    work.append((operation, (method, args, kwargs)))
+        calculated = {}
+        for operation, job in work:
+            calculated[id(operation)] = operation
+            if operation.cam is None:
+                continue
+            try:
+                if pool is not None:
+                    operation.cam.add_all(job.result())
+                else:
+                    method, args, kwargs = job
+                    getattr(operation.cam, method)(*args, **kwargs)
+            except Exception as e:
+                operation.cam = None
+                operation.error = workerExceptionText(e)
+        for operation in calculated.values():
+            if operation.cam is not None:
+                if operation.cam.is_nothing():
+                    operation.addWarning("No cuts produced")
+                operation.storeCachedCAM()
+        return True
+    def exportGcode(self, fn):
+        OpExporter(self).write(fn)
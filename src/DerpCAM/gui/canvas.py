@@ -20,12 +20,17 @@ class DocumentRenderer(object):
                     owner.mode_item.renderer.renderToolpaths(owner, alpha_scale = 0.25)
             self.document.drawing.renderTo(owner, owner.editor)
             if owner.editor is None:
-                self.document.forEachOperation(lambda item: item.renderer.renderToolpaths(owner) if item.renderer else None)
-                self.lastpt = PathPoint(0, 0)
-                self.document.forEachOperation(lambda item: self.renderRapids(item.renderer, owner) if item.renderer else None)
-                if dist(self.lastpt, PathPoint(0, 0)) > 0:
-                    pen = QPen(QColor(255, 0, 0), 0)
-                    owner.addRapidLine(pen, self.lastpt, PathPoint(0, 0))
+                # Toolpaths are in drawing coordinates
+                dx, dy = self.document.drawing.translation()
+                with owner.translatedDrawing(dx, dy):
+                    self.document.forEachOperation(lambda item: item.renderer.renderToolpaths(owner) if item.renderer else None)
+                    # Work coordinate origin
+                    origin = PathPoint(-dx, -dy)
+                    self.lastpt = origin
+                    self.document.forEachOperation(lambda item: self.renderRapids(item.renderer, owner) if item.renderer else None)
+                    if dist(self.lastpt, origin) > 0:
+                        pen = QPen(QColor(255, 0, 0), 0)
+                        owner.addRapidLine(pen, self.lastpt, origin)
     def renderRapids(self, renderer, owner):
         self.lastpt = renderer.renderRapids(owner, self.lastpt)
 
@@ -158,6 +163,11 @@ class DrawingViewer(view.PathViewer):
             qp.setOpacity(0.33)
             qp.drawRect(self.rubberband_rect)
             qp.setOpacity(1.0)
+        # Used for deciding which operations to calculate first
+        size = self.size()
+        topLeft = self.unproject(QPointF(0, 0))
+        bottomRight = self.unproject(QPointF(size.width(), size.height()))
+        self.document.visible_bounds = (topLeft.x(), bottomRight.y(), bottomRight.x(), topLeft.y())
         if not self.document.progress_dialog_displayed:
             progress = self.document.pollForUpdateCAM()
             if progress is not None:
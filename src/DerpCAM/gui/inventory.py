@@ -1,5 +1,4 @@
-from .propsheet import EnumClass
-from DerpCAM.common.guiutils import Format, UnitConverter
+from DerpCAM.common.guiutils import EnumClass, Format, UnitConverter
 import os
 import json
 import sys
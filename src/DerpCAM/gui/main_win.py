@@ -113,14 +113,18 @@ class CAMMainWindow(QMainWindow):
             ("&Pocket", self.millPocket, QKeySequence("Ctrl+K"), "Mill a pocket"),
             ("&Engrave", self.millEngrave, QKeySequence("Ctrl+M"), "Follow a line without an offset"),
             ("Interpolated &hole", self.millInterpolatedHole, QKeySequence("Ctrl+H"), "Mill a circular hole wider than the endmill size using helical interpolation"),
+            ("Interpolated hole pa&ttern", self.millInterpolatedHolePattern, None, "Mill many circular holes using helical interpolation, with one operation for all holes of the same diameter"),
             ("Out&side peel", self.millOutsidePeel, QKeySequence("Shift+Ctrl+E"), "Create the part by side milling on the outside of the part"),
             ("&Refine", self.millRefine, QKeySequence("Shift+Ctrl+K"), "Mill finer details remaining from a cut with a larger diameter tool"),
             None,
             ("&Drilled hole", self.drillHole, QKeySequence("Ctrl+B"), "Drill a circular hole with a twist drill bit"),
+            ("Drilled hole patter&n", self.drillHolePattern, None, "Drill many circular holes with a twist drill bit, with one operation for all holes of the same diameter"),
         ])
         self.helpMenu = self.addMenu("&Help", [
             ("&About...", lambda: self.helpAbout(), None, "Display project information"),
         ])
+        self.camStatusLabel = QLabel("")
+        self.statusBar().addPermanentWidget(self.camStatusLabel)
         self.coordLabel = QLabel("")
         self.statusBar().addPermanentWidget(self.coordLabel)
         self.viewer.coordsUpdated.connect(self.canvasMouseMove)
@@ -167,6 +171,7 @@ class CAMMainWindow(QMainWindow):
         if (progress is not None and progress > 0) or (progress is None and self.lastProgress is not None):
             self.viewer.repaint()
         self.lastProgress = progress
+        self.updateCAMStatus()
         if self.refreshNeeded:
             self.viewer.majorUpdate(reset_zoom=self.resetZoomNeeded)
             self.resetZoomNeeded = False
@@ -175,6 +180,15 @@ class CAMMainWindow(QMainWindow):
             subset = list(self.newCAMNeeded)
             self.resetCAMNeeded()
             self.document.startUpdateCAM(subset)
+    def updateCAMStatus(self):
+        scheduler = self.document.scheduler
+        running = scheduler.runningCount()
+        queued = scheduler.queueDepth()
+        latency = scheduler.averageLatency()
+        text = f"Calculating: {running}, queued: {queued}" if running or queued else ""
+        if latency is not None:
+            text += (", " if text else "") + f"avg. time: {latency:0.2f} s"
+        self.camStatusLabel.setText(text)
     def resetCAMNeeded(self):
         self.newCAMNeeded = set()
     def scheduleCAMUpdate(self, item):
@@ -296,21 +310,23 @@ class CAMMainWindow(QMainWindow):
         polyline = model.DrawingPolylineTreeItem(self.document, [], False)
         self.document.opAddDrawingItems([polyline])
         self.switchToEditor(editors.CanvasNewPolylineEditor(polyline))
-    def millSelectedShapes(self, operType):
+    def millSelectedShapes(self, operType, pattern=False):
         selection = self.viewer.selection
         anyLeft = False
         shapeIds = []
         if not selection:
             QMessageBox.critical(self, None, "No objects selected")
             return
-        shapeIds, selectionsUsed, warningsList = self.document.drawing.parseSelection(selection, operType)
+        shapeIds, selectionsUsed, warningsList = self.document.drawing.parseSelection(selection, operType, pattern)
         warningsText = "\n".join(warningsList)
         if not shapeIds:
             QMessageBox.warning(self, None, f"None of the selected objects are suitable for the operation:\n{warningsText}")
             return
         if not self.needCutterType(model.cutterTypesForOperationType(operType)):
             return
-        shapeIds = canvas.sortSelections(selectionsUsed, shapeIds)
+        if not pattern:
+            # Hole patterns are sorted when calculating the toolpaths
+            shapeIds = canvas.sortSelections(selectionsUsed, shapeIds)
         for i in selectionsUsed:
             self.projectDW.shapeTree.selectionModel().select(i.index(), QItemSelectionModel.Deselect)
         rowCount, cycle, operations = self.document.opCreateOperation(shapeIds, operType)
@@ -347,10 +363,14 @@ class CAMMainWindow(QMainWindow):
         self.millSelectedShapes(OperationType.ENGRAVE)
     def millInterpolatedHole(self):
         self.millSelectedShapes(OperationType.INTERPOLATED_HOLE)
+    def millInterpolatedHolePattern(self):
+        self.millSelectedShapes(OperationType.INTERPOLATED_HOLE, pattern=True)
     def millRefine(self):
         self.millSelectedShapes(OperationType.REFINE)
     def drillHole(self):
         self.millSelectedShapes(OperationType.DRILLED_HOLE)
+    def drillHolePattern(self):
+        self.millSelectedShapes(OperationType.DRILLED_HOLE, pattern=True)
     def helpAbout(self):
         dlg = about.AboutDlg()
         dlg.initUI()
@@ -2,6 +2,9 @@ import os.path
 import math
 import sys
 import threading
+import collections
+import contextlib
+import itertools
 import time
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
@@ -13,14 +16,15 @@ from PyQt5.QtWidgets import *
 from DerpCAM.common import geom
 from DerpCAM.common.guiutils import Format, Spinner, is_gui_application
 from DerpCAM import cam
-from DerpCAM.cam import dogbone, gcodegen, gcodeops, shapes, milling_tool
-
+from DerpCAM.cam import dogbone, gcodegen, gcodeops, shapes, milling_tool, ptext
+from DerpCAM.cam.ptext import DrawingTextStyleHAlign, DrawingTextStyleVAlign, DrawingTextStyle
+from DerpCAM.engine.operation import MaterialType, OperationType, not_none, PresetDerivedAttributeItem, PresetDerivedAttributes, \
+    workerExceptionText, DocumentCAM, OperationCAM, OpExporter
 from . import canvas, inventory
 from .propsheet import EnumClass, IntEditableProperty, \
     FloatDistEditableProperty, EnumEditableProperty, SetEditableProperty, \
     RefEditableProperty, StringEditableProperty, FontEditableProperty
 
-import ezdxf
 import json
 
 debug_inventory_matching = False
@@ -155,7 +159,7 @@ class DrawingItemTreeItem(CAMTreeItem):
         return CAMTreeItem.data(self, role)
     def invalidatedObjects(self, aspect):
         if aspect == InvalidateAspect.CAM:
-            return set([self] + self.document.allOperations(lambda item: item.usesShape(self.shape_id)))
+            return set([self] + self.document.dependentOperations(self))
         # Settings of operations are not affected and don't need to be refreshed
         return set([self])
 
@@ -317,44 +321,6 @@ class DrawingPolylineTreeItem(DrawingItemTreeItem):
         else:
             return (self.points[0].seg_start(), self.points[-1].seg_end())
         
-class DrawingTextStyleHAlign(EnumClass):
-    LEFT = 0
-    CENTRE = 1
-    RIGHT = 2
-    ALIGNED = 3
-    MIDDLE = 4
-    FIT = 5
-    descriptions = [
-        (LEFT, "Left"),
-        (CENTRE, "Centre"),
-        (RIGHT, "Right"),
-        (ALIGNED, "Aligned"),
-        (MIDDLE, "Middle"),
-        (FIT, "Fit"),
-    ]
-
-class DrawingTextStyleVAlign(EnumClass):
-    BASELINE = 0
-    BOTTOM = 1
-    MIDDLE = 2
-    TOP = 3
-    descriptions = [
-        (BASELINE, "Baseline"),
-        (BOTTOM, "Bottom"),
-        (MIDDLE, "Middle"),
-        (TOP, "Top"),
-    ]
-
-class DrawingTextStyle(object):
-    def __init__(self, height, width, halign, valign, angle, font_name, spacing):
-        self.height = height
-        self.width = width
-        self.halign = halign
-        self.valign = valign
-        self.angle = angle
-        self.font_name = font_name
-        self.spacing = spacing
-
 class DrawingTextTreeItem(DrawingItemTreeItem):
     prop_x = FloatDistEditableProperty("Insert X", "x", Format.coord, unit="mm", allow_none=False)
     prop_y = FloatDistEditableProperty("Insert Y", "y", Format.coord, unit="mm", allow_none=False)
@@ -450,19 +416,7 @@ class DrawingTextTreeItem(DrawingItemTreeItem):
         tti.shape_id = self.shape_id
         return tti
     def toShape(self):
-        res = []
-        last_bounds = None
-        if self.paths:
-            for i, path in enumerate(sorted(self.paths, key=lambda path: path.bounds()[0])):
-                path_bounds = path.bounds()
-                if len(res) and geom.inside_bounds(path_bounds, last_bounds):
-                    res[-1].add_island(path.nodes)
-                else:
-                    shape = shapes.Shape(path.nodes, path.closed)
-                    last_bounds = path_bounds
-                    res.append(shape)
-        res = list(sorted(res, key=lambda item: item.bounds[0]))
-        return res
+        return ptext.paths_to_shapes(self.paths)
     def renderTo(self, path, editor):
         for i in self.paths:
             path.addLines(self.penForPath(path, editor), i.nodes, i.closed)
@@ -485,48 +439,7 @@ class DrawingTextTreeItem(DrawingItemTreeItem):
     def textDescription(self):
         return f"{self.label()}: {self.text}"
     def createPaths(self):
-        scale = geom.GeometrySettings.RESOLUTION
-        if self.style.height * scale > 100:
-            scale = 100 / self.style.height
-        if not isinstance(QCoreApplication.instance(), QGuiApplication):
-            raise Exception("Use --allow-text for converting files using text objects")
-        font = QFont(self.style.font_name, 1, 400, False)
-        font.setPointSizeF(self.style.height * scale)
-        font.setLetterSpacing(QFont.AbsoluteSpacing, self.style.spacing * scale)
-        metrics = QFontMetrics(font)
-        width = self.style.width
-        angle = -self.style.angle
-        twidth = metrics.horizontalAdvance(self.text) / scale * self.style.width
-        x, y = self.origin.x, self.origin.y
-        if self.style.halign == DrawingTextStyleHAlign.RIGHT:
-            x -= twidth
-        elif self.style.halign == DrawingTextStyleHAlign.CENTRE:
-            x -= twidth / 2
-        elif self.style.halign == DrawingTextStyleHAlign.ALIGNED:
-            if twidth and self.target_width:
-                font.setPointSizeF(self.style.height * (self.target_width / (width * twidth) * scale))
-                metrics = QFontMetrics(font)
-        elif self.style.halign == DrawingTextStyleHAlign.FIT:
-            if twidth and self.target_width:
-                width *= self.target_width / twidth
-        elif self.style.halign == DrawingTextStyleHAlign.MIDDLE:
-            x -= twidth / 2
-            # This is likely wrong, but I don't have a better idea
-            y -= metrics.capHeight() / 2 / scale
-        # For non-special H alignment values, use V alignment
-        if self.style.halign < DrawingTextStyleHAlign.ALIGNED:
-            if self.style.valign == DrawingTextStyleVAlign.BOTTOM:
-                y += metrics.descent() / scale
-            elif self.style.valign == DrawingTextStyleVAlign.MIDDLE:
-                y -= metrics.capHeight() / 2 / scale
-            elif self.style.valign == DrawingTextStyleVAlign.TOP:
-                y -= metrics.capHeight() / scale
-        ppath = QPainterPath()
-        ppath.addText(0, 0, font, self.text)
-        transform = QTransform().rotate(angle).scale(width, 1)
-        self.paths = []
-        for polygon in ppath.toSubpathPolygons(transform):
-            self.paths.append(geom.Path([geom.PathPoint(p.x() / scale + x, -p.y() / scale + y) for p in polygon], True))
+        self.paths = ptext.text_to_paths(self.origin, self.target_width, self.style, self.text)
         self.calcBounds()
     def startEndPos(self):
         if self.paths:
@@ -563,6 +476,7 @@ class DrawingTreeItem(CAMListTreeItem):
         margin = 5
         return (b[0] - self.x_offset - margin, b[1] - self.y_offset - margin, b[2] - self.x_offset + margin, b[3] - self.y_offset + margin)
     def importDrawing(self, name):
+        import ezdxf
         doc = ezdxf.readfile(name)
         msp = doc.modelspace()
         existing = {}
@@ -652,6 +566,14 @@ class DrawingTreeItem(CAMListTreeItem):
             for j in i.items():
                 if j.shape_id == shape_id:
                     return j
+    # Same as itemById for many items at once, e.g. the holes of a pattern
+    def itemsById(self, shape_ids):
+        found = {}
+        for i in self.items():
+            found[i.shape_id] = i
+            for j in i.items():
+                found.setdefault(j.shape_id, j)
+        return [found.get(shape_id) for shape_id in shape_ids]
     def objectsNear(self, pos, margin):
         xy = geom.PathPoint(pos.x() + self.x_offset, pos.y() + self.y_offset)
         found = []
@@ -676,7 +598,14 @@ class DrawingTreeItem(CAMListTreeItem):
             if geom.inside_bounds(item.bounds, bounds):
                 found.append(item)
         return found
-    def parseSelection(self, selection, operType):
+    # Groups the circles by diameter, for creating one hole operation per
+    # diameter. Returns {shape ID of the first circle: shape IDs of the others}.
+    def holePatterns(self, circles):
+        groups = {}
+        for i in circles:
+            groups.setdefault(round(i.r, 3), []).append(i.shape_id)
+        return {shape_ids[0]: set(shape_ids[1:]) for shape_ids in groups.values()}
+    def parseSelection(self, selection, operType, pattern=False):
         translation = self.translation()
         warnings = []
         def pickObjects(selector):
@@ -691,6 +620,8 @@ class DrawingTreeItem(CAMListTreeItem):
             return matched, warnings
         if operType == OperationType.INTERPOLATED_HOLE or operType == OperationType.DRILLED_HOLE:
             selection, warnings = pickObjects(lambda i: isinstance(i, DrawingCircleTreeItem) or "%s is not a circle")
+            if pattern:
+                return self.holePatterns(selection), selection, warnings
         elif operType != OperationType.ENGRAVE:
             selection, warnings = pickObjects(lambda i: isinstance(i, DrawingTextTreeItem) or i.toShape().closed or "%s is not a closed shape")
         if operType != OperationType.POCKET and operType != OperationType.OUTSIDE_PEEL:
@@ -742,7 +673,7 @@ class DrawingTreeItem(CAMListTreeItem):
         self.emitPropertyChanged(name)
     def invalidatedObjects(self, aspect):
         if aspect == InvalidateAspect.CAM:
-            return set([self] + self.document.allOperations())
+            return set([self] + self.document.dependentOperations(self))
         # Properties of operations are not affected
         return set([self])
         
@@ -846,7 +777,7 @@ class ToolTreeItem(CAMListTreeItemWithChildren):
     def invalidatedObjects(self, aspect):
         # Need to refresh properties for any default or calculated values updated, tool name etc.
         # Affects both properties and CAM
-        return set([self] + self.document.allOperationsPlusRefinements(lambda item: item.cutter is self.inventory_tool))
+        return set([self] + self.document.dependentOperations(self.inventory_tool))
 
 class ToolPresetTreeItem(CAMTreeItem):
     prop_name = StringEditableProperty("Name", "name", False)
@@ -972,39 +903,13 @@ class ToolPresetTreeItem(CAMTreeItem):
             assert False, "Unknown attribute: " + repr(name)
         if name in ['roughing_offset', 'offset', 'stepover', 'direction', 'extra_width', 'trc_rate', 'pocket_strategy', 'axis_angle', 'eh_diameter', 'entry_mode']:
             # There are other things that might require a recalculation, but do not result in visible changes
-            self.document.startUpdateCAM(subset=self.document.allOperations(lambda item: item.tool_preset is self.inventory_preset))
+            self.document.startUpdateCAM(subset=self.document.dependentOperations(self.inventory_preset))
         self.emitPropertyChanged(name)
     def returnKeyPressed(self):
         self.document.selectPresetAsDefault(self.inventory_preset.toolbit, self.inventory_preset)
     def invalidatedObjects(self, aspect):
         # Need to refresh properties for any default or calculated values updated
-        return set([self] + self.document.allOperationsPlusRefinements(lambda item: item.tool_preset is self.inventory_preset))
-
-class MaterialType(EnumClass):
-    WOOD = 0
-    PLASTICS = 1
-    ALU = 2
-    MILD_STEEL = 3
-    ALLOY_STEEL = 4
-    TOOL_STEEL = 5
-    STAINLESS_STEEL = 6
-    CAST_IRON = 7
-    MALLEABLE_IRON = 8
-    BRASS = 9
-    FOAM = 10
-    descriptions = [
-        (FOAM, "Foam", milling_tool.material_foam),
-        (WOOD, "Wood/MDF", milling_tool.material_wood),
-        (PLASTICS, "Plastics", milling_tool.material_plastics),
-        (ALU, "Aluminium", milling_tool.material_aluminium),
-        (BRASS, "Brass", milling_tool.material_brass),
-        (MILD_STEEL, "Mild steel", milling_tool.material_mildsteel),
-        (ALLOY_STEEL, "Alloy or MC steel", milling_tool.material_alloysteel),
-        (TOOL_STEEL, "Tool steel", milling_tool.material_toolsteel),
-        (STAINLESS_STEEL, "Stainless steel", milling_tool.material_stainlesssteel),
-        (CAST_IRON, "Cast iron - gray", milling_tool.material_castiron),
-        (MALLEABLE_IRON, "Cast iron - malleable", milling_tool.material_malleableiron),
-    ]
+        return set([self] + self.document.dependentOperations(self.inventory_preset))
 
 class WorkpieceTreeItem(CAMTreeItem):
     prop_material = EnumEditableProperty("Material", "material", MaterialType, allow_none=True, none_value="Unknown")
@@ -1040,27 +945,7 @@ class WorkpieceTreeItem(CAMTreeItem):
         self.emitPropertyChanged(name)
     def invalidatedObjects(self, aspect):
         # Depth of cut, mostly XXXKF might check for default value
-        return set([self] + self.document.allOperations())
-
-class OperationType(EnumClass):
-    OUTSIDE_CONTOUR = 1
-    INSIDE_CONTOUR = 2
-    POCKET = 3
-    ENGRAVE = 4
-    INTERPOLATED_HOLE = 5
-    DRILLED_HOLE = 6
-    OUTSIDE_PEEL = 7
-    REFINE = 8
-    descriptions = [
-        (OUTSIDE_CONTOUR, "Outside contour"),
-        (INSIDE_CONTOUR, "Inside contour"),
-        (POCKET, "Pocket"),
-        (ENGRAVE, "Engrave"),
-        (INTERPOLATED_HOLE, "H-Hole"),
-        (DRILLED_HOLE, "Drill"),
-        (OUTSIDE_PEEL, "Outside peel"),
-        (REFINE, "Refine"),
-    ]
+        return set([self] + self.document.dependentOperations(self))
 
 class CutterAdapter(object):
     def getLookupData(self, items):
@@ -1164,220 +1049,219 @@ class CycleTreeItem(CAMTreeItem):
     def invalidatedObjects(self, aspect):
         return set([self] + self.document.allOperations(lambda item: item.parent() is self))
 
-def not_none(*args):
-    for i in args:
-        if i is not None:
-            return True
-    return False
-
-class PresetDerivedAttributeItem(object):
-    def __init__(self, name, preset_name=None, preset_scale=None, def_value=None):
-        self.name = name
-        self.preset_name = preset_name or name
-        self.preset_scale = preset_scale
-        self.def_value = def_value
-    def resolve(self, operation, preset):
-        if operation is not None:
-            op_value = getattr(operation, self.name)
-            if op_value is not None:
-                return (True, op_value)
-        preset_value = getattr(preset, self.preset_name, None) if preset else None
-        if preset_value is not None:
-            if self.preset_scale is not None:
-                preset_value *= self.preset_scale
-            return (operation is None, preset_value)
-        return (False, self.def_value)
-
-class PresetDerivedAttributes(object):
-    attrs_common = [
-        PresetDerivedAttributeItem('rpm'),
-        PresetDerivedAttributeItem('vfeed'),
-        PresetDerivedAttributeItem('doc', preset_name='maxdoc'),
-    ]
-    attrs_endmill = [
-        PresetDerivedAttributeItem('hfeed'),
-        PresetDerivedAttributeItem('offset', def_value=0),
-        PresetDerivedAttributeItem('roughing_offset', def_value=0),
-        PresetDerivedAttributeItem('stepover', preset_scale=100),
-        PresetDerivedAttributeItem('extra_width', preset_scale=100, def_value=0),
-        PresetDerivedAttributeItem('trc_rate', preset_scale=100, def_value=0),
-        PresetDerivedAttributeItem('direction', def_value=inventory.MillDirection.CONVENTIONAL),
-        PresetDerivedAttributeItem('pocket_strategy', def_value=inventory.PocketStrategy.CONTOUR_PARALLEL),
-        PresetDerivedAttributeItem('axis_angle', def_value=0),
-        PresetDerivedAttributeItem('eh_diameter', preset_scale=100, def_value=50),
-        PresetDerivedAttributeItem('entry_mode', def_value=inventory.EntryMode.PREFER_HELIX),
-    ]
-    attrs_all = attrs_common + attrs_endmill
-    attrs = {
-        inventory.EndMillCutter : {i.name : i for i in attrs_all},
-        inventory.DrillBitCutter : {i.name : i for i in attrs_common},
-    }
-    def __init__(self, operation, preset=None, addError=None):
-        if preset is None:
-            preset = operation.tool_preset
-        self.operation = operation
-        attrs = self.attrs[operation.cutter.__class__]
-        self.dirty = False
-        for attr in attrs.values():
-            dirty, value = attr.resolve(operation, preset)
-            setattr(self, attr.name, value)
-            self.dirty = self.dirty or dirty
-        # Material defaults
-        if operation.document.material.material is not None and operation.cutter is not None:
-            m = MaterialType.toTuple(operation.document.material.material)[2]
-            t = operation.cutter
-            try:
-                if isinstance(operation.cutter, inventory.EndMillCutter):
-                    if not all([self.rpm, self.hfeed, self.vfeed, self.doc, self.stepover]):
-                        # Slotting penalty
-                        f = 1
-                        if operation.operation in (OperationType.OUTSIDE_CONTOUR, OperationType.INSIDE_CONTOUR):
-                            f = 0.6
-                        st = milling_tool.standard_tool(t.diameter, t.flutes or 2, m, milling_tool.carbide_uncoated, not operation.cutter.material.is_carbide(), f, flute_length=t.length, machine_params=operation.document.gcode_machine_params)
-                        if self.rpm is None:
-                            self.rpm = st.rpm
-                        if self.hfeed is None:
-                            self.hfeed = st.hfeed * f
-                        if self.vfeed is None:
-                            self.vfeed = st.vfeed * f
-                        if self.doc is None:
-                            self.doc = st.maxdoc * f
-                        if self.stepover is None:
-                            self.stepover = st.stepover * 100
-                elif isinstance(operation.cutter, inventory.DrillBitCutter):
-                    if not all([self.rpm, self.vfeed, self.doc]):
-                        st = milling_tool.standard_tool(t.diameter, t.flutes or 2, m, milling_tool.carbide_uncoated, not operation.cutter.material.is_carbide(), 1.0, flute_length=t.length, machine_params=operation.document.gcode_machine_params, is_drill=True)
-                        if self.rpm is None:
-                            self.rpm = st.rpm
-                        if self.vfeed is None:
-                            self.vfeed = st.vfeed
-                        if self.doc is None:
-                            self.doc = st.maxdoc
-            except ValueError as e:
-                if addError:
-                    addError(str(e))
-    def validate(self, errors):
-        if self.vfeed is None:
-            errors.append("Plunge rate is not set")
-        if self.doc is None:
-            errors.append("Maximum depth of cut per pass is not set")
-        if isinstance(self.operation.cutter, inventory.EndMillCutter):
-            if self.hfeed is None:
-                if self.operation.operation != OperationType.DRILLED_HOLE:
-                    errors.append("Feed rate is not set")
-            elif self.hfeed < 0.1 or self.hfeed > 10000:
-                errors.append("Feed rate is out of range (0.1-10000)")
-            if self.stepover is None or self.stepover < 0.1 or self.stepover > 100:
-                if self.operation.operation == OperationType.POCKET or self.operation.operation == OperationType.OUTSIDE_PEEL or self.operation.operation == OperationType.REFINE:
-                    if self.stepover is None:
-                        errors.append("Horizontal stepover is not set")
-                    else:
-                        errors.append("Horizontal stepover is out of range")
-                else:
-                    # Fake value that is never used
-                    self.stepover = 0.5
-    @staticmethod
-    def valuesFromPreset(preset, cutter_type):
-        values = {}
-        if preset:
-            values['name'] = preset.name
-            for attr in PresetDerivedAttributes.attrs[cutter_type].values():
-                present, value = attr.resolve(None, preset)
-                values[attr.name] = value if present is not None else None
-        else:
-            for attr in PresetDerivedAttributes.attrs[cutter_type].values():
-                if attr.def_value is not None:
-                    values[attr.name] = attr.def_value
-        return values
-    def toPreset(self, name):
-        return self.toPresetFromAny(name, self, self.operation.cutter, type(self.operation.cutter))
-    @classmethod
-    def toPresetFromAny(klass, name, src, cutter, cutter_type):
-        kwargs = {}
-        is_dict = isinstance(src, dict)
-        for attr in klass.attrs[cutter_type].values():
-            value = src[attr.name] if is_dict else getattr(src, attr.name)
-            if value is not None and attr.preset_scale is not None:
-                value /= attr.preset_scale
-            kwargs[attr.preset_name] = value
-        return cutter_type.preset_type.new(None, name, cutter, **kwargs)
-    @classmethod
-    def resetPresetDerivedValues(klass, target):
-        for attr in klass.attrs_all:
-            setattr(target, attr.name, None)
-        target.emitPropertyChanged()
-
 class WorkerThread(threading.Thread):
-    def __init__(self, parentOp, workerFunc):
-        self.worker_func = workerFunc
+    def __init__(self, parentOp, method, args, kwargs):
         self.parent_operation = parentOp
+        # The Operations object to add the results to. It's replaced when the
+        # operation is recalculated, and a worker that was superseded
+        # by then must not write into the new one.
+        self.cam = parentOp.cam
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
         self.exception = None
         self.exception_text = None
         self.progress = (0, 10000000)
         self.cancelled = False
+        # Waiting in the scheduler's queue, not started yet
+        self.queued = False
+        self.scheduler = None
+        self.finished_callback = None
         threading.Thread.__init__(self, target=self.threadMain)
+    def leafWorkers(self):
+        return [self]
     def getProgress(self):
         return self.progress
     def cancel(self):
-        self.cancelled = True
+        # The scheduler starts the workers while holding its lock, so once this
+        # returns, a queued worker is either already started or never will be
+        if self.scheduler is not None:
+            with self.scheduler.lock:
+                self.cancelled = True
+        else:
+            self.cancelled = True
+    def start(self):
+        # Still queued until the thread is running, so that is_alive never
+        # sees a worker that's neither
+        threading.Thread.start(self)
+        self.queued = False
+    def join(self):
+        if not self.queued:
+            threading.Thread.join(self)
+    def is_alive(self):
+        return (self.queued and not self.cancelled) or threading.Thread.is_alive(self)
+    def calculate(self):
+        getattr(self.cam, self.method)(*self.args, **self.kwargs)
     def threadMain(self):
         try:
-            self.worker_func()
-            if self.parent_operation.cam and self.parent_operation.cam.is_nothing():
+            self.calculate()
+            if self.cam and self.cam is self.parent_operation.cam and self.cam.is_nothing():
                 self.parent_operation.addWarning("No cuts produced")
             self.progress = (self.progress[1], self.progress[1])
         except Exception as e:
             import traceback
-            errorText = str(e)
-            if not errorText:
-                if isinstance(e, AssertionError):
-                    errorText = traceback.format_exc(limit=1)
-                else:
-                    errorText = type(e).__name__
             self.exception = e
-            self.exception_text = errorText
-            if self.parent_operation and not self.parent_operation.error:
-                self.parent_operation.error = errorText
+            self.exception_text = workerExceptionText(e)
+            if self.parent_operation and self.cam is self.parent_operation.cam and not self.parent_operation.error:
+                self.parent_operation.error = self.exception_text
             traceback.print_exc()
-
-class WorkerThreadPack(object):
-    def __init__(self, parentOp, workerFuncList):
-        self.threads = [WorkerThread(parentOp, workerFunc) for workerFunc in workerFuncList]
+        finally:
+            if self.finished_callback:
+                self.finished_callback(self)
+
+# Same as WorkerThread, but the calculation runs in the worker process pool,
+# with the thread only waiting for the results. The operations are created
+# from copies of the shape, tool and parameters, and then added to the
+# operation's Operations object.
+class WorkerProcess(WorkerThread):
+    def __init__(self, parentOp, pool, method, args, kwargs):
+        WorkerThread.__init__(self, parentOp, method, args, kwargs)
+        self.pool = pool
+    def calculate(self):
+        cam = self.cam
+        job = geom.submit_calculation(self.pool, gcodeops.calculate_operations, cam.machine_params, cam.tool, cam.props, cam.thickness, self.method, self.args, self.kwargs)
+        if geom.wait_for_jobs([job]):
+            cam.add_all(job.result())
+
+class WorkerPack(object):
+    def __init__(self, workers):
+        self.workers = workers
         self.exception = None
         self.exception_text = None
     def getProgress(self):
         num = denom = 0
-        for thread in self.threads:
-            progress = thread.getProgress()
+        for worker in self.workers:
+            progress = worker.getProgress()
             num += progress[0]
             denom += progress[1]
         return (num, denom)
-    def start(self):
-        for thread in self.threads:
-            thread.start()
+    def leafWorkers(self):
+        return self.workers
     def cancel(self):
-        for thread in self.threads:
-            thread.cancel()
+        for worker in self.workers:
+            worker.cancel()
     def join(self):
-        for thread in self.threads:
-            thread.join()
+        for worker in self.workers:
+            worker.join()
         exceptions = ""
-        for thread in self.threads:
-            if thread.exception is not None:
-                self.exception = thread.exception
+        for worker in self.workers:
+            if worker.exception is not None:
+                self.exception = worker.exception
                 break
-        for thread in self.threads:
-            if thread.exception is not None:
-                exceptions += thread.exception_text
+        for worker in self.workers:
+            if worker.exception is not None:
+                exceptions += worker.exception_text
         if exceptions:
             self.exception_text = exceptions
     def is_alive(self):
-        return any([thread.is_alive() for thread in self.threads])
+        return any([worker.is_alive() for worker in self.workers])
+
+class ScheduledWorker(object):
+    def __init__(self, order, item, worker, priority):
+        self.order = order
+        self.item = item
+        self.worker = worker
+        self.priority = priority
+        self.submit_time = time.perf_counter()
+        self.start_time = None
+    def sortKey(self):
+        return (self.priority, self.order)
+
+# Runs the workers of all the operations, with a limit on how many of them
+# run at the same time. Selected operations go first, then the ones that have
+# a refine operation on the same shape, then the ones in the visible area.
+# Priorities are updated when polled (from the GUI thread), as the
+# next worker is usually started from the thread of the one that finished.
+class CAMScheduler(object):
+    # Threads only help with the parts of the calculation that release the GIL
+    max_threads = 2
+    PRIORITY_SELECTED = 0
+    PRIORITY_REFINED = 1
+    PRIORITY_VISIBLE = 2
+    PRIORITY_OTHER = 3
+    def __init__(self, document):
+        self.document = document
+        self.lock = threading.RLock()
+        self.pending = []
+        self.running = []
+        self.order = itertools.count()
+        # (seconds in the queue, seconds running) of the recently finished workers
+        self.latencies = collections.deque(maxlen=50)
+        self.batch_depth = 0
+    # Submit several workers before starting any, so that the priorities apply to all of them
+    @contextlib.contextmanager
+    def batch(self):
+        self.batch_depth += 1
+        try:
+            yield
+        finally:
+            self.batch_depth -= 1
+            if not self.batch_depth:
+                self.poll()
+    def submit(self, item, worker):
+        with self.lock:
+            for leaf in worker.leafWorkers():
+                leaf.queued = True
+                leaf.scheduler = self
+                leaf.finished_callback = self.workerFinished
+                self.pending.append(ScheduledWorker(next(self.order), item, leaf, CAMScheduler.PRIORITY_OTHER))
+        if not self.batch_depth:
+            self.poll()
+    def maxRunning(self):
+        if geom.get_worker_pool() is not None:
+            return geom.GeometrySettings.worker_processes
+        return self.max_threads
+    def poll(self):
+        refined_shape_ids = self.document.refinedShapeIds()
+        visible_bounds = self.document.visible_bounds
+        with self.lock:
+            for entry in self.pending:
+                entry.priority = entry.item.updatePriority(refined_shape_ids, visible_bounds)
+            self.startPending()
+    def workerFinished(self, worker):
+        with self.lock:
+            for entry in self.running:
+                if entry.worker is worker:
+                    self.running.remove(entry)
+                    self.latencies.append((entry.start_time - entry.submit_time, time.perf_counter() - entry.start_time))
+                    break
+            self.startPending()
+    def startPending(self):
+        self.pending = [entry for entry in self.pending if not entry.worker.cancelled]
+        free = self.maxRunning() - len(self.running)
+        if free <= 0 or not self.pending:
+            return
+        self.pending.sort(key=ScheduledWorker.sortKey)
+        starting = self.pending[:free]
+        self.pending = self.pending[free:]
+        for entry in starting:
+            entry.start_time = time.perf_counter()
+            self.running.append(entry)
+            entry.worker.start()
+    # Returns when one of the running workers finishes or the timeout expires,
+    # whichever comes first
+    def waitForRunning(self, timeout):
+        with self.lock:
+            running = [entry.worker for entry in self.running]
+        if running:
+            threading.Thread.join(running[0], timeout)
+    def queueDepth(self):
+        with self.lock:
+            return len([entry for entry in self.pending if not entry.worker.cancelled])
+    def runningCount(self):
+        with self.lock:
+            return len(self.running)
+    # Average time from submitting to finishing a worker, None if no workers finished yet
+    def averageLatency(self):
+        with self.lock:
+            if not self.latencies:
+                return None
+            return sum(wait + run for wait, run in self.latencies) / len(self.latencies)
 
 def cutterTypesForOperationType(operationType):
     return (inventory.DrillBitCutter, inventory.EndMillCutter) if operationType == OperationType.DRILLED_HOLE else inventory.EndMillCutter
 
-class OperationTreeItem(CAMTreeItem):
+class OperationTreeItem(CAMTreeItem, OperationCAM):
     prop_operation = EnumEditableProperty("Operation", "operation", OperationType)
     prop_cutter = RefEditableProperty("Cutter", "cutter", CutterAdapter())
     prop_preset = RefEditableProperty("Tool preset", "tool_preset", ToolPresetAdapter(), allow_none=True, none_value="<none>")
@@ -1388,11 +1272,13 @@ class OperationTreeItem(CAMTreeItem):
     prop_user_tabs = SetEditableProperty("Tab Locations", "user_tabs", format_func=lambda value: ", ".join([f"({Format.coord(i.x)}, {Format.coord(i.y)})" for i in value]), edit_func=lambda item: item.editTabLocations())
     prop_entry_exit = SetEditableProperty("Entry/Exit points", "entry_exit", format_func=lambda value: ("Applied" if value else "Not applied") + " - double-click to edit", edit_func=lambda item: item.editEntryExit())
     prop_islands = SetEditableProperty("Islands", "islands", edit_func=lambda item: item.editIslands(), format_func=lambda value: f"{len(value)} items - double-click to edit")
+    prop_pattern = SetEditableProperty("Pattern", "pattern", format_func=lambda value: f"{len(value) + 1} holes")
     prop_dogbones = EnumEditableProperty("Dogbones", "dogbones", cam.dogbone.DogboneMode, allow_none=False)
     prop_pocket_strategy = EnumEditableProperty("Strategy", "pocket_strategy", inventory.PocketStrategy, allow_none=True, none_value="(use preset value)")
     prop_axis_angle = FloatDistEditableProperty("Axis angle", "axis_angle", format=Format.angle, unit='\u00b0', min=0, max=90, allow_none=True)
     prop_eh_diameter = FloatDistEditableProperty("Entry helix %dia", "eh_diameter", format=Format.percent, unit='%', min=0, max=100, allow_none=True)
     prop_entry_mode = EnumEditableProperty("Entry mode", "entry_mode", inventory.EntryMode, allow_none=True, none_value="(use preset value)")
+    prop_simplify_tolerance = FloatDistEditableProperty("Simplify tolerance", "simplify_tolerance", Format.depth_of_cut, unit="mm", min=0, max=1, allow_none=True, none_value="default")
 
     prop_hfeed = FloatDistEditableProperty("Feed rate", "hfeed", Format.feed, unit="mm/min", min=0.1, max=10000, allow_none=True)
     prop_vfeed = FloatDistEditableProperty("Plunge rate", "vfeed", Format.feed, unit="mm/min", min=0.1, max=10000, allow_none=True)
@@ -1419,6 +1305,8 @@ class OperationTreeItem(CAMTreeItem):
         self.worker = None
         self.prev_diameter = None
         self.cam = None
+        # Hash of the inputs the current results (or calculation in progress) are based on
+        self.cam_input_hash = None
         self.renderer = None
         self.error = None
         self.warning = None
@@ -1434,7 +1322,10 @@ class OperationTreeItem(CAMTreeItem):
         self.tab_count = None
         self.offset = 0
         self.roughing_offset = 0
+        self.simplify_tolerance = None
         self.islands = set()
+        # Other circles drilled by the same hole operation
+        self.pattern = set()
         self.dogbones = cam.dogbone.DogboneMode.DISABLED
         self.user_tabs = set()
         self.entry_exit = []
@@ -1442,6 +1333,7 @@ class OperationTreeItem(CAMTreeItem):
     def updateCheckState(self):
         if not self.active and self.cam is not None:
             self.cam = None
+            self.cam_input_hash = None
             self.document.operationsUpdated.emit()
         self.setCheckState(Qt.CheckState.Checked if self.active else Qt.CheckState.Unchecked)
     def editTabLocations(self):
@@ -1460,7 +1352,7 @@ class OperationTreeItem(CAMTreeItem):
         for i in self.islands:
             if i == shape_id:
                 return True
-        return False
+        return shape_id in self.pattern
     def toString(self):
         return OperationType.toString(self.operation)
     def isPropertyValid(self, name):
@@ -1473,6 +1365,8 @@ class OperationTreeItem(CAMTreeItem):
             return False
         if not self.areIslandsEditable() and name == 'islands':
             return False
+        if not self.pattern and name == 'pattern':
+            return False
         if not has_stepover and name in ['stepover', 'eh_diameter']:
             return False
         if (not has_islands or self.pocket_strategy not in [inventory.PocketStrategy.AXIS_PARALLEL, inventory.PocketStrategy.AXIS_PARALLEL_ZIGZAG]) and name == 'axis_angle':
@@ -1481,7 +1375,7 @@ class OperationTreeItem(CAMTreeItem):
             return False
         if self.operation == OperationType.ENGRAVE and name in ['direction']:
             return False
-        if self.operation == OperationType.DRILLED_HOLE and name in ['hfeed', 'trc_rate', 'direction']:
+        if self.operation == OperationType.DRILLED_HOLE and name in ['hfeed', 'trc_rate', 'direction', 'simplify_tolerance']:
             return False
         return True
     def getValidEnumValues(self, name):
@@ -1490,6 +1384,8 @@ class OperationTreeItem(CAMTreeItem):
         if name == 'operation':
             if self.cutter is not None and isinstance(self.cutter, inventory.DrillBitCutter):
                 return [OperationType.DRILLED_HOLE]
+            if self.pattern:
+                return [OperationType.INTERPOLATED_HOLE, OperationType.DRILLED_HOLE]
             if isinstance(self.orig_shape, DrawingCircleTreeItem):
                 return [OperationType.OUTSIDE_CONTOUR, OperationType.INSIDE_CONTOUR, OperationType.POCKET, OperationType.OUTSIDE_PEEL, OperationType.ENGRAVE, OperationType.INTERPOLATED_HOLE, OperationType.DRILLED_HOLE]
             if isinstance(self.orig_shape, DrawingPolylineTreeItem) or isinstance(self.orig_shape, DrawingTextTreeItem):
@@ -1508,6 +1404,7 @@ class OperationTreeItem(CAMTreeItem):
         dump['active'] = self.active
         dump['shape_id'] = self.shape_id
         dump['islands'] = list(sorted(self.islands))
+        dump['pattern'] = list(sorted(self.pattern))
         dump['user_tabs'] = list(sorted([(pt.x, pt.y) for pt in self.user_tabs]))
         dump['entry_exit'] = [[(pts[0].x, pts[0].y), (pts[1].x, pts[1].y)] for pts in self.entry_exit]
         dump['cutter'] = self.cutter.id
@@ -1516,6 +1413,7 @@ class OperationTreeItem(CAMTreeItem):
     def class_specific_load(self, dump):
         self.shape_id = dump.get('shape_id', None)
         self.islands = set(dump.get('islands', []))
+        self.pattern = set(dump.get('pattern', []))
         self.user_tabs = set(geom.PathPoint(i[0], i[1]) for i in dump.get('user_tabs', []))
         self.entry_exit = [(geom.PathPoint(i[0][0], i[0][1]), geom.PathPoint(i[1][0], i[1][1])) for i in dump.get('entry_exit', [])]
         self.active = dump.get('active', True)
@@ -1526,12 +1424,12 @@ class OperationTreeItem(CAMTreeItem):
             self.prop_tab_height, self.prop_tab_count, self.prop_user_tabs,
             self.prop_entry_exit, self.prop_dogbones,
             self.prop_extra_width,
-            self.prop_islands, self.prop_pocket_strategy, self.prop_axis_angle,
+            self.prop_islands, self.prop_pattern, self.prop_pocket_strategy, self.prop_axis_angle,
             self.prop_direction,
             self.prop_doc, self.prop_hfeed, self.prop_vfeed,
             self.prop_offset, self.prop_roughing_offset,
             self.prop_stepover, self.prop_eh_diameter, self.prop_entry_mode,
-            self.prop_trc_rate, self.prop_rpm]
+            self.prop_trc_rate, self.prop_rpm, self.prop_simplify_tolerance]
     def setPropertyValue(self, name, value):
         if name == 'tool_preset':
             if isinstance(value, SavePresetOption):
@@ -1595,10 +1493,14 @@ class OperationTreeItem(CAMTreeItem):
                     return f"Oversize Drill {self.cutter.diameter:0.1f}mm" if self.cutter else ""
             return OperationType.toString(self.operation) + (f" {self.cutter.diameter:0.1f}mm" if self.cutter else "")
         return OperationType.toString(self.operation)
+    def shapeLabel(self):
+        if self.pattern:
+            return f"{self.orig_shape.label()} and {len(self.pattern)} more"
+        return self.orig_shape.label()
     def data(self, role):
         if role == Qt.DisplayRole:
             preset_if = ", " + self.tool_preset.name if self.tool_preset else ", no preset"
-            return QVariant(self.operationTypeLabel() + ": " + self.orig_shape.label() + ", " + ((f"{self.depth:0.2f} mm") if self.depth is not None else "full") + f" depth{preset_if}")
+            return QVariant(self.operationTypeLabel() + ": " + self.shapeLabel() + ", " + ((f"{self.depth:0.2f} mm") if self.depth is not None else "full") + f" depth{preset_if}")
         if role == Qt.DecorationRole and self.error is not None:
             return QVariant(QApplication.instance().style().standardIcon(QStyle.SP_MessageBoxCritical))
         if role == Qt.DecorationRole and self.warning is not None:
@@ -1609,7 +1511,7 @@ class OperationTreeItem(CAMTreeItem):
             elif self.warning is not None:
                 return QVariant(self.warning)
             else:
-                return QVariant(self.operationTypeLabel() + ": " + self.orig_shape.label() + ", " + ((Format.depth_of_cut(self.depth) + " mm") if self.depth is not None else "full") + f" depth, preset: {self.tool_preset.name if self.tool_preset else 'none'}")
+                return QVariant(self.operationTypeLabel() + ": " + self.shapeLabel() + ", " + ((Format.depth_of_cut(self.depth) + " mm") if self.depth is not None else "full") + f" depth, preset: {self.tool_preset.name if self.tool_preset else 'none'}")
         return CAMTreeItem.data(self, role)
     def addWarning(self, warning):
         if self.warning is None:
@@ -1625,13 +1527,27 @@ class OperationTreeItem(CAMTreeItem):
         self.document.operationsUpdated.emit()
     def startUpdateCAM(self):
         with Spinner():
+            self.updateOrigShape()
+            input_hash = self.inputHash() if self.cutter and self.active else None
+            if input_hash is not None and input_hash == self.cam_input_hash:
+                # Nothing has changed, keep the current results or calculation
+                if self.renderer is None and self.cam is not None:
+                    self.renderer = canvas.OperationsRendererWithSelection(self)
+                    self.document.operationsUpdated.emit()
+                return
+            prev_cam = None
+            if input_hash is not None and self.cam_input_hash is not None and input_hash[0] == self.cam_input_hash[0]:
+                # Only depths/feeds/speeds changed, the toolpaths of a finished
+                # calculation can be reused
+                if self.worker is None and self.error is None:
+                    prev_cam = self.cam
             self.last_progress = (1, 100000)
             self.error = None
             self.warning = None
             self.cam = None
             self.renderer = None
-            self.updateOrigShape()
             self.cancelWorker()
+            self.cam_input_hash = None
             if not self.cutter:
                 self.error = "Cutter not set"
                 self.last_progress = (1, 1)
@@ -1640,7 +1556,8 @@ class OperationTreeItem(CAMTreeItem):
                 self.last_progress = (1, 1)
                 # Operation not enabled
                 return
-            self.updateCAMWork()
+            self.cam_input_hash = input_hash
+            self.updateCAMWork(prev_cam)
     def pollForUpdateCAM(self):
         if not self.worker:
             return self.last_progress
@@ -1650,6 +1567,8 @@ class OperationTreeItem(CAMTreeItem):
             if self.error is None and self.worker.exception is not None:
                 self.error = self.worker.exception_text
             self.worker = None
+            if self.error is None:
+                self.storeCachedCAM()
             self.document.operationsUpdated.emit()
             self.emitDataChanged()
         return self.last_progress
@@ -1659,204 +1578,48 @@ class OperationTreeItem(CAMTreeItem):
             self.worker.join()
             self.worker = None
             self.last_progress = None
-    def operationFunc(self, shape, pda):
-        translation = self.document.drawing.translation()
-        if len(self.user_tabs):
-            tabs = self.user_tabs
-        else:
-            cs = self.document.config_settings
-            tabs = self.tab_count if self.tab_count is not None else shape.default_tab_count(cs.min_tabs, cs.max_tabs, cs.tab_dist, cs.tab_min_length)
+            self.cam_input_hash = None
+    def operationCall(self, shape, pda):
         if self.document.checkUpdateSuspended(self):
+            # Will need recalculating when the update is resumed
+            self.cam_input_hash = None
             return
-        if self.operation == OperationType.OUTSIDE_CONTOUR:
-            if pda.trc_rate:
-                return lambda: self.cam.outside_contour_trochoidal(shape, pda.extra_width / 100.0, pda.trc_rate / 100.0, tabs=tabs, entry_exit=self.entry_exit)
-            else:
-                return lambda: self.cam.outside_contour(shape, tabs=tabs, widen=pda.extra_width / 50.0, entry_exit=self.entry_exit)
-        elif self.operation == OperationType.INSIDE_CONTOUR:
-            if pda.trc_rate:
-                return lambda: self.cam.inside_contour_trochoidal(shape, pda.extra_width / 100.0, pda.trc_rate / 100.0, tabs=tabs, entry_exit=self.entry_exit)
-            else:
-                return lambda: self.cam.inside_contour(shape, tabs=tabs, widen=pda.extra_width / 50.0, entry_exit=self.entry_exit)
-        elif self.operation == self.operation == OperationType.REFINE and self.shape_to_refine is not None:
-            assert pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG
-            if self.is_external:
-                if isinstance(self.shape_to_refine, dict):
-                    return lambda: self.cam.outside_peel_hsm(shape, shape_to_refine=self.shape_to_refine.get(shape, None))
-                else:
-                    return lambda: self.cam.outside_peel_hsm(shape, shape_to_refine=self.shape_to_refine)
-            else:
-                if isinstance(self.shape_to_refine, dict):
-                    return lambda: self.cam.pocket_hsm(shape, shape_to_refine=self.shape_to_refine.get(shape, None))
-                else:
-                    return lambda: self.cam.pocket_hsm(shape, shape_to_refine=self.shape_to_refine)
-        elif self.operation == OperationType.POCKET or self.operation == OperationType.REFINE:
-            if pda.pocket_strategy == inventory.PocketStrategy.CONTOUR_PARALLEL:
-                return lambda: self.cam.pocket(shape)
-            elif pda.pocket_strategy == inventory.PocketStrategy.AXIS_PARALLEL or pda.pocket_strategy == inventory.PocketStrategy.AXIS_PARALLEL_ZIGZAG:
-                return lambda: self.cam.face_mill(shape)
-            elif pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG:
-                return lambda: self.cam.pocket_hsm(shape)
-        elif self.operation == OperationType.OUTSIDE_PEEL:
-            if pda.pocket_strategy == inventory.PocketStrategy.CONTOUR_PARALLEL:
-                return lambda: self.cam.outside_peel(shape)
-            elif pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL or pda.pocket_strategy == inventory.PocketStrategy.HSM_PEEL_ZIGZAG:
-                return lambda: self.cam.outside_peel_hsm(shape)
-            else:
-                raise ValueError("Strategy not supported for outside cuts")
-        elif self.operation == OperationType.ENGRAVE:
-            return lambda: self.cam.engrave(shape)
-        elif self.operation == OperationType.INTERPOLATED_HOLE:
-            return lambda: self.cam.helical_drill(self.orig_shape.centre.x + translation[0], self.orig_shape.centre.y + translation[1], 2 * self.orig_shape.r)
-        elif self.operation == OperationType.DRILLED_HOLE:
-            return lambda: self.cam.peck_drill(self.orig_shape.centre.x + translation[0], self.orig_shape.centre.y + translation[1])
-        raise ValueError("Unsupported operation")
-    def shapeToRefine(self, shape, previous, is_external):
-        if is_external:
-            return cam.pocket.shape_to_refine_external(shape, previous)
-        else:
-            return cam.pocket.shape_to_refine_internal(shape, previous)
-    def refineShape(self, shape, previous, current, min_entry_dia, is_external):
-        if is_external:
-            return cam.pocket.refine_shape_external(shape, previous, current, min_entry_dia)
-        else:
-            return cam.pocket.refine_shape_internal(shape, previous, current, min_entry_dia)
-    def createShapeObject(self):
-        translation = self.document.drawing.translation()
-        self.shape = self.orig_shape.translated(*translation).toShape()
-        if not isinstance(self.shape, list) and self.operation in (OperationType.POCKET, OperationType.OUTSIDE_PEEL):
-            extra_shapes = []
-            for island in self.islands:
-                item = self.document.drawing.itemById(island).translated(*translation).toShape()
-                if isinstance(item, list):
-                    for i in item:
-                        self.shape.add_island(i.boundary)
-                        if i.islands:
-                            extra_shapes += [shapes.Shape(j, True) for j in i.islands]
-                elif item.closed:
-                    self.shape.add_island(item.boundary)
-                    if item.islands:
-                        extra_shapes += [shapes.Shape(j, True) for j in item.islands]
-            if extra_shapes:
-                self.shape = [self.shape] + extra_shapes
-    def addDogbonesToIslands(self, shape, tool):
-        new_islands = []
-        for i in shape.islands:
-            new_shapes = cam.dogbone.add_dogbones(shapes.Shape(i, True), tool, True, self.dogbones, False)
-            if isinstance(new_shapes, list):
-                new_islands += [j.boundary for j in new_shapes]
-            else:
-                new_islands.append(new_shapes.boundary)
-        shape.islands = new_islands
-    def updateCAMWork(self):
+        return OperationCAM.operationCall(self, shape, pda)
+    def updatePriority(self, refined_shape_ids, visible_bounds):
+        if self.isSelected:
+            return CAMScheduler.PRIORITY_SELECTED
+        if self.operation != OperationType.REFINE and self.shape_id in refined_shape_ids:
+            return CAMScheduler.PRIORITY_REFINED
+        if visible_bounds is not None and self.orig_shape is not None and self.orig_shape.bounds is not None:
+            dx, dy = self.document.drawing.translation()
+            sx, sy, ex, ey = self.orig_shape.bounds
+            if geom.bounds_overlap((sx + dx, sy + dy, ex + dx, ey + dy), visible_bounds):
+                return CAMScheduler.PRIORITY_VISIBLE
+        return CAMScheduler.PRIORITY_OTHER
+    def createWorker(self, method, args, kwargs):
+        # Fall back to calculating in a thread if worker processes are disabled
+        # or not supported
+        pool = geom.get_worker_pool()
+        if pool is not None:
+            return WorkerProcess(self, pool, method, args, kwargs)
+        return WorkerThread(self, method, args, kwargs)
+    def updateCAMWork(self, prev_cam=None):
         try:
-            translation = self.document.drawing.translation()
-            errors = []
-            if self.orig_shape:
-                self.createShapeObject()
-            else:
-                self.shape = None
-            thickness = self.document.material.thickness
-            depth = self.depth if self.depth is not None else thickness
-            if depth is None or depth == 0:
-                raise ValueError("Neither material thickness nor cut depth is set")
-            start_depth = self.start_depth if self.start_depth is not None else 0
-            if self.cutter.length and depth > self.cutter.length:
-                self.addWarning(f"Cut depth ({depth:0.1f} mm) greater than usable flute length ({self.cutter.length:0.1f} mm)")
-            # Only checking for end mills because most drill bits have a V tip and may require going slightly past
-            if thickness and isinstance(self.cutter, inventory.EndMillCutter) and depth > thickness:
-                self.addWarning(f"Cut depth ({depth:0.1f} mm) greater than material thickness ({thickness:0.1f} mm)")
-            if self.operation == OperationType.DRILLED_HOLE and self.cutter.diameter > 2 * self.orig_shape.r + 0.01:
-                self.addWarning(f"Cutter diameter ({self.cutter.diameter:0.1f} mm) greater than hole diameter ({2 * self.orig_shape.r:0.1f} mm)")
-            tab_depth = max(start_depth, depth - self.tab_height) if self.tab_height is not None else start_depth
-
-            pda = PresetDerivedAttributes(self, addError=lambda error: errors.append(error))
-            pda.validate(errors)
-            if errors:
-                raise ValueError("\n".join(errors))
-            if pda.rpm is not None:
-                mp = self.document.gcode_machine_params
-                if mp.min_rpm is not None and pda.rpm < mp.min_rpm:
-                    self.addWarning(f"Spindle speed {pda.rpm:1f} lower than the minimum of {mp.min_rpm:1f}")
-                if mp.max_rpm is not None and pda.rpm > mp.max_rpm:
-                    self.addWarning(f"Spindle speed {pda.rpm:1f} higher than the maximum of {mp.max_rpm:1f}")
-
-            if isinstance(self.cutter, inventory.EndMillCutter):
-                tool = milling_tool.Tool(self.cutter.diameter, pda.hfeed, pda.vfeed, pda.doc, stepover=pda.stepover / 100.0, climb=(pda.direction == inventory.MillDirection.CLIMB), min_helix_ratio=pda.eh_diameter / 100.0)
-                zigzag = pda.pocket_strategy in (inventory.PocketStrategy.HSM_PEEL_ZIGZAG, inventory.PocketStrategy.AXIS_PARALLEL_ZIGZAG, )
-                self.gcode_props = gcodeops.OperationProps(-depth, -start_depth, -tab_depth, pda.offset, zigzag, pda.axis_angle * math.pi / 180, pda.roughing_offset, pda.entry_mode != inventory.EntryMode.PREFER_RAMP)
-            else:
-                tool = milling_tool.Tool(self.cutter.diameter, 0, pda.vfeed, pda.doc)
-                self.gcode_props = gcodeops.OperationProps(-depth, -start_depth, -tab_depth, 0)
-            self.gcode_props.rpm = pda.rpm
-            if self.dogbones and self.operation == OperationType.OUTSIDE_PEEL and not isinstance(self.shape, list):
-                self.addDogbonesToIslands(self.shape, tool)
-            if self.dogbones and self.operation not in (OperationType.ENGRAVE, OperationType.DRILLED_HOLE, OperationType.INTERPOLATED_HOLE, OperationType.OUTSIDE_PEEL):
-                is_outside = self.operation == OperationType.OUTSIDE_CONTOUR
-                is_refine = self.operation == OperationType.REFINE
-                is_pocket = self.operation == OperationType.POCKET
-                if isinstance(self.shape, list):
-                    res = []
-                    for i in self.shape:
-                        res.append(cam.dogbone.add_dogbones(i, tool, is_outside, self.dogbones, is_refine))
-                    if is_pocket:
-                        for i in res:
-                            self.addDogbonesToIslands(self.shape, tool)
-                    self.shape = res
-                else:
-                    self.shape = cam.dogbone.add_dogbones(self.shape, tool, is_outside, self.dogbones, is_refine)
-                    if is_pocket:
-                        self.addDogbonesToIslands(self.shape, tool)
-            if self.operation == OperationType.REFINE:
-                diameter_plus = self.cutter.diameter + 2 * pda.offset
-                prev_diameter, prev_operation, islands = self.document.largerDiameterForShape(self.orig_shape, diameter_plus)
-                self.prev_diameter = prev_diameter
-                if prev_diameter is None:
-                    if pda.offset:
-                        raise ValueError(f"No matching milling operation to refine with cutter diameter {Format.cutter_dia(self.cutter.diameter)} and offset {Format.coord(pda.offset)}")
-                    else:
-                        raise ValueError(f"No matching milling operation to refine with cutter diameter {Format.cutter_dia(self.cutter.diameter)}")
-                is_hsm = pda.pocket_strategy in (inventory.PocketStrategy.HSM_PEEL, inventory.PocketStrategy.HSM_PEEL_ZIGZAG)
-                if prev_operation.operation == OperationType.OUTSIDE_PEEL:
-                    # Make up a list of shapes from shape's islands?
-                    raise ValueError("Refining outside peel operations is not supported yet")
-                self.is_external = (prev_operation.operation == OperationType.OUTSIDE_CONTOUR)
-                self.shape_to_refine = None
-                if islands and not isinstance(self.shape, list):
-                    for island in islands:
-                        item = self.document.drawing.itemById(island).translated(*translation).toShape()
-                        if item.closed:
-                            self.shape.add_island(item.boundary)
-                if is_hsm:
-                    if isinstance(self.shape, list):
-                        self.shape_to_refine = { i : self.shapeToRefine(i, prev_diameter, self.is_external) for i in self.shape }
-                    else:
-                        self.shape_to_refine = self.shapeToRefine(self.shape, prev_diameter, self.is_external)
-                elif isinstance(self.shape, list):
-                    res = []
-                    for i in self.shape:
-                        res += self.refineShape(i, prev_diameter, diameter_plus, tool.min_helix_diameter, self.is_external)
-                    self.shape = res
-                else:
-                    self.shape = self.refineShape(self.shape, prev_diameter, diameter_plus, tool.min_helix_diameter, self.is_external)
-            else:
-                self.prev_diameter = None
-            if isinstance(self.shape, list) and len(self.shape) == 1:
-                self.shape = self.shape[0]
+            pda, tool = self.prepareCAM()
+            if prev_cam is not None and self.updateZStage(prev_cam, tool):
+                return
+            if prev_cam is None and self.loadCachedCAM(pda, tool):
+                return
+            self.createShapes(pda, tool)
             self.cam = gcodeops.Operations(self.document.gcode_machine_params, tool, self.gcode_props, self.document.material.thickness)
             self.renderer = canvas.OperationsRendererWithSelection(self)
-            if self.shape:
+            calls = self.operationCalls(pda)
+            if calls:
                 if isinstance(self.shape, list):
-                    threadFuncs = [ self.operationFunc(shape, pda) for shape in self.shape ]
-                    threadFuncs = [ fn for fn in threadFuncs if fn is not None]
-                    if threadFuncs:
-                        self.worker = WorkerThreadPack(self, threadFuncs)
-                        self.worker.start()
+                    self.worker = WorkerPack([self.createWorker(*call) for call in calls])
                 else:
-                    threadFunc = self.operationFunc(self.shape, pda)
-                    if threadFunc:
-                        self.worker = WorkerThread(self, threadFunc)
-                        self.worker.start()
+                    self.worker = self.createWorker(*calls[0])
+                self.document.scheduler.submit(self, self.worker)
             self.error = None
         except Exception as e:
             self.cam = None
@@ -1865,6 +1628,14 @@ class OperationTreeItem(CAMTreeItem):
             self.document.operationsUpdated.emit()
             if not isinstance(e, ValueError):
                 raise
+    def updateZStage(self, prev_cam, tool):
+        if not OperationCAM.updateZStage(self, prev_cam, tool):
+            return False
+        self.renderer = canvas.OperationsRendererWithSelection(self)
+        self.last_progress = (1, 1)
+        self.document.operationsUpdated.emit()
+        self.emitDataChanged()
+        return True
     def reorderItem(self, direction):
         index = self.reorderItemImpl(direction, self.parent())
         if index is not None:
@@ -2346,7 +2117,7 @@ class JoinItemsUndoCommand(QUndoCommand):
         root.insertRow(pos, self.document.drawing)
         self.document.shapesUpdated.emit()
 
-class DocumentModel(QObject):
+class DocumentModel(QObject, DocumentCAM):
     propertyChanged = pyqtSignal([CAMTreeItem, str])
     cutterSelected = pyqtSignal([CycleTreeItem])
     tabEditRequested = pyqtSignal([OperationTreeItem])
@@ -2376,6 +2147,9 @@ class DocumentModel(QObject):
         self.progress_dialog_displayed = False
         self.update_suspended = None
         self.update_suspended_dirty = False
+        self.scheduler = CAMScheduler(self)
+        # Part of the drawing shown in the viewer, None if unknown
+        self.visible_bounds = None
         self.tool_list = ToolListTreeItem(self)
         self.shapeModel = QStandardItemModel()
         self.shapeModel.setHorizontalHeaderLabels(["Input object"])
@@ -2536,9 +2310,6 @@ class DocumentModel(QObject):
         self.drawing_filename = None
         self.load(data)
         self.projectLoaded.emit()
-    def makeMachineParams(self):
-        self.gcode_machine_params = gcodeops.MachineParams(safe_z=self.material.clearance, semi_safe_z=self.material.safe_entry_z,
-            min_rpm=geom.GeometrySettings.spindle_min_rpm, max_rpm=geom.GeometrySettings.spindle_max_rpm)
     def newDocument(self):
         self.reinitDocument()
         self.filename = None
@@ -2571,22 +2342,6 @@ class DocumentModel(QObject):
                 operation : OperationTreeItem = cycle.child(j)
                 res.append(func(operation))
         return res
-    def largerDiameterForShape(self, shape, min_size):
-        candidates = []
-        for operation in self.forEachOperation(lambda operation: operation):
-            pda = PresetDerivedAttributes(operation)
-            diameter_plus = operation.cutter.diameter + 2 * pda.offset
-            if (operation.shape_id is shape.shape_id) and (diameter_plus > min_size):
-                candidates.append((diameter_plus, operation))
-        if not candidates:
-            return None, None, None
-        islands = None
-        candidates = list(sorted(candidates, key = lambda item: item[0]))
-        for diameter_plus, operation in candidates:
-            if operation.areIslandsEditable() and operation.islands:
-                islands = operation.islands
-                break
-        return candidates[0][0], candidates[0][1], islands
     def operDataChanged(self, topLeft, bottomRight, roles):
         if not roles or (Qt.CheckStateRole in roles):
             changes = []
@@ -2646,16 +2401,20 @@ class DocumentModel(QObject):
                 operation.startUpdateCAM()
     def startUpdateCAM(self, subset=None):
         self.makeMachineParams()
-        if subset is None:
-            self.forEachOperation(lambda item: item.startUpdateCAM())
-        else:
-            self.forEachOperation(lambda item: item.startUpdateCAM() if item in subset else None)
+        with self.scheduler.batch():
+            if subset is None:
+                self.forEachOperation(lambda item: item.startUpdateCAM())
+            else:
+                self.forEachOperation(lambda item: item.startUpdateCAM() if item in subset else None)
     def cancelAllWorkers(self):
         self.forEachOperation(lambda item: item.cancelWorker())
+    def refinedShapeIds(self):
+        return set(self.forEachOperation(lambda item: item.shape_id if item.operation == OperationType.REFINE else None))
     def pollForUpdateCAM(self):
         has_workers = any(self.forEachOperation(lambda item: item.worker))
         if not has_workers:
             return
+        self.scheduler.poll()
         results = self.forEachOperation(lambda item: item.pollForUpdateCAM())
         totaldone = 0
         totaloverall = 0
@@ -2692,24 +2451,12 @@ class DocumentModel(QObject):
         else:
             cancelled = False
             while self.pollForUpdateCAM() is not None:
-                time.sleep(0.25)
+                self.scheduler.waitForRunning(0.25)
         return not cancelled
-    def checkCAMErrors(self):
-        return self.forEachOperation(lambda item: item.error)
-    def checkCAMWarnings(self):
-        return self.forEachOperation(lambda item: item.warning)
     def getToolbitList(self, data_type: type):
         res = [(tb.id, tb.description()) for tb in self.project_toolbits.values() if isinstance(tb, data_type)]
         #res += [(tb.id, tb.description()) for tb in inventory.inventory.toolbits if isinstance(tb, data_type) and tb.presets]
         return res
-    def validateForOutput(self):
-        def validateOperation(item):
-            if item.depth is None:
-                if self.material.thickness is None or self.material.thickness == 0:
-                    raise ValueError("Default material thickness not set")
-            if item.error is not None:
-                raise ValueError(item.error)
-        self.forEachOperation(validateOperation)
     def setOperSelection(self, selection):
         changes = []
         def setSelected(operation):
@@ -2749,6 +2496,18 @@ class DocumentModel(QObject):
             p = tool.child(i)
             if p.inventory_preset is preset:
                 return p
+    def operationInputs(self, operation):
+        # Objects whose properties affect the toolpaths of the operation
+        inputs = [self.drawing, self.material, operation.cutter, operation.tool_preset]
+        inputs += [self.drawing.itemById(i) for i in [operation.shape_id] + list(operation.islands) if i is not None]
+        inputs += operation.patternShapes()
+        return [i for i in inputs if i is not None]
+    def dependentOperations(self, source):
+        # Operations using the source object directly, plus any refine operations
+        # using their results
+        ops = self.allOperations(lambda item: any(i is source for i in self.operationInputs(item)))
+        shape_ids = set([op.shape_id for op in ops])
+        return ops + [op for op in self.refineOpsForShapes(shape_ids) if op not in ops]
     def refineOpsForShapes(self, shape_ids):
         return self.allOperations(lambda item: item.operation == OperationType.REFINE and item.shape_id in shape_ids)
     def refreshRefineForOpOrCycle(self, item):
@@ -2814,7 +2573,11 @@ class DocumentModel(QObject):
                 item = CAMTreeItem.load(self, { '_type' : 'OperationTreeItem', 'shape_id' : i, 'operation' : operationType })
                 item.cutter = cycle.cutter
                 item.tool_preset = self.default_preset_by_tool.get(item.cutter, None)
-                item.islands = shapeIds[i]
+                if operationType in (OperationType.INTERPOLATED_HOLE, OperationType.DRILLED_HOLE):
+                    # Other holes of a hole pattern, see DrawingTreeItem.holePatterns
+                    item.pattern = set(shapeIds[i])
+                else:
+                    item.islands = shapeIds[i]
                 item.startUpdateCAM()
                 self.undoStack.push(AddOperationUndoCommand(self, item, cycle, rowCount))
                 indexes.append(item.index())
@@ -2917,24 +2680,3 @@ class DocumentModel(QObject):
         self.undoStack.undo()
     def redo(self):
         self.undoStack.redo()
-
-class OpExporter(object):
-    def __init__(self, document):
-        document.waitForUpdateCAM()
-        self.machine_params = document.gcode_machine_params
-        self.operations = gcodeops.Operations(document.gcode_machine_params)
-        self.all_cutters = set([])
-        self.cutter = None
-        document.forEachOperation(self.add_cutter)
-        document.forEachOperation(self.process_operation)
-    def add_cutter(self, item):
-        if item.cam:
-            self.all_cutters.add(item.cutter)
-    def process_operation(self, item):
-        if item.cam:
-            if item.cutter != self.cutter and len(self.all_cutters) > 1:
-                self.operations.add(gcodeops.ToolChangeOperation(item.cutter, self.machine_params))
-                self.cutter = item.cutter
-            self.operations.add_all(item.cam.operations)
-    def write(self, fn):
-        self.operations.to_gcode_file(fn)
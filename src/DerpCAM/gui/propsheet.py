@@ -1,7 +1,7 @@
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
-from DerpCAM.common.guiutils import UnitConverter
+from DerpCAM.common.guiutils import EnumClass, UnitConverter
 
 def useFormat(format, value):
     if isinstance(format, str):
@@ -70,20 +70,6 @@ class SetEditableProperty(EditableProperty):
                 self.edit_func(objects[0])
             return Ellipsis
 
-class EnumClass(object):
-    @classmethod
-    def toString(classInst, value):
-        for data in classInst.descriptions:
-            if value == data[0]:
-                return data[1]
-        return None
-    @classmethod
-    def toTuple(classInst, value):
-        for data in classInst.descriptions:
-            if value == data[0]:
-                return data
-        return None
-
 class FontEditableProperty(EditableProperty):
     def createEditor(self, parent, item, objects):
         widget = QFontComboBox(parent)
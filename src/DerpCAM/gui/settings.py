@@ -2,129 +2,22 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
+from DerpCAM.common import config
+from DerpCAM.common.config import *
 from DerpCAM.common.geom import GeometrySettings
 from DerpCAM.common.guiutils import GuiSettings
 
 import os.path
 
-class ConfigSetting(object):
-    def __init__(self, attr_name, setting_pathname, def_value):
-        self.attr_name = attr_name
-        self.setting_pathname = setting_pathname
-        self.def_value = def_value
-    def init(self, target):
-        setattr(target, self.attr_name, self.def_value)
-    def load(self, settings, target):
-        if settings.contains(self.setting_pathname):
-            setattr(target, self.attr_name, self.from_setting(settings.value(self.setting_pathname)))
-    def save(self, settings, source):
-        settings.setValue(self.setting_pathname, self.to_setting(getattr(source, self.attr_name)))
-    def from_setting(self, cfgvalue):
-        return str(cfgvalue)
-    def to_setting(self, value):
-        return str(value)
-
-class IntConfigSetting(ConfigSetting):
-    def from_setting(self, cfgvalue):
-        return int(cfgvalue)
-    def to_setting(self, value):
-        return str(value)
-
-class FloatConfigSetting(ConfigSetting):
-    def __init__(self, attr_name, setting_pathname, def_value, digits):
-        ConfigSetting.__init__(self, attr_name, setting_pathname, def_value)
-        self.digits = digits
-    def from_setting(self, cfgvalue):
-        return float(cfgvalue)
-    def to_setting(self, value):
-        return f"{value:0.{self.digits}f}"
-
-class BoolConfigSetting(ConfigSetting):
-    def from_setting(self, cfgvalue):
-        return cfgvalue == 'true'
-    def to_setting(self, value):
-        return 'true' if value else 'false'
-
-class ConfigSettings(object):
-    setting_list = [
-        FloatConfigSetting('resolution', 'geometry/resolution', GeometrySettings.RESOLUTION, 1),
-        BoolConfigSetting('simplify_arcs', 'geometry/simplify_arcs', GeometrySettings.simplify_arcs),
-        BoolConfigSetting('simplify_lines', 'geometry/simplify_lines', GeometrySettings.simplify_lines),
-        BoolConfigSetting('paranoid_mode', 'gcode/paranoid_mode', GeometrySettings.paranoid_mode),
-        BoolConfigSetting('grbl_output', 'geometry/grbl_output', GeometrySettings.grbl_output),
-        BoolConfigSetting('spindle_control', 'gcode/spindle_control', GeometrySettings.spindle_control),
-        FloatConfigSetting('spindle_warmup', 'gcode/spindle_warmup', 0, 1),
-        FloatConfigSetting('spindle_min_rpm', 'gcode/spindle_min_rpm', 8000, 1),
-        FloatConfigSetting('spindle_max_rpm', 'gcode/spindle_max_rpm', 24000, 1),
-        ConfigSetting('run_after_export', 'gcode/run_after_export', ''),
-        BoolConfigSetting('draw_arrows', 'display/draw_arrows', GeometrySettings.draw_arrows),
-        FloatConfigSetting('grid_resolution', 'display/grid_resolution', 50, 2),
-        FloatConfigSetting('grid_resolution_minor', 'display/grid_resolution_minor', 10, 2),
-        ConfigSetting('input_directory', 'paths/input', ''),
-        ConfigSetting('last_input_directory', 'paths/last_input', ''),
-        ConfigSetting('gcode_directory', 'paths/gcode', ''),
-        ConfigSetting('last_gcode_directory', 'paths/last_gcode', ''),
-        FloatConfigSetting('clearance_z', 'defaults/clearance_z', 5, 2),
-        FloatConfigSetting('safe_entry_z', 'defaults/safe_entry_z', 1, 2),
-        BoolConfigSetting('dxf_inches', 'units/dxf_inches', GeometrySettings.dxf_inches),
-        BoolConfigSetting('gcode_inches', 'units/gcode_inches', GeometrySettings.gcode_inches),
-        BoolConfigSetting('display_inches', 'units/display_inches', GuiSettings.inch_mode),
-        IntConfigSetting('min_tabs', 'tabs/min_tabs', 2),
-        IntConfigSetting('max_tabs', 'tabs/max_tabs', 8),
-        FloatConfigSetting('tab_dist', 'tabs/tab_dist', 200, 1),
-        FloatConfigSetting('tab_min_length', 'tabs/tab_min_length', 50, 1),
-    ]
-    NUM_MRU = 4
-    def __init__(self):
-        self.settings = self.createSettingsObj()
-        for i in self.setting_list:
-            i.init(self)
-        self.load()
+class ConfigSettings(config.ConfigSettings):
     def createSettingsObj(self):
         return QSettings("kfoltman", "DerpCAM")
-    def loadMru(self):
-        self.settings.sync()
-        res = []
-        for i in range(self.NUM_MRU):
-            label = f"mru{i}"
-            if self.settings.contains(label):
-                filename = self.settings.value(label)
-                if os.path.exists(filename):
-                    res.append(filename)
-        return res
-    def saveMru(self, data):
-        for i in range(self.NUM_MRU):
-            label = f"mru{i}"
-            if i < len(data):
-                self.settings.setValue(label, data[i])
-            else:
-                self.settings.remove(label)
-        self.settings.sync()
-    def load(self):
-        settings = self.settings
-        settings.sync()
-        for i in self.setting_list:
-            i.load(settings, self)
-    def save(self):
-        settings = self.settings
-        for i in self.setting_list:
-            i.save(settings, self)
-        settings.sync()
-    def update(self):
-        GeometrySettings.RESOLUTION = self.resolution
-        GeometrySettings.simplify_arcs = self.simplify_arcs
-        GeometrySettings.simplify_lines = self.simplify_lines
-        GeometrySettings.paranoid_mode = self.paranoid_mode
-        GeometrySettings.draw_arrows = self.draw_arrows
-        GeometrySettings.dxf_inches = self.dxf_inches
-        GeometrySettings.gcode_inches = self.gcode_inches
-        GeometrySettings.grbl_output = self.grbl_output
-        GeometrySettings.spindle_control = self.spindle_control
-        GeometrySettings.spindle_warmup = self.spindle_warmup
-        GeometrySettings.spindle_min_rpm = self.spindle_min_rpm
-        GeometrySettings.spindle_max_rpm = self.spindle_max_rpm
-        GeometrySettings.run_after_export = self.run_after_export
-        GuiSettings.inch_mode = self.display_inches
+    def camCacheDir(self):
+        # Not using CacheLocation, as it depends on the application name set after the settings are loaded
+        location = QStandardPaths.writableLocation(QStandardPaths.GenericCacheLocation)
+        if not location:
+            return None
+        return os.path.join(location, "DerpCAM", "toolpaths")
 
 class DirectorySelector(QWidget):
     def __init__(self):
@@ -192,9 +85,22 @@ class PreferencesDialog(QDialog):
         self.simplifyArcsCheck = QCheckBox("&Convert lines to arcs")
         self.simplifyArcsCheck.setChecked(self.config.simplify_arcs)
         self.formCAM.addRow(self.simplifyArcsCheck)
-        self.simplifyLinesCheck = QCheckBox("&Merge short segments (experimental)")
+        self.simplifyLinesCheck = QCheckBox("&Merge short segments")
         self.simplifyLinesCheck.setChecked(self.config.simplify_lines)
         self.formCAM.addRow(self.simplifyLinesCheck)
+        self.simplifyToleranceSpin = floatSpin(0.001, 1, 3, self.config.simplify_tolerance, "Maximum deviation from the original path when merging short segments.")
+        self.formCAM.addRow("Merge &tolerance (mm):", self.simplifyToleranceSpin)
+        self.workerProcessesSpin = intSpin(0, 64, self.config.worker_processes, "Number of processes used for the parts of the calculations that can run in parallel, 0 = none.")
+        self.formCAM.addRow("&Worker processes:", self.workerProcessesSpin)
+        self.parallelGcodeCheck = QCheckBox("Generate G-code in the worker processes")
+        self.parallelGcodeCheck.setToolTip("Only faster for the operations that take long to output, like engraving text or drilling hole patterns")
+        self.parallelGcodeCheck.setChecked(self.config.parallel_gcode)
+        self.formCAM.addRow(self.parallelGcodeCheck)
+        self.camCacheCheck = QCheckBox("&Keep calculated toolpaths between sessions")
+        self.camCacheCheck.setChecked(self.config.cam_cache)
+        self.formCAM.addRow(self.camCacheCheck)
+        self.camCacheSizeSpin = intSpin(1, 100000, self.config.cam_cache_size, "Maximum disk space used for the calculated toolpaths, in megabytes.")
+        self.formCAM.addRow("Toolpath cache si&ze (MB):", self.camCacheSizeSpin)
         self.paranoidModeCheck = QCheckBox("&Paranoid mode: never use rapids below safe entry Z")
         self.paranoidModeCheck.setToolTip("Forbid rapid Z moves into previously removed stock or outside stock boundaries")
         self.paranoidModeCheck.setChecked(self.config.paranoid_mode)
@@ -202,6 +108,19 @@ class PreferencesDialog(QDialog):
         self.grblOutputCheck = QCheckBox("&Output Grbl variant of G-Code")
         self.grblOutputCheck.setChecked(self.config.grbl_output)
         self.formCAM.addRow(self.grblOutputCheck)
+        self.reorderCutsCheck = QCheckBox("Reorder cuts to s&horten rapid moves")
+        self.reorderCutsCheck.setToolTip("Change the order of the toolpaths and operations using the same tool, keeping overlapping cuts in the original order")
+        self.reorderCutsCheck.setChecked(self.config.reorder_cuts)
+        self.formCAM.addRow(self.reorderCutsCheck)
+        self.cannedCyclesCheck = QCheckBox("Use ca&nned drilling cycles (G81/G82/G83/G73)")
+        self.cannedCyclesCheck.setToolTip("Output peck drilling using the drilling cycles of the controller instead of individual moves, not used for Grbl")
+        self.cannedCyclesCheck.setChecked(self.config.canned_cycles)
+        self.formCAM.addRow(self.cannedCyclesCheck)
+        self.subroutinesCombo = QComboBox()
+        self.subroutinesCombo.addItems(["Not used", "LinuxCNC (O-word sub/call)", "Subprograms (M98/M99)"])
+        self.subroutinesCombo.setToolTip("Output repeated toolpaths, like the same contour at every depth, once and call them as subroutines, not used for Grbl")
+        self.subroutinesCombo.setCurrentIndex(self.config.gcode_subroutines)
+        self.formCAM.addRow("Su&broutines for repeated toolpaths:", self.subroutinesCombo)
         self.spindleControlCheck = QCheckBox("&Generate spindle control commands")
         self.spindleControlCheck.setChecked(self.config.spindle_control)
         self.formCAM.addRow(self.spindleControlCheck)
@@ -282,8 +201,16 @@ class PreferencesDialog(QDialog):
         self.config.resolution = self.resolutionSpin.value()
         self.config.simplify_arcs = self.simplifyArcsCheck.isChecked()
         self.config.simplify_lines = self.simplifyLinesCheck.isChecked()
+        self.config.simplify_tolerance = self.simplifyToleranceSpin.value()
+        self.config.worker_processes = self.workerProcessesSpin.value()
+        self.config.parallel_gcode = self.parallelGcodeCheck.isChecked()
+        self.config.cam_cache = self.camCacheCheck.isChecked()
+        self.config.cam_cache_size = self.camCacheSizeSpin.value()
         self.config.paranoid_mode = self.paranoidModeCheck.isChecked()
         self.config.grbl_output = self.grblOutputCheck.isChecked()
+        self.config.reorder_cuts = self.reorderCutsCheck.isChecked()
+        self.config.canned_cycles = self.cannedCyclesCheck.isChecked()
+        self.config.gcode_subroutines = self.subroutinesCombo.currentIndex()
         self.config.spindle_control = self.spindleControlCheck.isChecked()
         self.config.spindle_warmup = self.warmupSpin.value()
         self.config.spindle_min_rpm = self.minRPMSpin.value()
@@ -386,6 +386,6 @@ class CutterListDialogTest(CutterMgrTestBase):
         self.assertEqual(dlg.editButton.text(), editText)
         self.assertEqual(dlg.deleteButton.text(), deleteText)
 
-unittest.main()
-
-del app
+if __name__ == '__main__':
+    unittest.main()
+    del app
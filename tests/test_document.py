@@ -1,6 +1,8 @@
 import os.path
 import sys
 import math
+import tempfile
+import threading
 import unittest
 sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
 
@@ -9,6 +11,8 @@ from DerpCAM import gui
 import DerpCAM.gui.inventory
 import DerpCAM.gui.model
 import DerpCAM.gui.settings
+import DerpCAM.engine.operation
+import DerpCAM.engine.project
 
 from PyQt5.QtCore import QSettings, Qt
 from PyQt5.QtWidgets import QApplication
@@ -387,6 +391,276 @@ class DocumentTest(unittest.TestCase):
         self.assertEqual(cycle.checkState(), Qt.CheckState.PartiallyChecked)
         self.assertEqual(cycle.child(0).checkState(), Qt.CheckState.Unchecked)
         self.assertEqual(cycle.child(1).checkState(), Qt.CheckState.Checked)
+    def testWorkerProcesses(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+        doc.opCreateOperation({15: []}, gui.model.OperationType.POCKET, cycle)
+        doc.opCreateOperation({23: [], 24: []}, gui.model.OperationType.ENGRAVE, cycle)
+        doc.cancelAllWorkers()
+        def calculate(worker_processes, worker_type):
+            try:
+                geom.GeometrySettings.worker_processes = worker_processes
+                # Inputs are unchanged, so force recalculating from scratch
+                for item in doc.allOperations():
+                    item.cam_input_hash = None
+                doc.startUpdateCAM()
+                self.assertIs(type(cycle.child(1).worker), worker_type)
+                self.assertTrue(doc.waitForUpdateCAM())
+            finally:
+                geom.GeometrySettings.worker_processes = 0
+            self.assertFalse(any(doc.checkCAMErrors()))
+            return gui.model.OpExporter(doc).operations.to_gcode().gcode
+        gcode = calculate(0, gui.model.WorkerThread)
+        self.assertEqual(calculate(2, gui.model.WorkerProcess), gcode)
+        # Cancelling the calculations running in the worker processes
+        try:
+            geom.GeometrySettings.worker_processes = 2
+            doc.startUpdateCAM()
+            doc.cancelAllWorkers()
+        finally:
+            geom.GeometrySettings.worker_processes = 0
+        self.assertFalse(any(doc.forEachOperation(lambda item: item.worker)))
+    def testScheduler(self):
+        doc = self.document
+        doc.load(testDocument2)
+        cutter = gui.inventory.EndMillCutter.new(None, "test cutter", gui.inventory.CutterMaterial.HSS, 3, 15, 2)
+        doc.opAddCutter(cutter)
+        cycle = doc.cycleForCutter(cutter)
+        doc.opCreateOperation({1: [], 2: [], 3: [], 4: [], 5: []}, gui.model.OperationType.ENGRAVE, cycle)
+        # Not calculated (no larger cutter to refine after), but gives priority to the other operation on that shape
+        doc.opCreateOperation({5: []}, gui.model.OperationType.REFINE, cycle)
+        doc.cancelAllWorkers()
+        engraves = {item.shape_id: item for item in cycle.items() if item.operation == gui.model.OperationType.ENGRAVE}
+        self.assertEqual(len(engraves), 5)
+        scheduler = doc.scheduler
+        old_max_threads = scheduler.max_threads
+        try:
+            scheduler.max_threads = 1
+            # Only overlaps with the line (shape 4)
+            doc.visible_bounds = (30, -21, 35, -19)
+            doc.setOperSelection([engraves[2]])
+            doc.startUpdateCAM()
+            self.assertEqual(scheduler.runningCount(), 1)
+            self.assertEqual(scheduler.queueDepth(), 4)
+            with scheduler.lock:
+                started = [entry.item for entry in scheduler.running]
+                for entry in scheduler.pending:
+                    entry.worker.start = lambda entry=entry, start=entry.worker.start: (started.append(entry.item), start())
+            self.assertTrue(doc.waitForUpdateCAM())
+            self.assertEqual(started, [engraves[2], engraves[5], engraves[4], engraves[1], engraves[3]])
+            self.assertEqual(scheduler.queueDepth(), 0)
+            self.assertEqual(scheduler.runningCount(), 0)
+            self.assertIsNotNone(scheduler.averageLatency())
+            # Superseded workers are removed from the queue
+            cutter.diameter = 4
+            doc.startUpdateCAM()
+            self.assertEqual(scheduler.queueDepth(), 4)
+            cutter.diameter = 5
+            doc.startUpdateCAM(subset=[engraves[1], engraves[3]])
+            self.assertEqual(scheduler.queueDepth(), 4)
+            # Cancelling waits for the scheduler, so that it can't start the
+            # worker in the meantime
+            worker = engraves[1].worker
+            self.assertIs(worker.cam, engraves[1].cam)
+            with scheduler.lock:
+                thread = threading.Thread(target=engraves[1].cancelWorker)
+                thread.start()
+                thread.join(0.1)
+                self.assertTrue(thread.is_alive())
+                self.assertFalse(worker.cancelled)
+            thread.join()
+            self.assertTrue(worker.cancelled)
+            doc.cancelAllWorkers()
+            self.assertEqual(scheduler.queueDepth(), 0)
+            self.assertEqual(scheduler.runningCount(), 0)
+        finally:
+            scheduler.max_threads = old_max_threads
+            doc.visible_bounds = None
+    def testIncrementalUpdate(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+        doc.opCreateOperation({23: []}, gui.model.OperationType.ENGRAVE, cycle)
+        self.assertTrue(doc.waitForUpdateCAM())
+        ops = {item.shape_id: item for item in cycle.items()}
+        circle = doc.drawing.itemById(9)
+        self.assertEqual(circle.invalidatedObjects(gui.model.InvalidateAspect.CAM), set([circle, ops[9]]))
+        self.assertEqual(set(doc.dependentOperations(doc.material)), set(ops.values()))
+        def calculate():
+            cams = {shape_id: item.cam for shape_id, item in ops.items()}
+            doc.startUpdateCAM()
+            self.assertTrue(doc.waitForUpdateCAM())
+            self.assertFalse(any(doc.checkCAMErrors()))
+            return set(shape_id for shape_id, item in ops.items() if item.cam is not cams[shape_id])
+        self.assertEqual(calculate(), set())
+        # Same effective value as the one from the preset
+        ops[9].hfeed = 500
+        self.assertEqual(calculate(), set())
+        ops[9].hfeed = 400
+        self.assertEqual(calculate(), set([9]))
+        doc.opChangeProperty(circle.prop_x, [(circle, 100)])
+        self.assertEqual(calculate(), set([9]))
+        doc.opChangeProperty(doc.material.prop_thickness, [(doc.material, 4)])
+        self.assertEqual(calculate(), set([9, 15, 23]))
+        doc.undo()
+        self.assertEqual(calculate(), set([9, 15, 23]))
+        # Deactivated operations are recalculated when enabled again
+        ops[15].active = False
+        ops[15].updateCheckState()
+        self.assertIsNone(ops[15].cam)
+        self.assertEqual(calculate(), set())
+        ops[15].active = True
+        ops[15].updateCheckState()
+        self.assertEqual(calculate(), set([15]))
+        self.assertIsNotNone(ops[15].cam)
+        # Per-operation simplification tolerance
+        ops[15].simplify_tolerance = 0.05
+        self.assertEqual(calculate(), set([15]))
+        self.assertEqual(ops[15].gcode_props.simplify_tolerance, 0.05)
+        # G-code output settings don't invalidate the toolpaths
+        try:
+            geom.GeometrySettings.grbl_output = True
+            geom.GeometrySettings.canned_cycles = True
+            self.assertEqual(calculate(), set())
+        finally:
+            geom.GeometrySettings.grbl_output = False
+            geom.GeometrySettings.canned_cycles = False
+    def testZStageUpdate(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+        doc.opCreateOperation({15: []}, gui.model.OperationType.POCKET, cycle)
+        self.assertTrue(doc.waitForUpdateCAM())
+        ops = [item for item in cycle.items() if item.shape_id == 15]
+        def recalculate():
+            doc.startUpdateCAM()
+            self.assertTrue(doc.waitForUpdateCAM())
+            self.assertFalse(any(doc.checkCAMErrors()))
+            return gui.model.OpExporter(doc).operations.to_gcode().gcode
+        for name, value in [('hfeed', 400), ('vfeed', 50), ('rpm', 12000), ('doc', 1), ('depth', 3), ('start_depth', 1), ('tab_height', 1)]:
+            for item in ops:
+                setattr(item, name, value)
+            doc.startUpdateCAM()
+            # Toolpaths are reused instead of recalculated in a worker
+            self.assertFalse(any(doc.forEachOperation(lambda item: item.worker)))
+            gcode = gui.model.OpExporter(doc).operations.to_gcode().gcode
+            for item in ops:
+                item.cam_input_hash = None
+            self.assertEqual(recalculate(), gcode)
+        ops[1].offset = 0.5
+        doc.startUpdateCAM()
+        self.assertIsNotNone(ops[1].worker)
+        self.assertTrue(doc.waitForUpdateCAM())
+    def testTranslation(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+        self.assertTrue(doc.waitForUpdateCAM())
+        op = [item for item in cycle.items() if item.shape_id == 15][0]
+        cam = op.cam
+        gcode = gui.model.OpExporter(doc).operations.to_gcode().gcode
+        doc.drawing.x_offset = 0
+        doc.drawing.y_offset = -5
+        doc.startUpdateCAM()
+        # Moving the origin does not recalculate the toolpaths
+        self.assertIsNone(op.worker)
+        self.assertIs(op.cam, cam)
+        gcode2 = gui.model.OpExporter(doc).operations.to_gcode().gcode
+        self.assertEqual(len(gcode), len(gcode2))
+        for line, line2 in zip(gcode, gcode2):
+            words = dict((word[0], word[1:]) for word in line.split(" ")[1:])
+            words2 = dict((word[0], word[1:]) for word in line2.split(" ")[1:])
+            self.assertEqual(words.keys(), words2.keys())
+            for axis, delta in [('X', 10), ('Y', 25)]:
+                if axis in words and line.startswith(('G1', 'G2', 'G3')):
+                    self.assertAlmostEqual(float(words2[axis]), float(words[axis]) + delta, places=2)
+    def testToolpathCache(self):
+        doc = self.document
+        with tempfile.TemporaryDirectory() as cache_dir:
+            geom.GeometrySettings.cam_cache_dir = cache_dir
+            try:
+                doc.load(testDocument1)
+                cycle = doc.allCycles()[0]
+                doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+                doc.opCreateOperation({15: []}, gui.model.OperationType.POCKET, cycle)
+                self.assertTrue(doc.waitForUpdateCAM())
+                self.assertFalse(any(doc.checkCAMErrors()))
+                gcode = gui.model.OpExporter(doc).operations.to_gcode().gcode
+                self.assertEqual(len(os.listdir(cache_dir)), 3)
+                data = doc.store()
+                for item in doc.allOperations():
+                    item.doc = 1
+                data2 = doc.store()
+                # Loaded without recalculating anything, including when only the depths differ
+                for dump, is_same in [(data, True), (data2, False)]:
+                    doc2 = gui.model.DocumentModel(config_settings)
+                    doc2.load(dump)
+                    self.assertFalse(any(doc2.forEachOperation(lambda item: item.worker)))
+                    self.assertTrue(all(doc2.forEachOperation(lambda item: item.cam)))
+                    self.assertEqual(gui.model.OpExporter(doc2).operations.to_gcode().gcode == gcode, is_same)
+                # Different toolpaths
+                cycle.child(0).offset = 0.5
+                doc.startUpdateCAM()
+                self.assertIsNotNone(cycle.child(0).worker)
+                self.assertTrue(doc.waitForUpdateCAM())
+                self.assertEqual(len(os.listdir(cache_dir)), 4)
+            finally:
+                geom.GeometrySettings.cam_cache_dir = None
+    def testHeadlessEngine(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        doc.opCreateOperation({15: []}, gui.model.OperationType.OUTSIDE_CONTOUR, cycle)
+        doc.opCreateOperation({15: []}, gui.model.OperationType.POCKET, cycle)
+        doc.opCreateOperation({23: [], 24: []}, gui.model.OperationType.ENGRAVE, cycle)
+        cycle.child(1).offset = 0.25
+        cycle.child(2).simplify_tolerance = 0
+        doc.startUpdateCAM()
+        self.assertTrue(doc.waitForUpdateCAM())
+        gcode = gui.model.OpExporter(doc).operations.to_gcode().gcode
+        prj = DerpCAM.engine.project.Project(config_settings)
+        prj.load(doc.store())
+        ops = prj.forEachOperation(lambda op: op)
+        self.assertEqual(len(ops), 5)
+        for item, op in zip(doc.allOperations(), ops):
+            self.assertEqual(item.inputHash(), op.inputHash())
+        self.assertEqual(DerpCAM.engine.operation.OpExporter(prj).operations.to_gcode().gcode, gcode)
+    def testHolePattern(self):
+        doc = self.document
+        doc.load(testDocument1)
+        cycle = doc.allCycles()[0]
+        circles = [gui.model.DrawingCircleTreeItem(doc, geom.PathPoint(20 * (i % 5), 20 * (i // 5)), 6) for i in range(20)]
+        circles += [gui.model.DrawingCircleTreeItem(doc, geom.PathPoint(150, 10 * i), 5) for i in range(3)]
+        doc.opAddDrawingItems(circles)
+        shapeIds = doc.drawing.holePatterns(circles[::-1])
+        self.assertEqual(shapeIds, {circles[22].shape_id: {circles[20].shape_id, circles[21].shape_id}, circles[19].shape_id: set(i.shape_id for i in circles[:19])})
+        doc.opCreateOperation(shapeIds, gui.model.OperationType.INTERPOLATED_HOLE, cycle)
+        self.assertTrue(doc.waitForUpdateCAM())
+        self.assertFalse(any(doc.checkCAMErrors()))
+        ops = [item for item in cycle.items() if item.pattern]
+        self.assertEqual([len(op.cam.operations) for op in ops], [1, 1])
+        self.assertEqual([len(op.cam.operations[0].centres) for op in ops], [3, 20])
+        self.assertIn("and 19 more", ops[1].data(Qt.DisplayRole).value())
+        gcode = gui.model.OpExporter(doc).operations.to_gcode().gcode
+        self.assertEqual(len([line for line in gcode if line.startswith("(Start helical drill at ")]), 23)
+        # Saved and calculated the same way by the headless engine
+        prj = DerpCAM.engine.project.Project(config_settings)
+        prj.load(doc.store())
+        for item, op in zip(doc.allOperations(), prj.forEachOperation(lambda op: op)):
+            self.assertEqual(op.pattern, item.pattern)
+            self.assertEqual(item.inputHash(), op.inputHash())
+        self.assertEqual(DerpCAM.engine.operation.OpExporter(prj).operations.to_gcode().gcode, gcode)
+        # Changing one of the holes
+        circles[0].setPropertyValue('diameter', 10)
+        doc.startUpdateCAM()
+        self.assertTrue(doc.waitForUpdateCAM())
+        self.assertEqual(ops[1].error, "All holes of the pattern must be circles of the same diameter")
+        self.assertIsNone(ops[0].error)
     def verifyCutter(self, cutter, description):
         doc = self.document
         doc.opAddCutter(cutter)
@@ -622,6 +896,6 @@ class OpTypeTest(unittest.TestCase):
             else:
                 assert cutter_types == gui.inventory.EndMillCutter
 
-unittest.main()
-
-del app
+if __name__ == '__main__':
+    unittest.main()
+    del app
@@ -0,0 +1,128 @@
+import json
+import os.path
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from DerpCAM.common import config, geom
+from DerpCAM.cam import ptext
+from DerpCAM.engine import batch, project
+
+testProject = {
+    "material": { "_type": "WorkpieceTreeItem", "material": 1, "thickness": 3, "clearance": 5, "safe_entry_z": 1 },
+    "tools": [
+        { "_type": "EndMillCutter", "id": 1, "name": "test cutter", "material": "carbide", "diameter": 3, "length": 10.0, "flutes": 2 },
+    ],
+    "tool_presets": [
+        { "_type": "EndMillPreset", "id": 2, "name" : "test preset", "toolbit": 1,
+          "rpm": 16000, "hfeed": 500, "vfeed": 100, "maxdoc": 1, "stepover": 0.4, "direction": 1 },
+    ],
+    "default_presets": [ { "tool_id": 1, "preset_id": 2 } ],
+    "drawing": {
+        "header": { "_type": "DrawingTreeItem", "x_offset": 0, "y_offset": 0 },
+        "items": [
+            { "_type": "DrawingCircleTreeItem", "shape_id": 1, "cx": 0, "cy": 0, "r": 10 },
+            { "_type": "DrawingPolylineTreeItem", "shape_id": 2, "points": [[20, 0], [40, 0], [40, 20], [20, 20]], "closed": True},
+        ],
+    },
+    "operation_cycles": [
+        {
+            "tool_id": 1, "is_current": True,
+            "operations": [
+                { "_type": "OperationTreeItem", "operation": 1, "cutter": 1, "tool_preset": 2, "shape_id": 1 },
+                { "_type": "OperationTreeItem", "operation": 4, "cutter": 1, "tool_preset": 2, "shape_id": 2 },
+            ],
+        },
+    ],
+}
+
+class EngineTest(unittest.TestCase):
+    def loadedModules(self, modules):
+        code = f"import sys; {modules}; print(' '.join(sorted(set(m.split('.')[0] for m in sys.modules))))"
+        env = dict(os.environ, PYTHONPATH=os.path.join(os.path.dirname(os.path.abspath(__file__)), '../src'), QT_QPA_PLATFORM='offscreen')
+        return subprocess.check_output([sys.executable, "-c", code], env=env).decode().split()
+    def testNoQt(self):
+        loaded = self.loadedModules("import DerpCAM.engine.project, DerpCAM.engine.batch")
+        self.assertNotIn("PyQt5", loaded)
+    def testLazyImports(self):
+        # Only needed for DXF files, text, pockets or HSM
+        for modules in ["import DerpCAM.engine.project, DerpCAM.engine.batch", "from DerpCAM.gui import model, settings, cutter_mgr, main_win"]:
+            loaded = self.loadedModules(modules)
+            for module in ["ezdxf", "shapely", "hsm_nibble", "pyvoronoi"]:
+                self.assertNotIn(module, loaded, modules)
+    def testIniSettings(self):
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, "DerpCAM.conf")
+            with open(fn, "w") as f:
+                f.write('[General]\nmru_count=2\n\n[geometry]\nresolution=20.0\ncam_cache=false\n\n[gcode]\nrun_after_export="echo \\"a b\\""\n')
+            settings = config.IniSettings(fn)
+            self.assertTrue(settings.contains("mru_count"))
+            self.assertFalse(settings.contains("General/mru_count"))
+            self.assertEqual(settings.value("geometry/resolution"), "20.0")
+            self.assertEqual(settings.value("gcode/run_after_export"), 'echo "a b"')
+            config_settings = config.ConfigSettings()
+            config_settings.settings = settings
+            config_settings.load()
+            self.assertEqual(config_settings.resolution, 20)
+            self.assertFalse(config_settings.cam_cache)
+            self.assertEqual(config_settings.run_after_export, 'echo "a b"')
+        self.assertFalse(config.IniSettings(fn).contains("mru_count"))
+    def testLoadProject(self):
+        prj = project.Project(config.ConfigSettings())
+        prj.load(testProject)
+        ops = prj.forEachOperation(lambda op: op)
+        self.assertEqual(len(ops), 2)
+        for op in ops:
+            op.updateOrigShape()
+        self.assertIsInstance(ops[0].orig_shape, project.DrawingCircle)
+        self.assertIsInstance(ops[1].orig_shape, project.DrawingPolyline)
+        self.assertEqual([op.store()['shape_id'] for op in ops], [1, 2])
+        self.assertIs(ops[0].cutter, ops[1].cutter)
+        self.assertEqual(ops[0].tool_preset.name, "test preset")
+    def testText(self):
+        style = ptext.DrawingTextStyle(10, 1, ptext.DrawingTextStyleHAlign.LEFT, ptext.DrawingTextStyleVAlign.BASELINE, 0, "Bitstream Vera Sans", 0)
+        paths = ptext.text_to_paths(geom.PathPoint(100, 50), None, style, "HI")
+        self.assertEqual(len(paths), 2)
+        self.assertTrue(all(path.closed for path in paths))
+        bounds = geom.max_bounds(*[path.bounds() for path in paths])
+        self.assertAlmostEqual(bounds[1], 50, delta=0.1)
+        self.assertAlmostEqual(bounds[3], 60, delta=0.5)
+        self.assertGreater(bounds[0], 100)
+        self.assertEqual(len(ptext.paths_to_shapes(paths)), 2)
+        style.halign = ptext.DrawingTextStyleHAlign.RIGHT
+        paths2 = ptext.text_to_paths(geom.PathPoint(100, 50), None, style, "HI")
+        bounds2 = geom.max_bounds(*[path.bounds() for path in paths2])
+        self.assertLess(bounds2[2], 100)
+        self.assertAlmostEqual(bounds2[2] - bounds2[0], bounds[2] - bounds[0], delta=0.1)
+    def testBatch(self):
+        with tempfile.TemporaryDirectory() as dir:
+            inputs = []
+            for name in ["a", "b"]:
+                fn = os.path.join(dir, name + ".dcp")
+                with open(fn, "w") as f:
+                    json.dump(testProject, f)
+                inputs.append(fn)
+            out_dir = os.path.join(dir, "out")
+            self.assertEqual(batch.main(inputs + ["-j", "2", "-o", out_dir, "--no-cache"]), 0)
+            with open(os.path.join(out_dir, "a.ngc"), "r") as f:
+                gcode_a = f.read()
+            with open(os.path.join(out_dir, "b.ngc"), "r") as f:
+                gcode_b = f.read()
+            self.assertEqual(gcode_a, gcode_b)
+            self.assertIn("M2", gcode_a)
+            self.assertEqual(batch.main([inputs[0], "--suffix", ".nc", "--no-cache"]), 0)
+            with open(os.path.join(dir, "a.nc"), "r") as f:
+                self.assertEqual(f.read(), gcode_a)
+            broken = os.path.join(dir, "broken.dcp")
+            with open(broken, "w") as f:
+                f.write("{")
+            self.assertEqual(batch.main([broken, inputs[1], "-o", out_dir, "--no-cache"]), 2)
+            self.assertFalse(os.path.exists(os.path.join(out_dir, "broken.ngc")))
+            self.assertEqual(batch.main([os.path.join(dir, "a.ngc")]), 1)
+            self.assertEqual(batch.main(inputs + [os.path.join(dir, "x", "a.dcp"), "-o", out_dir]), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,19 @@
+import copy
 import os
+import pickle
+import random
 import sys
+import tempfile
 import unittest
 
+import numpy
+
 sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
 
 from DerpCAM.common.geom import *
 from DerpCAM.cam.gcodegen import *
+from DerpCAM.cam.gcodeops import *
+from DerpCAM.cam import cut_order
 from DerpCAM.cam.milling_tool import *
 from DerpCAM.cam.toolpath import *
 from DerpCAM.cam.wall_profile import *
@@ -14,6 +22,15 @@ machine_params = MachineParams(5, 1)
 tool = standard_tool(2, 2, material_mildsteel, carbide_uncoated)
 tool.maxdoc = 1
 
+# Calculates the operations, each of them given as the name of the method of
+# Operations that adds it, followed by the arguments
+def calculate(props, calls, tool=tool, translation=(0, 0)):
+    operations = Operations(machine_params, tool, props)
+    operations.translation = translation
+    for method, *args in calls:
+        getattr(operations, method)(*args)
+    return operations
+
 class LayerScheduleTest(unittest.TestCase):
     def assertNear(self, v1, v2, places=3, msg=None):
         self.assertAlmostEqual(v1, v2, places=places, msg=msg)
@@ -136,4 +153,375 @@ class LayerScheduleTest(unittest.TestCase):
                     self.assertGreaterEqual(last - i.offsets.start_offset, offset_tolerance)
                 last = i.offsets.start_offset
 
-unittest.main()
+class ZStageTest(unittest.TestCase):
+    rect = shapes.Shape.rectangle(0, 0, 30, 20)
+    calls = [("outside_contour", rect, 4), ("pocket", rect), ("pocket_hsm", shapes.Shape.circle(50, 10, 8))]
+    def testZStage(self):
+        tool1 = tool.clone_with_overrides(maxdoc=1)
+        tool2 = tool.clone_with_overrides(hfeed=tool.hfeed * 0.5, vfeed=tool.vfeed * 0.5, maxdoc=0.75)
+        props1 = OperationProps(depth=-3, tab_depth=-2.5)
+        props2 = OperationProps(depth=-4, start_depth=-0.5, tab_depth=-2)
+        operations = calculate(props1, self.calls, tool1)
+        original = operations.to_gcode().gcode
+        expected = calculate(props2, self.calls, tool2.clone_with_overrides()).to_gcode().gcode
+        updated = operations.with_z_params(machine_params, tool2, props2, None)
+        self.assertEqual(updated.to_gcode().gcode, expected)
+        # The original operations still use the old feeds
+        self.assertEqual(tool1.maxdoc, 1)
+        self.assertEqual(operations.to_gcode().gcode, original)
+        # Toolpaths are reused
+        for old, new in zip(operations.operations, updated.operations):
+            self.assertIsNot(old.cutpaths[0], new.cutpaths[0])
+            if isinstance(old.cutpaths[0], CutPathWallProfile):
+                for key, csubpaths in old.cutpaths[0].calculated_layers.items():
+                    self.assertIs(new.cutpaths[0].calculated_layers[key].subpaths, csubpaths.subpaths)
+            else:
+                self.assertIs(new.cutpaths[0].subpaths_full, old.cutpaths[0].subpaths_full)
+    def testZStageNotAvailable(self):
+        # Callbacks for calculating the toolpaths aren't pickled, so the tabs
+        # cannot be added later
+        tool1 = tool.clone_with_overrides(maxdoc=1)
+        props1 = OperationProps(depth=-3, tab_depth=-3)
+        props2 = OperationProps(depth=-3, tab_depth=-1.5)
+        operations = calculate(props1, self.calls, tool1)
+        operations.operations = pickle.loads(pickle.dumps(operations.operations))
+        with self.assertRaises(ToolpathsNotAvailable):
+            operations.with_z_params(machine_params, tool1, props2, None)
+        # No new layers needed
+        props3 = OperationProps(depth=-2, tab_depth=-2)
+        expected = calculate(props3, self.calls, tool1.clone_with_overrides()).to_gcode().gcode
+        self.assertEqual(operations.with_z_params(machine_params, tool1, props3, None).to_gcode().gcode, expected)
+
+class FormattingTest(unittest.TestCase):
+    def moves(self):
+        # Includes negative zeros, values halfway between two roundings and repeated positions
+        values = [0, -0.0001, 0.0004, -0.0005, 0.0005, 1.0005, -2.0015, 2.675, 12.5, 100, -100.1, 3.14159, 0.0625, 99999.9999]
+        moves = []
+        for i, value in enumerate(values):
+            moves.append((0, value, -value, None, None, None))
+            moves.append((1, value, value, -i * 0.1, None, None))
+            moves.append((1, value, value, -i * 0.1, None, None))
+            moves.append((2 + i % 2, value + 1, value, None, -value, 0.0005))
+            moves.append((1, None, None, value, None, None))
+        return moves
+    def generate(self, moves, batch_min, inch_mode=False, translation=(0, 0)):
+        old_batch_min = Gcode.BATCH_MIN
+        try:
+            Gcode.BATCH_MIN = batch_min
+            gcode = Gcode()
+            gcode.inch_mode = inch_mode
+            gcode.translation = translation
+            gcode.linear(x=0, y=0)
+            gcode.add_moves(moves)
+            gcode.add_moves(moves[:4])
+            gcode.linear(x=1, y=1)
+            return gcode.gcode
+        finally:
+            Gcode.BATCH_MIN = old_batch_min
+    def testFixedPoint(self):
+        values = numpy.array([0, -0.0, -0.0004, 0.0005, -1.0005, 1.5, 10, -123.4567, 0.1 + 0.2, numpy.nan])
+        chars, keys = fixed_point_array(values, 3)
+        for value, row, key in zip(values, chars, keys):
+            if numpy.isnan(value):
+                self.assertEqual(row[row != 0].tobytes(), b"")
+                self.assertEqual(key, ABSENT)
+            else:
+                self.assertEqual((row[row != 0].tobytes().decode(), key), fixed_point(value, 3))
+        self.assertEqual(fixed_point(-0.0001, 3), ("-0", -1))
+        self.assertEqual(fixed_point(12.5, 3), ("12.5", 25000))
+        self.assertIsNone(fixed_point_array(numpy.array([1e9]), 3))
+    def testBatched(self):
+        moves = self.moves()
+        for inch_mode in (False, True):
+            for translation in ((0, 0), (10.0005, -0.25)):
+                expected = self.generate(moves, 1 << 30, inch_mode, translation)
+                self.assertEqual(self.generate(moves, 1, inch_mode, translation), expected)
+        # Too large for the fixed-point formatting, uses the slow path
+        moves.append((1, 1e12, 0, None, None, None))
+        self.assertEqual(self.generate(moves, 1), self.generate(moves, 1 << 30))
+
+class StreamingTest(unittest.TestCase):
+    rect = shapes.Shape.rectangle(0, 0, 30, 20)
+    calls = [("outside_contour", rect, 4), ("pocket", rect), ("peck_drill", 40, 10)]
+    def testStreaming(self):
+        operations = calculate(OperationProps(depth=-3, tab_depth=-2), self.calls)
+        expected = operations.to_gcode().gcode
+        old_flush_size = Gcode.FLUSH_SIZE
+        try:
+            # Flush often, so that the feed merging and deduplication happen across the flushes
+            for flush_size in (1, 2, 3, 7):
+                Gcode.FLUSH_SIZE = flush_size
+                chunks = []
+                gcode = operations.to_gcode(chunks.append)
+                self.assertEqual(gcode.gcode, [])
+                self.assertEqual(gcode.line_count(), len(expected))
+                self.assertLessEqual(max(len(chunk) for chunk in chunks), max(flush_size, 1))
+                self.assertEqual(sum(chunks, []), expected)
+        finally:
+            Gcode.FLUSH_SIZE = old_flush_size
+        self.assertEqual(list(operations.to_gcode_iter()), expected)
+    def testFile(self):
+        operations = calculate(OperationProps(depth=-3, tab_depth=-2), self.calls)
+        expected = operations.to_gcode().gcode
+        with tempfile.TemporaryDirectory() as dir:
+            fn = os.path.join(dir, "test.ngc")
+            operations.to_gcode_file(fn)
+            with open(fn, "r") as f:
+                self.assertEqual(f.read().split("\n"), expected + [""])
+            self.assertEqual(os.listdir(dir), ["test.ngc"])
+            # The previous file is left alone if the generation fails
+            operations.operations.append(None)
+            with self.assertRaises(AttributeError):
+                operations.to_gcode_file(fn)
+            self.assertEqual(os.listdir(dir), ["test.ngc"])
+            with open(fn, "r") as f:
+                self.assertEqual(f.read().split("\n"), expected + [""])
+
+class ParallelTest(unittest.TestCase):
+    props = OperationProps(depth=-3, tab_depth=-2)
+    rect = shapes.Shape.rectangle(0, 0, 30, 20)
+    calls = [("outside_contour", rect, 4), ("pocket", rect, props.clone(rpm=10000)), ("engrave", shapes.Shape.circle(50, 10, 5), props.clone(rpm=12000)), ("peck_drill", 40, 10)]
+    def testFragments(self):
+        operations = calculate(self.props, self.calls, translation=(5, 10))
+        old_spindle_control = GeometrySettings.spindle_control
+        try:
+            for spindle_control in (False, True):
+                GeometrySettings.spindle_control = spindle_control
+                expected = operations.to_gcode().gcode
+                # The first operation generated normally to get a realistic state
+                first = Operations(machine_params, tool)
+                first.translation = operations.translation
+                first.add(operations.operations[0])
+                gcode = Gcode()
+                generator = first.generate_gcode(gcode)
+                next(generator)
+                for operation in operations.operations[1:]:
+                    # Wrong guesses are rejected
+                    self.assertFalse(gcode.add_fragment(operation_gcode_fragment(operation, operations.translation, -1, gcode.last_coords)))
+                    self.assertFalse(gcode.add_fragment(operation_gcode_fragment(operation, operations.translation, gcode.last_rpm, None)))
+                    self.assertTrue(gcode.add_fragment(operation_gcode_fragment(operation, operations.translation, gcode.last_rpm, gcode.last_coords)))
+                for i in generator:
+                    pass
+                self.assertEqual(gcode.gcode, expected)
+        finally:
+            GeometrySettings.spindle_control = old_spindle_control
+    def testWorkers(self):
+        operations = calculate(self.props, self.calls, translation=(5, 10))
+        expected = operations.to_gcode().gcode
+        try:
+            GeometrySettings.worker_processes = 2
+            GeometrySettings.parallel_gcode = True
+            self.assertEqual(operations.to_gcode().gcode, expected)
+            # Errors are reported the same way
+            broken = copy.copy(operations.operations[1])
+            broken.cutpaths = None
+            operations.operations.insert(1, broken)
+            with self.assertRaises(TypeError):
+                operations.to_gcode()
+        finally:
+            GeometrySettings.worker_processes = 0
+            GeometrySettings.parallel_gcode = False
+
+class CutOrderTest(unittest.TestCase):
+    # Holes and small pockets in the worst possible order, then the outline
+    # around all of them
+    calls = [call for x in [10 + (i % 2) * 80 + (i // 2) * 2 for i in range(8)] for call in [("peck_drill", x, 10), ("inside_contour", shapes.Shape.circle(x + 1, 30, 2), 0)]]
+    calls.append(("outside_contour", shapes.Shape.rectangle(0, 0, 100, 40), 0))
+    def testOrder(self):
+        operations = calculate(OperationProps(depth=-1), self.calls)
+        ordered, before, after = cut_order.optimize_order(operations.operations, PathPoint(0, 0))
+        self.assertLess(after, before / 2)
+        self.assertEqual(len(ordered), len(operations.operations))
+        self.assertEqual(set(ordered), set(operations.operations))
+        # The outline overlaps everything else
+        self.assertIs(ordered[-1], operations.operations[-1])
+        # A tool change can't be moved and nothing is moved across it
+        change = ToolChangeOperation(None, machine_params)
+        ordered2, before2, after2 = cut_order.optimize_order(operations.operations[:8] + [change] + operations.operations[8:], PathPoint(0, 0))
+        self.assertIs(ordered2[8], change)
+        self.assertEqual(set(ordered2[:8]), set(operations.operations[:8]))
+        self.assertLess(after, after2)
+    def testConstraints(self):
+        rng = random.Random(1)
+        for n in (5, 20, 60):
+            nodes = []
+            for i in range(n):
+                x, y = rng.uniform(0, 100), rng.uniform(0, 100)
+                r = rng.uniform(0.5, 10)
+                nodes.append(cut_order.CutNode(i, None, PathPoint(x, y), PathPoint(x + rng.uniform(-r, r), y), (x - r, y - r, x + r, y + r)))
+            ordered = cut_order.order_nodes(nodes, PathPoint(0, 0), None)
+            self.assertEqual(sorted(node.operation for node in ordered), list(range(n)))
+            self.assertLessEqual(cut_order.block_length(ordered, PathPoint(0, 0), None), cut_order.block_length(nodes, PathPoint(0, 0), None))
+            for i, a in enumerate(ordered):
+                for b in ordered[i + 1:]:
+                    if bounds_overlap(a.bounds, b.bounds):
+                        self.assertLess(a.operation, b.operation)
+    def testGcode(self):
+        operations = calculate(OperationProps(depth=-1), self.calls)
+        expected = operations.to_gcode().gcode
+        try:
+            GeometrySettings.reorder_cuts = True
+            gcode = operations.to_gcode().gcode
+        finally:
+            GeometrySettings.reorder_cuts = False
+        self.assertIn("(Rapid moves between the cuts:", gcode[3])
+        self.assertEqual(sorted(gcode[:3] + gcode[4:]), sorted(expected))
+
+class CannedCycleTest(unittest.TestCase):
+    props = OperationProps(depth=-3)
+    calls = [("peck_drill", 0, 0), ("peck_drill", 10, 0), ("peck_drill", 20, 0),
+        ("add", PeckDrill(30, 0, tool, machine_params, props, retract=RetractBy(0.5))),
+        ("peck_drill", 40, 0, OperationProps(depth=-0.5)),
+        ("add", PeckDrill(50, 0, tool, machine_params, props, dwell_retract=1)),
+        ("engrave", shapes.Shape.circle(50, 10, 5))]
+    def cycleLines(self, gcode):
+        return [line for line in gcode if line.startswith(("G7", "G8", "G9", "X"))]
+    def testCycles(self):
+        operations = calculate(self.props, self.calls)
+        expected = operations.to_gcode().gcode
+        self.assertEqual(self.cycleLines(expected), [])
+        feed = f"F{tool.vfeed:0.2f}"
+        try:
+            GeometrySettings.canned_cycles = True
+            gcode = operations.to_gcode().gcode
+            self.assertEqual(self.cycleLines(gcode), [
+                "G98 G83 X0 Y0 Z-3 R1 Q1 " + feed, "X10 Y0", "X20 Y0", "G80",
+                "G98 G73 X30 Y0 Z-3 R1 Q1 " + feed, "G80",
+                "G98 G81 X40 Y0 Z-0.5 R1 " + feed, "G80"])
+            # Each cycle starts at safe Z, and returns there after each of the
+            # holes, so the moves between them are at safe Z too
+            for i, line in enumerate(gcode):
+                if line.startswith("G98 "):
+                    self.assertEqual(gcode[i - 1], f"G0 Z{machine_params.safe_z}")
+                # The cycle is cancelled before any other moves
+                if line == "G80":
+                    self.assertFalse(gcode[i + 1].startswith(("X", "G0 X", "G1")))
+            # The holes drilled without a cycle are the same as before
+            self.assertEqual(gcode[gcode.index("G0 X50 Y0"):], expected[expected.index("G0 X50 Y0"):])
+            # Grbl doesn't support them
+            GeometrySettings.grbl_output = True
+            gcode = operations.to_gcode().gcode
+            GeometrySettings.canned_cycles = False
+            self.assertEqual(gcode, operations.to_gcode().gcode)
+        finally:
+            GeometrySettings.canned_cycles = False
+            GeometrySettings.grbl_output = False
+
+class HolePatternTest(unittest.TestCase):
+    def testSerpentineOrder(self):
+        points = [(5 * x, 5 * y) for y in range(4) for x in range(6)]
+        random.Random(1).shuffle(points)
+        order = cut_order.serpentine_order(points)
+        self.assertEqual(sorted(order.tolist()), list(range(len(points))))
+        ordered = [points[i] for i in order]
+        for row in range(4):
+            xs = [x for x, y in ordered[6 * row:6 * row + 6]]
+            self.assertEqual(set(y for x, y in ordered[6 * row:6 * row + 6]), {5 * row})
+            self.assertEqual(xs, sorted(xs, reverse=row % 2 == 1))
+        self.assertEqual(cut_order.serpentine_order([(1, 1), (0, 0)]).tolist(), [0, 1])
+    def testPattern(self):
+        centres = hole_pattern_centres([(10 * (i % 4), 10 * (i // 4)) for i in range(12)])
+        self.assertEqual(centres.shape, (12, 2))
+        self.assertRaises(ValueError, lambda: hole_pattern_centres([]))
+        for create in [lambda ops: ops.peck_drill_pattern(centres), lambda ops: ops.helical_drill_pattern(centres, 4)]:
+            pattern = Operations(machine_params, tool, OperationProps(depth=-2))
+            create(pattern)
+            operation = pattern.operations[0]
+            self.assertIsInstance(operation, HolePattern)
+            self.assertEqual(operation.instance_offsets().tolist(), (centres - centres[0]).tolist())
+            parts = operation.order_parts()
+            self.assertEqual(len(parts), 1)
+            self.assertEqual(parts[0][1:3], (PathPoint(*centres[0]), PathPoint(*centres[-1])))
+            self.assertEqual(parts[0][3][0:2], tuple(operation.hole.shape.bounds[0:2]))
+            self.assertGreaterEqual(parts[0][3][2], 30)
+            self.assertGreaterEqual(parts[0][3][3], 20)
+            # Same as separate operations, apart from the comments at the start and the end of the operations
+            # and the feed rate set again at the start of each of them
+            separate = Operations(machine_params, tool, OperationProps(depth=-2))
+            for x, y in centres.tolist():
+                if isinstance(operation.hole, PeckDrill):
+                    separate.peck_drill(x, y)
+                else:
+                    separate.helical_drill(x, y, 4)
+            without_ops = lambda gcode: [line for line in gcode if " operation: " not in line and not line.startswith("F")]
+            self.assertEqual(without_ops(pattern.to_gcode().gcode), without_ops(separate.to_gcode().gcode))
+            zpattern = operation.with_z_params(tool, machine_params, OperationProps(depth=-1))
+            self.assertEqual(zpattern.hole.props.depth, -1)
+            self.assertIs(zpattern.centres, operation.centres)
+
+class SubroutineTest(unittest.TestCase):
+    calls = [("outside_contour", shapes.Shape.round_rectangle(0, 0, 40, 30, 5), 0),
+        ("outside_contour", shapes.Shape.round_rectangle(60.5, 0.25, 100.5, 30.25, 5), 0),
+        ("helical_drill_pattern", hole_pattern_centres([(10 * i, 50) for i in range(5)]), 6)]
+    # Moves made by the program, as (command, X, Y, Z, I, J) with absolute
+    # coordinates, running the subroutines where they're called
+    def executedMoves(self, gcode):
+        subroutines = {}
+        current = None
+        main = []
+        for line in gcode:
+            words = line.split()
+            if words[0] == "M2":
+                # Followed by the M98 subprograms
+                current = []
+            elif words[0].startswith("O") and words[1:] in ([], ["sub"]):
+                current = subroutines[words[0]] = []
+            elif words[0] == "M99" or words[1:] == ["endsub"]:
+                current = None
+            elif current is not None:
+                current.append(line)
+            else:
+                main.append(line)
+        moves = []
+        pos = {}
+        relative = [False]
+        def execute(lines):
+            for line in lines:
+                words = line.split()
+                if words[0] in ("G90", "G91"):
+                    relative[0] = words[0] == "G91"
+                elif words[1:] == ["call"] or words[0] == "M98":
+                    execute(subroutines[words[0] if words[0] != "M98" else "O" + words[1][1:]])
+                elif words[0] in ("G0", "G1", "G2", "G3"):
+                    coords = {word[0]: float(word[1:]) for word in words[1:]}
+                    for axis in "XYZ":
+                        if axis in coords:
+                            pos[axis] = round(pos[axis] + coords[axis] if relative[0] else coords[axis], 6)
+                    moves.append((words[0], pos.get("X"), pos.get("Y"), pos.get("Z"), coords.get("I"), coords.get("J")))
+        execute(main)
+        return moves
+    def testSubroutines(self):
+        operations = calculate(OperationProps(depth=-4), self.calls)
+        expected = operations.to_gcode().gcode
+        self.assertFalse([line for line in expected if "sub" in line.split() or line.startswith("M98")])
+        try:
+            for mode, inches in [(SUBROUTINES_OWORD, False), (SUBROUTINES_M98, False), (SUBROUTINES_OWORD, True)]:
+                GeometrySettings.gcode_inches = inches
+                GeometrySettings.gcode_subroutines = SUBROUTINES_NONE
+                expected = operations.to_gcode().gcode
+                GeometrySettings.gcode_subroutines = mode
+                gcode = operations.to_gcode().gcode
+                # Same moves, the contours of each layer and the holes are only output once
+                self.assertEqual(self.executedMoves(gcode), self.executedMoves(expected))
+                self.assertLess(len(gcode), len(expected) / 2)
+                if mode == SUBROUTINES_OWORD:
+                    calls = [line for line in gcode if line.endswith(" call")]
+                    definitions = [line for line in gcode if line.endswith(" sub")]
+                    self.assertLess(gcode.index(definitions[0]), gcode.index(calls[0]))
+                else:
+                    calls = [line for line in gcode if line.startswith("M98 ")]
+                    definitions = [line for line in gcode[gcode.index("M2"):] if line.startswith("O")]
+                self.assertEqual(len(calls), 2 * 4 + 5 * len(operations.operations[2].hole.diameters()))
+                self.assertEqual(len(definitions), 2 + len(operations.operations[2].hole.diameters()))
+            # Grbl doesn't support them
+            GeometrySettings.grbl_output = True
+            gcode = operations.to_gcode().gcode
+            GeometrySettings.gcode_subroutines = SUBROUTINES_NONE
+            self.assertEqual(gcode, operations.to_gcode().gcode)
+        finally:
+            GeometrySettings.gcode_subroutines = SUBROUTINES_NONE
+            GeometrySettings.grbl_output = False
+            GeometrySettings.gcode_inches = False
+
+if __name__ == '__main__':
+    unittest.main()
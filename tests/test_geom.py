@@ -1,11 +1,20 @@
 import os
 import sys
+import tempfile
+import threading
+import time
 import unittest
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
 
 from DerpCAM.common.geom import *
+from DerpCAM.common import diskcache, geom
 from DerpCAM.cam.toolpath import Tab, Tabs
+from DerpCAM.cam.shapes import Shape
+from DerpCAM.cam import pocket
+from DerpCAM.cam.milling_tool import *
+import shapely
+from shapely.geometry import LineString
 
 def prepare(ranges):
     res = []
@@ -217,6 +226,24 @@ class GeomTest(unittest.TestCase):
         self.assertCloseEnoughTuple(p.closest_point(PathPoint(10 * sqrt(2) / 2, 10 * sqrt(2) / 2)), (2 * pi * 10 / 8, 0))
         self.assertCloseEnoughTuple(p.closest_point(PathPoint(10, 10)), (2 * pi * 10 / 8, PathPoint(10, 10).dist(PathPoint(10 * sqrt(2) / 2, 10 * sqrt(2) / 2))))
 
+    def testPositionIndex(self):
+        # Long enough to use the segment grid
+        nodes = [PathPoint(10 * cos(i * pi / 100), 10 * sin(i * pi / 100)) for i in range(200)]
+        p = Path(nodes, True)
+        lengths = p.lengths()
+        self.assertIs(p.lengths(), lengths)
+        self.assertIsNotNone(p.segment_grid())
+        for i in range(50):
+            pt = PathPoint(15 * cos(i * 0.37), 12 * sin(i * 0.37))
+            self.assertEqual(p.closest_point(pt), p.closest_point_on_segments(pt, range(len(lengths) - 1), lengths))
+            pos = i * p.length() / 50
+            self.assertEqual(p.point_at(pos), p.point_at_hint(pos, p.start_hint())[0])
+        self.assertEqual(p.point_at(p.length() + 1), p.point_at(1))
+        # Replacing the nodes invalidates the index
+        p.nodes = nodes[:50]
+        self.assertLess(p.length(), lengths[-1])
+        self.assertIsNone(p.segment_grid())
+
     def testSubpath(self):
         path = Path([PathPoint(0, 0), PathPoint(10, 0, 1), PathPoint(20, 0, 2), PathPoint(20, 0, 3), PathPoint(30, 0, 4)], False)
         self.assertEqual(path.length(), 30)
@@ -236,6 +263,276 @@ class GeomTest(unittest.TestCase):
         self.assertNear(subpath.nodes[1].sspan, 0.4)
         self.assertEqual(subpath.nodes[1].speed_hint, Ellipsis)
 
+    def testCoordinateBuffers(self):
+        pts = [PathPoint(0.5, 1.02), PathPoint(-3.1, 2), PathPoint(7, -0.06)]
+        ints = PtsToInts(pts)
+        self.assertEqual([tuple(i) for i in PtsToInts(PtsToArray(pts))], ints)
+        self.assertEqual(PtsToIntArray(pts).tolist(), [list(i) for i in ints])
+        self.assertEqual(PtsFromInts(IntsToArray(ints)), PtsFromInts(ints))
+        self.assertEqual(ArrayToPts(PtsFromIntArray(ints)), PtsFromInts(ints))
+        self.assertEqual(ArrayToPts(PtsToArray(pts)), pts)
+        self.assertEqual(ArrayToPts(PtsToArray([])), [])
+        path = IntPath(pts)
+        self.assertEqual(IntPath(path.int_array(), True).int_points, [list(i) for i in path.int_points])
+        self.assertEqual(path.real_array().tolist(), [[p.x, p.y] for p in path.real_points()])
+        self.assertEqual(len(circle(1, 2, 10)), ceil(pi * 10 * GeometrySettings.RESOLUTION) + 1)
+        self.assertEqual(circle(1, 2, 0), [PathPoint(1, 2)])
+
+    def testArrayPath(self):
+        arc = PathArc(PathPoint(10, 0), PathPoint(0, 10), CandidateCircle(0, 0, 10), 10, 0, pi / 2, Ellipsis)
+        for closed in (False, True):
+            path = Path([PathPoint(0, 0), PathPoint(10, 0, 5), arc, PathPoint(0, 5)], closed)
+            apath = ArrayPath.from_path(path).compact()
+            self.assertEqual(len(apath), 4)
+            self.assertTrue(apath.has_arcs())
+            self.assertEqual(apath.nodes, path.nodes)
+            self.assertEqual(apath.nodes[1].speed_hint, 5)
+            self.assertEqual(apath.nodes[2].speed_hint, Ellipsis)
+            self.assertEqual(apath, path)
+            self.assertNear(apath.length(), path.length())
+            self.assertCloseEnoughTuple(apath.lengths(), path.lengths())
+            self.assertCloseEnoughTuple(apath.bounds(), path.bounds())
+            self.assertEqual(apath.seg_end(), path.seg_end())
+            self.assertEqual(list(PathSegmentIterator(apath)), list(PathSegmentIterator(path)))
+            self.assertCloseEnoughTuple(apath.closest_point(PathPoint(8, 8)), path.closest_point(PathPoint(8, 8)))
+            self.assertEqual(apath.point_at(12), path.point_at(12))
+            moved = apath.translated(5, 10)
+            self.assertEqual(moved.nodes[2].c.centre(), PathPoint(5, 10))
+            self.assertEqual(moved.nodes[2].p1, PathPoint(15, 10))
+            self.assertEqual(moved.to_path().nodes[3], PathPoint(5, 15))
+        apath = ArrayPath([], False)
+        self.assertTrue(apath.is_empty())
+        self.assertEqual(apath.lengths(), [0])
+
+class GeometryCacheTest(unittest.TestCase):
+    def testCache(self):
+        cache = GeometryCache(max_points=12)
+        calls = []
+        def execute(value):
+            def func():
+                calls.append(value)
+                return GeometryCache.freeze_paths([[[value, 0], [value, 1], [value + 1, 1]]])
+            return func
+        square = [[0, 0], [10, 0], [10, 10], [0, 10]]
+        key1 = GeometryCache.key(('op', 1), [square])
+        self.assertEqual(key1, GeometryCache.key(('op', 1), [[tuple(i) for i in square]]))
+        self.assertEqual(key1, GeometryCache.key(('op', 1), [IntPath(square, True)]))
+        self.assertNotEqual(key1, GeometryCache.key(('op', 2), [square]))
+        self.assertNotEqual(key1, GeometryCache.key(('op', 1), [square[::-1]]))
+        self.assertNotEqual(GeometryCache.key(('op', 1), [square], []), GeometryCache.key(('op', 1), [], [square]))
+        res = GeometryCache.thaw_paths(cache.lookup(('op', 1), [[square]], execute(1)))
+        self.assertEqual(res, [[[1, 0], [1, 1], [2, 1]]])
+        # Modifying the result doesn't affect the cached copy
+        res[0].append([5, 5])
+        self.assertEqual(GeometryCache.thaw_paths(cache.lookup(('op', 1), [[square]], execute(1))), [[[1, 0], [1, 1], [2, 1]]])
+        self.assertEqual((cache.hits, cache.misses, calls), (1, 1, [1]))
+        # Least recently used entries are evicted first
+        keys = [GeometryCache.key(('op', i), [square]) for i in range(2, 6)]
+        for i in range(2, 6):
+            cache.lookup(('op', i), [[square]], execute(i))
+            cache.lookup(('op', 1), [[square]], execute(1))
+        self.assertEqual(calls, [1, 2, 3, 4, 5])
+        self.assertLessEqual(cache.points, 12)
+        self.assertIn(key1, cache.entries)
+        self.assertNotIn(keys[0], cache.entries)
+        # Disabled cache
+        GeometrySettings.geometry_cache = False
+        try:
+            cache.lookup(('op', 1), [[square]], execute(1))
+        finally:
+            GeometrySettings.geometry_cache = True
+        self.assertEqual(calls, [1, 2, 3, 4, 5, 1])
+
+    def testClipper(self):
+        square = IntPath([[0, 0], [100, 0], [100, 100], [0, 100]], True)
+        hole = IntPath([[20, 20], [80, 20], [80, 80], [20, 80]], True)
+        line = IntPath([[-10, 50], [110, 50]], True)
+        geometry_cache.clear()
+        for i in range(2):
+            self.assertEqual(sum(i.area() for i in run_clipper_simple(CT_DIFFERENCE, [square], [hole], return_ints=True)), 10000 - 3600)
+            tree = run_clipper_advanced(CT_INTERSECTION, [], [square], [line])
+            self.assertEqual(OpenPathsFromPolyTree(tree), [[[100, 50], [0, 50]]])
+            OpenPathsFromPolyTree(tree)[0].append([1000, 1000])
+        self.assertEqual(geometry_cache.hits, 2)
+        self.assertEqual(geometry_cache.misses, 2)
+
+class DiskCacheTest(unittest.TestCase):
+    def testCache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = diskcache.DiskCache(cache_dir, 3000)
+            self.assertIsNone(cache.load('a'))
+            value = {'paths': [[0, 0], [10, 0], [10, 10]], 'depth': -3.5}
+            self.assertTrue(cache.store('a', value))
+            self.assertEqual(cache.load('a'), value)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            # Least recently used entries are evicted first, 'a' is used all the time
+            mtime = time.time() - 100
+            for key in 'bcde':
+                os.utime(cache.filename('a'), (mtime, mtime))
+                self.assertTrue(cache.store(key, os.urandom(1000)))
+                os.utime(cache.filename(key), (mtime + 1, mtime + 1))
+                mtime += 2
+            self.assertLessEqual(cache.size, 3000)
+            self.assertIsNone(cache.load('b'))
+            self.assertIsNone(cache.load('c'))
+            self.assertEqual(cache.load('a'), value)
+            self.assertEqual(sorted(os.listdir(cache_dir)), sorted(os.path.basename(cache.filename(key)) for key in 'ade'))
+            # Too large to be stored
+            self.assertFalse(cache.store('f', os.urandom(5000)))
+            # Damaged entries are removed
+            with open(cache.filename('e'), "wb") as f:
+                f.write(diskcache.DiskCache.MAGIC + b"garbage")
+            self.assertIsNone(cache.load('e'))
+            self.assertFalse(os.path.exists(cache.filename('e')))
+            cache.clear()
+            self.assertEqual(os.listdir(cache_dir), [])
+
+class OffsetTest(unittest.TestCase):
+    def testLargeOffset(self):
+        res = GeometrySettings.RESOLUTION
+        square = PtsToInts(Shape.rectangle(0, 0, 200, 200).boundary)
+        for dist in (5, 35, 60, 99):
+            offset = Shape._offset(square, True, -dist * res)
+            self.assertEqual(len(offset), 1)
+            self.assertEqual(sorted(PtsToInts(PtsFromInts(offset[0]))), sorted(PtsToInts(Shape.rectangle(dist, dist, 200 - dist, 200 - dist).boundary)))
+        self.assertEqual(Shape._offset(square, True, -101 * res), [])
+        # Open paths are only ever widened
+        line = PtsToInts([PathPoint(0, 0), PathPoint(100, 0)])
+        self.assertEqual(Shape._offset(line, False, -5 * res), [])
+        self.assertEqual(len(Shape._offset(line, False, 50 * res)), 1)
+        # Growing a circle in steps still gives a circle, each step may add
+        # up to half a Clipper unit of rounding error
+        offset = Shape._offset(PtsToInts(circle(0, 0, 10)), True, 50 * res)
+        self.assertEqual(len(offset), 1)
+        for x, y in offset[0]:
+            self.assertLess(abs(sqrt(x * x + y * y) / res - 60), 0.15)
+        # The offset settings are part of the cache key
+        old_tolerance = GeometrySettings.offset_arc_tolerance
+        try:
+            GeometrySettings.offset_arc_tolerance = 0.2
+            coarse = Shape._offset(PtsToInts(circle(0, 0, 10)), True, 50 * res)
+            self.assertLess(len(coarse[0]), len(offset[0]))
+        finally:
+            GeometrySettings.offset_arc_tolerance = old_tolerance
+
+    def testContourRings(self):
+        shape = Shape.round_rectangle(0, 0, 120, 80, 10)
+        shape.add_island(Shape.circle(60, 40, 10).boundary)
+        tool = standard_tool(4, 2, material_aluminium, carbide_uncoated)
+        islands = pocket.calculate_tool_margin(shape, tool, 0)[1]
+        count = 0
+        for displace, tps in pocket.calc_contour_rings(shape, tool, 0.25, 1.5, subtract=islands):
+            expected = pocket.calc_contour(shape, tool, False, displace, subtract=islands)
+            if not tps:
+                self.assertIsNone(expected)
+                break
+            self.assertEqual(len(tps.toolpaths), len(expected.toolpaths))
+            # Chained rings may differ by a few Clipper units (mostly in the
+            # rounded corners), the pieces may come in a different order
+            for tp in tps.toolpaths:
+                ls = LineString(PtsToArray(tp.path.nodes))
+                self.assertLess(min(shapely.hausdorff_distance(ls, LineString(PtsToArray(exp_tp.path.nodes))) for exp_tp in expected.toolpaths), 0.2)
+            count += 1
+        self.assertEqual(count, 26)
+
+# Jobs for WorkerJobTest, they need to be importable by the workers
+def report_and_wait(timeout):
+    set_calculation_progress(1, 2)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if is_calculation_cancelled():
+            return 'cancelled'
+        time.sleep(0.01)
+    return 'timeout'
+
+def report_and_return(value):
+    set_calculation_progress(1, 2)
+    return value
+
+class WorkerJobTest(unittest.TestCase):
+    def waitFor(self, condition):
+        deadline = time.time() + 10
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+    def testJobs(self):
+        try:
+            GeometrySettings.worker_processes = 2
+            pool = get_worker_pool()
+            waiting = submit_calculation(pool, report_and_wait, 10)
+            self.waitFor(lambda: waiting.progress() == (1, 2))
+            # The jobs submitted while the first one is running don't share
+            # its cancel flag
+            jobs = [submit_calculation(pool, report_and_return, i) for i in range(5)]
+            self.assertNotIn(waiting.cancel_slot, [job.cancel_slot for job in jobs])
+            self.assertEqual([job.result() for job in jobs], list(range(5)))
+            waiting.cancel()
+            self.assertEqual(waiting.result(), 'cancelled')
+            # Progress reported by the finished jobs isn't kept
+            time.sleep(0.2)
+            self.waitFor(lambda: not geom.worker_progress)
+            self.waitFor(lambda: len(geom.worker_free_slots) == len(geom.worker_cancel_flags))
+        finally:
+            GeometrySettings.worker_processes = 0
+
+class HSMTest(unittest.TestCase):
+    def testParallel(self):
+        # Two separate pockets
+        shape = Shape.rectangle(0, 0, 60, 30)
+        shape.add_island(Shape.rectangle(27, 0, 33, 25).boundary)
+        tool = standard_tool(6, 2, material_aluminium, carbide_uncoated)
+        def dump(tps):
+            return [(tp.path.nodes, tp.is_cleanup, vars(tp.helical_entry) if tp.helical_entry else None) for tp in tps.toolpaths]
+        def calculate():
+            thread = threading.Thread(target=lambda: results.append(dump(pocket.hsm_peel(shape, tool, False))))
+            thread.start()
+            thread.join()
+            return thread.progress
+        results = []
+        serial_progress = calculate()
+        try:
+            GeometrySettings.worker_processes = 2
+            progress = calculate()
+        finally:
+            GeometrySettings.worker_processes = 0
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(serial_progress, (1999, 2000))
+        self.assertEqual(progress, (1999, 2000))
+
+class AxisParallelTest(unittest.TestCase):
+    def testEndpointIndex(self):
+        paths = pocket.EndpointIndex(True)
+        a = Path([PathPoint(0, 0), PathPoint(10, 0)], False)
+        b = Path([PathPoint(10, 0), PathPoint(10, 10)], False)
+        c = Path([PathPoint(20, 0), PathPoint(10, 0)], False)
+        for path in (a, b, c):
+            paths.append(path)
+        self.assertEqual(len(paths), 3)
+        # The earliest added path wins, even if it needs reversing
+        self.assertEqual(paths.pop_near(PathPoint(10.01, 0)).nodes, a.reverse().nodes)
+        self.assertIs(paths.pop_near(PathPoint(10, 0)), b)
+        self.assertIsNone(paths.pop_near(PathPoint(15, 0)))
+        self.assertIs(paths.pop_first(), c)
+        self.assertEqual(len(paths), 0)
+        slices = pocket.EndpointIndex(False)
+        slices.append(c)
+        self.assertIsNone(slices.pop_near(PathPoint(10, 0)))
+        self.assertIs(slices.pop_near(PathPoint(20, 0)), c)
+
+    def testZigzag(self):
+        tool = standard_tool(6, 2, material_aluminium, carbide_uncoated)
+        # One path for all the rows and one for the final contour
+        tps = pocket.axis_parallel(Shape.rectangle(0, 0, 200, 100), tool, 0, 0, True)
+        self.assertEqual(len(tps.toolpaths), 2)
+        shape = Shape.round_rectangle(0, 0, 300, 200, 10)
+        for i in range(6):
+            shape.add_island(Shape.circle(40 + i * 45, 100, 12).boundary)
+        for angle in (0, pi / 6, pi / 2):
+            tps = pocket.axis_parallel(shape, tool, angle, 0, False)
+            zigzag_tps = pocket.axis_parallel(shape, tool, angle, 0, True)
+            self.assertLess(len(zigzag_tps.toolpaths), len(tps.toolpaths))
+            self.assertAlmostEqual(sum(tp.path.length() for tp in zigzag_tps.toolpaths), sum(tp.path.length() for tp in tps.toolpaths), delta=0.2 * sum(tp.path.length() for tp in tps.toolpaths))
+
 class TabsTest(unittest.TestCase):
     def testCut(self):
         # Tabs / cut
@@ -283,4 +580,83 @@ class CircleTest(unittest.TestCase):
             self.verify_path_circles(c2)
             self.assertEqual(len(c2), 4)
 
-unittest.main()
+    def testArcFitter(self):
+        for i in range(1, 50):
+            c = circle(0, 0, 0.3 * i, None, 0, 2 * pi / 3)
+            c2 = ArcFitter.simplify(c)
+            self.verify_path_circles(c2)
+            self.assertEqual(len(c2), 2)
+            self.assertLess(abs(c2[1].sspan - 2 * pi / 3), 0.01)
+
+        for i in range(10, 50):
+            c = circle(0, 0, i, None, 0, -2 * pi)
+            c2 = ArcFitter.simplify(c)
+            self.verify_path_circles(c2)
+            self.assertEqual(len(c2), 4)
+            self.assertLess(c2[1].sspan, 0)
+            self.assertLess(c2[3].sspan, 0)
+
+        # Offset contours, with the coordinates rounded to the Clipper units.
+        # Short ranges of those points fit tiny circles, in either direction,
+        # but each of the curves is still replaced by long arcs.
+        for r in (1, 5, 20):
+            for contour in Shape._offset(PtsToInts(Shape.circle(0, 0, r).boundary), True, 1.5 * GeometrySettings.RESOLUTION):
+                c2 = ArcFitter.simplify(PtsFromInts(contour))
+                self.assertEqual([item.sspan > 0 for item in c2 if item.is_arc()], [True, True])
+        shape = Shape.union(Shape.rectangle(0, 0, 60, 40), Shape.circle(60, 20, d=30))
+        tool = standard_tool(3, 2, material_aluminium, carbide_uncoated)
+        for tp in pocket.calc_contour(shape, tool, True).toolpaths:
+            c2 = ArcFitter.simplify(tp.path.nodes)
+            # The four corners and the two parts of the circle
+            self.assertEqual([item.sspan > 0 for item in c2 if item.is_arc()], [True] * 6)
+
+        # Straight lines and sharp corners are left alone
+        square = [PathPoint(i * 0.1, 0) for i in range(100)] + [PathPoint(10, i * 0.1) for i in range(100)]
+        self.assertEqual(ArcFitter.simplify(square), square)
+
+        # Existing arcs are passed through
+        arc = PathArc.xyra(0, 0, 10, 0, pi / 2)
+        c = [PathPoint(20, 0), arc.p1, arc] + circle(0, 0, 10, None, pi / 2, pi)
+        c2 = ArcFitter.simplify(c)
+        self.assertIs(c2[2], arc)
+        self.assertEqual(len(c2), 5)
+
+class LineSimplifierTest(unittest.TestCase):
+    def max_deviation(self, original, simplified):
+        path = Path(simplified, False)
+        return max(path.closest_point(p.seg_end())[1] for p in original)
+
+    def testSimplify(self):
+        # Wobbly line, a circle and a spiral
+        wobbly = [PathPoint(i * 0.05, 0.002 * sin(i)) for i in range(1000)]
+        c = circle(0, 0, 10)
+        spiral = [PathPoint((1 + i * 0.002) * cos(i * 0.005), (1 + i * 0.002) * sin(i * 0.005)) for i in range(5000)]
+        for points in (wobbly, c, spiral):
+            for tolerance in (0.001, 0.01, 0.1):
+                res = LineSimplifier.simplify(points, tolerance)
+                self.assertIs(res[0], points[0])
+                self.assertIs(res[-1], points[-1])
+                self.assertLess(len(res), len(points))
+                self.assertLessEqual(self.max_deviation(points, res), tolerance + 1e-9)
+        self.assertEqual(len(LineSimplifier.simplify(wobbly, 0.01)), 2)
+        # Disabled
+        self.assertIs(LineSimplifier.simplify(wobbly, 0), wobbly)
+
+    def testBoundaries(self):
+        arc = PathArc.xyra(0, 0, 10, 0, pi / 2)
+        line1 = [PathPoint(20 - i * 0.1, 0) for i in range(101)]
+        line2 = [PathPoint(0, 10 + i * 0.1) for i in range(1, 101)]
+        res = LineSimplifier.simplify(line1 + [arc] + line2, 0.01)
+        self.assertEqual(res, [line1[0], line1[-1], arc, line2[-1]])
+        # A change of speed hint is always a vertex
+        line = [PathPoint(i * 0.1, 0, 1 if 30 < i <= 60 else None) for i in range(100)]
+        res = LineSimplifier.simplify(line, 0.01)
+        self.assertEqual(res, [line[0], line[30], line[60], line[99]])
+        # Same results for the array-based paths
+        for nodes in (line1 + [arc] + line2, line):
+            for closed in (False, True):
+                apath = ArrayPath.from_nodes(nodes, closed).optimize_lines(0.01).compact()
+                self.assertEqual(apath.nodes, Path(nodes, closed).optimize_lines(0.01).nodes)
+
+if __name__ == '__main__':
+    unittest.main()
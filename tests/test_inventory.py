@@ -142,4 +142,5 @@ class InventoryTest(unittest.TestCase):
         for k, v in attribs.items():
             self.assertEqual(getattr(preset, k), v, f"{tool_name} -> {preset_name} -> {k}")
 
-unittest.main()
+if __name__ == '__main__':
+    unittest.main()
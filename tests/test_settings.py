@@ -31,6 +31,7 @@ class ConfigDialogTest(unittest.TestCase):
         self.checkSpinbox("clearance_z", "clearanceZSpin", [(42, 33.25), (21, 55)])
         self.checkSpinbox("safe_entry_z", "safeEntryZSpin", [(42, 33.25), (21, -55)])
         self.checkSpinbox("spindle_warmup", "warmupSpin", [(42, 33.2)])
+        self.checkSpinbox("worker_processes", "workerProcessesSpin", [(2, 0), (0, 3)], geometry_setting='worker_processes')
     def testCheckboxes(self):
         self.checkCheckbox('simplify_arcs', 'simplifyArcsCheck')
         self.checkCheckbox('simplify_lines', 'simplifyLinesCheck')
@@ -39,6 +40,34 @@ class ConfigDialogTest(unittest.TestCase):
         self.checkCheckbox('grbl_output', 'grblOutputCheck')
         self.checkCheckbox('gcode_inches', 'gcodeInchesCheck')
         self.checkCheckbox('spindle_control', 'spindleControlCheck')
+        self.checkCheckbox('reorder_cuts', 'reorderCutsCheck')
+        self.checkCheckbox('canned_cycles', 'cannedCyclesCheck')
+        self.checkCheckbox('parallel_gcode', 'parallelGcodeCheck')
+    def testSubroutines(self):
+        for value in (1, 2, 0):
+            self.createDialog()
+            self.assertEqual(self.dlg.subroutinesCombo.currentIndex(), self.settings.gcode_subroutines)
+            self.dlg.subroutinesCombo.setCurrentIndex(value)
+            self.dlg.accept()
+            self.assertEqual(self.settings.gcode_subroutines, value)
+            self.settings.update()
+            self.assertEqual(geom.GeometrySettings.gcode_subroutines, value)
+            self.settings.save()
+            self.settings.load()
+            self.assertEqual(self.settings.gcode_subroutines, value)
+    def testCamCache(self):
+        self.checkSpinbox("cam_cache_size", "camCacheSizeSpin", [(100, 50), (20, 1000)], geometry_setting='cam_cache_size')
+        for value in (False, True):
+            self.settings.cam_cache = not value
+            self.createDialog()
+            self.dlg.camCacheCheck.setChecked(value)
+            self.dlg.accept()
+            self.assertEqual(self.settings.cam_cache, value)
+            self.settings.update()
+            self.assertEqual(geom.GeometrySettings.cam_cache_dir is not None, value)
+        self.settings.no_cache = True
+        self.settings.update()
+        self.assertIsNone(geom.GeometrySettings.cam_cache_dir)
     def testEditBoxes(self):
         self.checkDirEditbox('input_directory', 'inputDirEdit')
         self.checkDirEditbox('gcode_directory', 'gcodeDirEdit')
@@ -195,6 +224,6 @@ class ConfigDialogTest(unittest.TestCase):
             self.dlg.reject()
             self.assertEqual(getattr(self.settings, config_attr), value, config_attr)
 
-unittest.main()
-
-del app
+if __name__ == '__main__':
+    unittest.main()
+    del app